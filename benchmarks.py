@@ -0,0 +1,450 @@
+from bs4 import BeautifulSoup
+from data_munging import JsonData, DataBase, Coordinates, TimeSerie, Aggregates, CountCube, column_names, \
+    partitioned_counts, read_arrow, list_buffers
+from near_duplicates import NearDuplicates
+from search_index import SearchIndex
+import data_scrapper
+import numpy as np
+import pandas as pd
+import argparse
+import datetime
+import gc
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+STATES = ['AL', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'FL', 'GA', 'ID', 'IL', 'IN', 'IA', 'KS', 'KY', 'LA',
+          'ME', 'MD', 'MA', 'MI', 'MN', 'MS', 'MO', 'MT', 'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC', 'ND',
+          'OH', 'OK', 'OR', 'PA', 'RI', 'SC', 'SD', 'TN', 'TX', 'UT', 'VT', 'VA', 'WA', 'WV', 'WI', 'WY']
+SHAPES = ['Light', 'Circle', 'Triangle', 'Fireball', 'Unknown', 'Disk', 'Sphere', 'Oval', 'Other']
+DURATIONS = ['1 hour', '5 minutes', '30 seconds', '5-10 min', '2 hours', 'a few seconds', '~3 min', '']
+WORDS = ['light', 'lights', 'bright', 'orange', 'white', 'red', 'object', 'sky', 'moving', 'hovering',
+         'fast', 'slow', 'north', 'south', 'east', 'west', 'three', 'two', 'triangle', 'no', 'sound',
+         'we', 'saw', 'the', 'over', 'above', 'trees', 'then', 'disappeared', 'formation', 'craft']
+
+
+def make_month_page(rows, seed=0):
+    """
+    Builds the HTML of a NUFORC-like month page [level 2] with the given number
+    of rows. The same seed always gives the same page.
+    Args:
+        rows: The number of reports in the table
+        seed: The seed of the random generator
+    """
+    rnd = random.Random(seed)
+    cities = ['St. Louis', 'Phoenix', 'Seattle', 'Boston', 'Austin', 'Denver']
+    states = ['MO', 'AZ', 'WA', 'MA', 'TX', 'CO']
+    shapes = ['Light', 'Circle', 'Triangle', 'Fireball', 'Unknown', 'Disk']
+    durations = ['1 hour', '5 minutes', '30 seconds', '5-10 min', '2 hours']
+
+    body = []
+    for i in range(rows):
+        city = rnd.randrange(len(cities))
+        day = rnd.randint(1, 28)
+        body.append('<TR VALIGN=TOP>\n<TD><FONT><A HREF=138/S138%03d%03d.html>11/%d/17 %02d:%02d</A></FONT></TD>'
+                    '\n<TD><FONT>%s</FONT></TD>\n<TD><FONT>%s</FONT></TD>\n<TD><FONT>%s</FONT></TD>'
+                    '\n<TD><FONT>%s</FONT></TD>\n<TD><FONT>Lights in the sky &amp; a hum %d</FONT></TD>'
+                    '\n<TD><FONT>11/%d/17</FONT></TD>\n</TR>'
+                    % (i // 1000, i % 1000, day, rnd.randrange(24), rnd.randrange(60), cities[city],
+                       states[city], rnd.choice(shapes), rnd.choice(durations), i, day))
+
+    return ('<HTML><BODY><TABLE CELLSPACING=0 BORDER=1>\n<THEAD>\n<TR>\n<TH>Date / Time</TH>\n'
+            '<TH>City</TH>\n<TH>State</TH>\n<TH>Shape</TH>\n<TH>Duration</TH>\n<TH>Summary</TH>\n'
+            '<TH>Posted</TH>\n</TR>\n</THEAD>\n<TBODY>\n' + '\n'.join(body) +
+            '\n</TBODY>\n</TABLE></BODY></HTML>')
+
+
+def soup_parse(text):
+    soup = BeautifulSoup(text, "html.parser")
+    return (data_scrapper.extract_links(soup), data_scrapper.get_event_content(soup))
+
+
+def best_of(function, text, repeat):
+    """
+    Returns the best wall time in seconds of `repeat' calls of function(text)
+    """
+    best = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_parsers(pages, repeat=3):
+    """
+    Times the BeautifulSoup and the fast extraction of month pages and checks
+    that both give the same output.
+    Args:
+        pages: A dict {name: html}
+        repeat: The number of runs per page, the best one is kept
+    """
+    result = {}
+    for name, text in pages.items():
+        if (soup_parse(text) != data_scrapper.parse_event_page(text)):
+            raise ValueError('The fast parser output differs on ' + name)
+
+        soup = best_of(soup_parse, text, repeat)
+        fast = best_of(data_scrapper.parse_event_page, text, repeat)
+        result[name] = {'soup': soup, 'fast': fast, 'speedup': soup / fast}
+    return result
+
+
+def make_counties(n, seed=0):
+    """
+    Returns n rows of a synthetic US_Counties.csv as a DataFrame. The
+    geometry of a county is a KML polygon of 5 to 50 points, one county in
+    ten having two of them. The same seed always gives the same rows.
+    Args:
+        n: The number of counties
+        seed: The seed of the random generator
+    """
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(n):
+        state = STATES[i % len(STATES)]
+        name = 'County {}'.format(i // len(STATES))
+        polygons = []
+        for ring in range(2 if (i % 10 == 0) else 1):
+            lon, lat = rnd.uniform(-120, -70), rnd.uniform(26, 48)
+            angles = sorted(rnd.uniform(0, 2 * np.pi) for j in range(rnd.randint(5, 50)))
+            points = ['%.6f,%.6f' % (lon + 0.3 * np.cos(a) * rnd.uniform(0.5, 1), lat + 0.3 * np.sin(a) *
+                                     rnd.uniform(0.5, 1)) for a in angles]
+            polygons.append('<Polygon><outerBoundaryIs><LinearRing><coordinates>' + ' '.join(points + points[:1]) +
+                            '</coordinates></LinearRing></outerBoundaryIs></Polygon>')
+        geometry = ''.join(polygons)
+        if (len(polygons) > 1):
+            geometry = '<MultiGeometry>' + geometry + '</MultiGeometry>'
+        rows.append({'State-County': state + '-' + name, 'state abbr': state, 'value': i, 'GEO_ID': i,
+                     'GEO_ID2': i, 'County Name': name, 'State Abbr': state, 'geometry': geometry,
+                     'Geographic Name': name + ', ' + state, 'FIPS formula': i, 'Has error': 0,
+                     'STATE num': i % len(STATES), 'COUNTY num': i})
+    return pd.DataFrame(rows)
+
+
+def make_reports(n, places, seed=0):
+    """
+    Generator of n synthetic records in the format of the scraper, over the
+    years 1990-2017. 80% of the reports are in one of places, and one in
+    twenty repeats the summary of the previous report of the same day and
+    state with another city spelling, as the near duplicates of the website.
+    The same arguments always give the same records.
+    Args:
+        n: The number of reports
+        places: A list of (city, state) the reports are mostly located in
+        seed: The seed of the random generator
+    """
+    rnd = random.Random(seed)
+    first = datetime.datetime(1990, 1, 1)
+    previous = None
+    for i in range(n):
+        if ((previous is not None) and (i % 20 == 0)):
+            fields = dict(previous)
+            fields['City'] = fields['City'].upper()
+            fields['Summary'] = fields['Summary'].replace('the', 'teh', 1)
+        else:
+            if (rnd.random() < 0.8):
+                city, state = rnd.choice(places)
+            else:
+                city, state = 'Town {}'.format(rnd.randrange(10000)), rnd.choice(STATES)
+            date = first + datetime.timedelta(minutes=rnd.randrange(28 * 365 * 24 * 60))
+            fields = {'Date / Time': '{}/{}/{:02d} {:02d}:{:02d}'.format(date.month, date.day, date.year % 100,
+                                                                        date.hour, date.minute),
+                      'City': city, 'State': state, 'Shape': rnd.choice(SHAPES),
+                      'Duration': rnd.choice(DURATIONS),
+                      'Summary': ' '.join(rnd.choice(WORDS) for j in range(rnd.randint(5, 40))),
+                      'Posted': '{}/{}/{:02d}'.format(date.month, date.day, date.year % 100)}
+            previous = fields
+        date = fields['Date / Time']
+        yield {'{:02d}{:02d}/S{:08d}'.format(int(date.split('/')[2][:2]), int(date.split('/')[0]), i): fields}
+
+
+def write_dataset(directory, n, seed=0):
+    """
+    Writes n synthetic reports (reports.jsonl) and their counties
+    (counties.csv) into directory and returns both paths. The number of
+    counties grows with n up to the 3000 or so of the US.
+    Args:
+        directory: The output directory
+        n: The number of reports
+        seed: The seed of the random generators
+    """
+    counties = make_counties(min(3000, max(50, n // 100)), seed)
+    counties_file = os.path.join(directory, 'counties.csv')
+    counties.to_csv(counties_file, index=False)
+
+    data_file = os.path.join(directory, 'reports.jsonl')
+    places = list(zip(counties['County Name'], counties['State Abbr']))
+    with data_scrapper.RecordWriter(data_file) as writer:
+        for record in make_reports(n, places, seed):
+            writer.write(record)
+    return (data_file, counties_file)
+
+
+def measure(function, context, repeat=1, memory=True):
+    """
+    Runs function(context) repeat times and returns the best wall time in
+    seconds and, if memory is set, the peak of the memory allocated by Python
+    and NumPy during one more run traced with tracemalloc (the memory of the
+    child processes is not traced).
+    Args:
+        function: The stage
+        context: The dict shared by the stages
+        repeat: The number of timed runs
+        memory: Adds a traced run for the peak memory
+    """
+    result = {'seconds': float('inf')}
+    for i in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function(context)
+        result['seconds'] = min(result['seconds'], time.perf_counter() - start)
+
+    if (memory):
+        gc.collect()
+        tracemalloc.start()
+        try:
+            function(context)
+            result['peak_mb'] = tracemalloc.get_traced_memory()[1] / float(1 << 20)
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+# STAGES
+# Every stage takes the context shared by the stages of one size, reads the
+# results of the stages it requires and stores its own. They can run again.
+def stage_pages(context):
+    for i in range(max(1, context['size'] // 1000)):
+        data_scrapper.parse_event_page(context['pages'][i % len(context['pages'])])
+
+
+def stage_load(context):
+    df = JsonData(context['data_file'], id_column='id', typed=True).get_dataframe()
+    context['df'] = df.rename(columns=column_names)
+
+
+def stage_mongo(context):
+    config = {'host': 'localhost', 'port': 27017, 'db': 'benchmarks', 'collection': 'reports'}
+    db = DataBase(config, client=mongomock.MongoClient())
+    db.save_from_frame(context['df'].drop(['summary'], axis=1), 'id')
+    db.count_by_place()
+    db.count_by_day()
+
+
+def stage_aggregates(context):
+    path = os.path.join(context['directory'], 'aggregates.sqlite')
+    if (os.path.isfile(path)):
+        os.remove(path)
+    aggregates = Aggregates(path)
+    aggregates.apply(context['df'], 'id')
+    context['places'], context['days'] = aggregates.places(), aggregates.day_state()
+    aggregates.close()
+
+
+def stage_partitioned(context):
+    partitioned_counts([context['data_file']], context['processes'], chunk_bytes=8 << 20)
+
+
+def stage_counties(context):
+    context['coord'] = Coordinates(context['counties_file'])
+
+
+def stage_geo(context):
+    context['coord'].combine_with(context['places'], 'reports', 'sum')
+    context['coord'].combine_with(context['df'], 'reports', 'size')
+
+
+def stage_timeserie(context):
+    ts = TimeSerie(pd.Timestamp(1990, 1, 1), pd.Timestamp(2017, 12, 31))
+    ts.combine_with(context['days'], 'reports', 'sum')
+    ts.combine_with(context['df'], 'reports', 'size', freq='month')
+
+
+def stage_cube(context):
+    CountCube.build(context['df'], context['coord'], os.path.join(context['directory'], 'cube'))
+
+
+# The geo output written and read back, as JSON and as a memory mapped Arrow file
+def stage_geo_json(context):
+    path = os.path.join(context['directory'], 'geo_reports.json')
+    context['coord'].get_coord_obj().to_json(path)
+    pd.read_json(path)
+
+
+def stage_geo_arrow(context):
+    path = os.path.join(context['directory'], 'geo_reports.arrow')
+    context['coord'].to_arrow(path)
+    list_buffers(read_arrow(path), 'longitude')
+
+
+def stage_search(context):
+    index = SearchIndex(os.path.join(context['directory'], 'index_{}'.format(time.perf_counter_ns())))
+    index.add(context['df'])
+    index.search('orange "three lights"', state='CA')
+
+
+def stage_dedup(context):
+    NearDuplicates().find(context['df'])
+
+
+# name: (function, required stages). The mongo stage mostly measures
+# mongomock, whose upserts scan the collection, so it only runs on demand.
+STAGES = {
+    'pages': (stage_pages, []),
+    'load': (stage_load, []),
+    'mongo': (stage_mongo, ['load']),
+    'aggregates': (stage_aggregates, ['load']),
+    'partitioned': (stage_partitioned, []),
+    'counties': (stage_counties, []),
+    'geo': (stage_geo, ['load', 'aggregates', 'counties']),
+    'timeserie': (stage_timeserie, ['load', 'aggregates']),
+    'geo_json': (stage_geo_json, ['geo']),
+    'geo_arrow': (stage_geo_arrow, ['geo']),
+    'cube': (stage_cube, ['load', 'counties']),
+    'search': (stage_search, ['load']),
+    'dedup': (stage_dedup, ['load'])}
+DEFAULT_STAGES = [name for name in STAGES if name != 'mongo']
+
+
+def run_suite(sizes, directory=None, stages=None, repeat=1, memory=True, processes=2, seed=0):
+    """
+    Generates a synthetic dataset of every size and measures the stages on it.
+    Returns {size: {stage: {'seconds': .., 'peak_mb': ..}}}, the sizes being
+    strings as in the JSON baselines. The stages required by the selected
+    ones run too. The mongo stage runs on mongomock and is skipped without it.
+    Args:
+        sizes: The numbers of reports
+        directory: Where the datasets are written, a temporary directory by default
+        stages: The names of the stages, DEFAULT_STAGES by default
+        repeat: The number of timed runs of each stage
+        memory: Measures the peak memory of each stage
+        processes: The number of processes of the partitioned stage
+        seed: The seed of the generators
+    """
+    selected = list(DEFAULT_STAGES if stages is None else stages)
+    unknown = [name for name in selected if name not in STAGES]
+    if (unknown):
+        raise ValueError('unknown stages {}'.format(unknown))
+    if (mongomock is None) and ('mongo' in selected):
+        print('mongomock is not installed, the mongo stage is skipped', file=sys.stderr)
+        selected.remove('mongo')
+    if (pyarrow is None) and ('geo_arrow' in selected):
+        print('pyarrow is not installed, the geo_arrow stage is skipped', file=sys.stderr)
+        selected.remove('geo_arrow')
+
+    needed = set()
+
+    def visit(name):
+        if (name not in needed):
+            needed.add(name)
+            for required in STAGES[name][1]:
+                visit(required)
+    for name in selected:
+        visit(name)
+
+    tmp_dir = tempfile.TemporaryDirectory() if directory is None else None
+    directory = tmp_dir.name if tmp_dir else directory
+    results = {}
+    try:
+        for size in sizes:
+            size_dir = os.path.join(directory, str(size))
+            os.makedirs(size_dir, exist_ok=True)
+            data_file, counties_file = write_dataset(size_dir, size, seed)
+            context = {'size': size, 'directory': size_dir, 'data_file': data_file, 'processes': processes,
+                       'counties_file': counties_file,
+                       'pages': [make_month_page(1000, seed + i) for i in range(5)]}
+            results[str(size)] = {}
+            for name in STAGES:
+                if (name in needed):
+                    results[str(size)][name] = measure(STAGES[name][0], context, repeat, memory)
+    finally:
+        if (tmp_dir):
+            tmp_dir.cleanup()
+    return results
+
+
+def compare(results, baseline, threshold=0.25):
+    """
+    Returns the list of the regressions of results against baseline: the
+    stages of the sizes of both whose time or peak memory grew by more than
+    threshold (0.25 is 25%)
+    Args:
+        results, baseline: Results of run_suite
+        threshold: The relative growth tolerated
+    """
+    regressions = []
+    for size, stages in results.items():
+        for name, result in stages.items():
+            reference = baseline.get(size, {}).get(name)
+            if (reference is None):
+                continue
+            for metric in ('seconds', 'peak_mb'):
+                if ((metric in result) and (metric in reference) and
+                        (result[metric] > reference[metric] * (1 + threshold))):
+                    regressions.append('{} records, {}: {} {:.3f} > {:.3f} (+{:.0%})'.format(
+                        size, name, metric, result[metric], reference[metric],
+                        result[metric] / reference[metric] - 1))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the scraper parsers and the pipeline stages')
+    parser.add_argument('pages', nargs='*', help='saved month pages, compares the scraper parsers on them')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000], help='numbers of synthetic reports')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), help='all but mongo by default')
+    parser.add_argument('--no-memory', action='store_true', help='skips the traced run of the stages')
+    parser.add_argument('--processes', type=int, default=2, help='processes of the partitioned stage')
+    parser.add_argument('--directory', help='where the datasets are written, temporary by default')
+    parser.add_argument('--save', help='writes the results as a JSON baseline')
+    parser.add_argument('--baseline', help='fails when a stage regresses against this JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='tolerated growth, 0.25 is 25%%')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.ERROR)
+
+    if (args.pages):
+        pages = {}
+        for path in args.pages:
+            with open(path, 'r', encoding='utf-8', errors='replace') as infile:
+                pages[path] = infile.read()
+        for name, timing in bench_parsers(pages, args.repeat).items():
+            print('{}: soup {:.4f}s fast {:.4f}s speedup x{:.1f}'.format(
+                name, timing['soup'], timing['fast'], timing['speedup']))
+        return 0
+
+    results = run_suite(args.sizes, args.directory, args.stages, args.repeat, not args.no_memory, args.processes)
+    for size, stages in results.items():
+        for name, result in stages.items():
+            print('{:>10} {:<12} {:9.3f}s {:>10}'.format(size, name, result['seconds'],
+                  '{:.1f}MB'.format(result['peak_mb']) if ('peak_mb' in result) else ''))
+
+    if (args.save):
+        with open(args.save, 'w') as outfile:
+            json.dump(results, outfile, indent=2, sort_keys=True)
+    if (args.baseline):
+        with open(args.baseline, 'r') as infile:
+            regressions = compare(results, json.load(infile), args.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
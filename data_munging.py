@@ -8,12 +8,31 @@ import json
 import pymongo
 import re
 import datetime
+import gzip
+import hashlib
 import pprint
+import sqlite3
 import unittest
+import argparse
+import pickle
+import time
 
 from pymongo import MongoClient
 from io import StringIO
-from pymongo.errors import BulkWriteError
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure
+from metrics import metrics
+from near_duplicates import NearDuplicates
+from search_index import SearchIndex
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
 
 
 def get_logger(name=None):
@@ -27,33 +46,356 @@ def get_logger(name=None):
     return log
 
 
+def iter_json_list(file, chunk_size=1 << 16):
+    """
+    Generator over the items of a JSON list read from file chunk by chunk, so
+    that the whole JSON text is never held in memory.
+    Args:
+        file: A text file object containing a JSON list
+        chunk_size: The number of characters read at a time
+    """
+    decoder = json.JSONDecoder()
+    buff = file.read(chunk_size).lstrip()
+    if (not buff.startswith('[')):
+        raise ValueError('The file does not contain a JSON list')
+
+    buff = buff[1:]
+    eof = False
+    while True:
+        buff = buff.lstrip().lstrip(',').lstrip()
+        if (buff.startswith(']')):
+            return
+
+        try:
+            item, end = decoder.raw_decode(buff)
+        except ValueError:
+            if (eof):
+                raise
+            chunk = file.read(chunk_size)
+            eof = not chunk
+            buff += chunk
+            continue
+
+        yield item
+        buff = buff[end:]
+
+
+def iter_records(path, stream=False):
+    """
+    Generator over the records of a file written by the scraper. JSON lines files
+    (.jsonl) are read lazily one line at a time, JSON files (.json) are parsed as a
+    whole unless stream is set. Both can be gzip compressed (.gz).
+    Args:
+        path: The path to the file
+        stream: Parses a .json file incrementally with iter_json_list
+    """
+    name = path[:-3] if path.endswith('.gz') else path
+    opener = gzip.open if path.endswith('.gz') else open
+
+    with opener(path, 'rt', encoding='utf-8') as file:
+        if (name.endswith('.jsonl')):
+            for line in file:
+                if (line.strip()):
+                    yield json.loads(line)
+        elif (stream):
+            for record in iter_json_list(file):
+                yield record
+        else:
+            for record in json.load(file):
+                yield record
+
+
+def file_hash(path, salt=''):
+    """
+    Returns the SHA-1 hex digest of the content of a file, prefixed with salt.
+    Used to name cache files so that any change of the source invalidates them.
+    Args:
+        path: The path to the file
+        salt: A string identifying the options the cache depends on
+    """
+    digest = hashlib.sha1(salt.encode('utf-8'))
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def remove_stale(cache_file):
+    """
+    Removes the cache files of the same source and type as cache_file, which
+    is named as <source>.<hash>.<extension>
+    Args:
+        cache_file: The cache file to be kept
+    """
+    cache_dir, name = os.path.split(cache_file)
+    source, digest, extension = name.rsplit('.', 2)
+    for other in os.listdir(cache_dir):
+        parts = other.rsplit('.', 2)
+        if ((other != name) and (len(parts) == 3) and (parts[0] == source) and (parts[2] == extension)):
+            os.remove(os.path.join(cache_dir, other))
+
+
+def frame_to_arrow(df, lists=None, dtype=np.float32):
+    """
+    Returns a pyarrow Table of the columns of df followed by list columns,
+    each list column holding one flat buffer of all the values and their
+    offsets, e.g. the coordinates of the counties.
+    Args:
+        df: The dataframe of the scalar columns
+        lists: A dict {name: list of numpy arrays}, one array per row of df
+        dtype: The type of the values of the list columns
+    """
+    if (pyarrow is None):
+        raise ImportError('pyarrow is required by the Arrow outputs')
+
+    table = pyarrow.Table.from_pandas(df, preserve_index=False)
+    for name, arrays in (lists or {}).items():
+        lengths = [len(values) for values in arrays]
+        offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int32)
+        values = np.concatenate(arrays).astype(dtype) if arrays else np.empty(0, dtype=dtype)
+        # NaN values (the separators of the rings) stay NaN, not null
+        table = table.append_column(name, pyarrow.ListArray.from_arrays(pyarrow.array(offsets),
+                                                                         pyarrow.array(values)))
+    return table
+
+
+def write_arrow(table, output_file, compression=None):
+    """
+    Writes a pyarrow Table into an Arrow IPC file. The uncompressed files are
+    read by read_arrow without copying their buffers.
+    Args:
+        table: The pyarrow Table, see frame_to_arrow
+        output_file: The file written
+        compression: None, 'lz4' or 'zstd'
+    """
+    if (pyarrow is None):
+        raise ImportError('pyarrow is required by the Arrow outputs')
+    if (compression not in (None, 'lz4', 'zstd')):
+        raise ValueError('compression should be None, lz4 or zstd')
+
+    options = pyarrow.ipc.IpcWriteOptions(compression=compression)
+    with pyarrow.OSFile(output_file + '.tmp', 'wb') as sink:
+        with pyarrow.ipc.new_file(sink, table.schema, options=options) as writer:
+            writer.write_table(table)
+    os.replace(output_file + '.tmp', output_file)
+
+
+def read_arrow(path, memory_map=True, columns=None):
+    """
+    Returns the pyarrow Table of an Arrow IPC file written by write_arrow.
+    Memory mapped, the buffers of an uncompressed file are views of the
+    mapping and only the pages used are read; compressed buffers are
+    decompressed in memory. table.to_pandas() gives a dataframe.
+    Args:
+        path: The Arrow file
+        memory_map: Maps the file instead of reading it
+        columns: The names of the columns read, all by default
+    """
+    if (pyarrow is None):
+        raise ImportError('pyarrow is required by the Arrow outputs')
+
+    source = pyarrow.memory_map(path, 'r') if memory_map else pyarrow.OSFile(path, 'rb')
+    table = pyarrow.ipc.open_file(source).read_all()
+    return table.select(columns) if (columns is not None) else table
+
+
+def list_buffers(table, column):
+    """
+    Returns the (values, offsets) numpy arrays of a list column of a table
+    read by read_arrow, the values of the row i being
+    values[offsets[i]:offsets[i + 1]]. When the column has a single chunk
+    (as written by write_arrow) they are views of its buffers, hence of the
+    mapped file, otherwise the chunks are concatenated.
+    """
+    chunks = table.column(column)
+    array = chunks.chunk(0) if (chunks.num_chunks == 1) else chunks.combine_chunks()
+    offsets = array.offsets.to_numpy(zero_copy_only=True)
+    values = array.values.to_numpy(zero_copy_only=True)
+    return (values, offsets)
+
+
+def parse_dates(values, formats):
+    """
+    Vectorized parsing of date strings with explicit formats. Every distinct
+    string is parsed once, the formats being tried in order on the values not
+    parsed yet. Values which already are dates (e.g. read from MongoDB among
+    strings) are kept as they are. Returns the parsed values and the number
+    of malformed ones (non empty strings matching none of the formats), which
+    become NaT.
+    Args:
+        values: A pandas Series of strings or dates
+        formats: The list of strftime formats accepted
+    """
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Series(uniques, dtype=object)
+    is_date = uniques.map(lambda value: isinstance(value, (datetime.datetime, np.datetime64))).astype(bool)
+    parsed = pd.Series(pd.NaT, index=uniques.index, dtype='datetime64[ns]')
+    if (is_date.any()):
+        parsed[is_date] = pd.to_datetime(uniques[is_date])
+    uniques = uniques.astype(str)
+
+    for fmt in formats:
+        missing = parsed.isna() & ~is_date
+        if (not missing.any()):
+            break
+        parsed[missing] = pd.to_datetime(uniques[missing], format=fmt, errors='coerce')
+
+    bad = (parsed.isna() & ~is_date & (uniques.str.strip() != '')).values
+    malformed = int(bad[codes[codes >= 0]].sum())
+
+    # the code -1 of the missing values picks the NaT appended at the end
+    result = np.append(parsed.values, np.datetime64('NaT'))[codes]
+    return (pd.Series(result, index=values.index, name=values.name), malformed)
+
+
+def parse_durations(values):
+    """
+    Vectorized conversion of the free text durations ("1 hour", "5-10 min",
+    "about 30 seconds") into seconds. A range gives its mid point. Returns the
+    durations and the number of non empty values which cannot be read, which
+    become NaN.
+    Args:
+        values: A pandas Series of strings
+    """
+    codes, uniques = pd.factorize(values)
+    text = pd.Series(uniques, dtype=object).astype(str).str.lower()
+    text = text.str.replace(r'\b(an?|one)\b', '1', regex=True)
+    for number, word in enumerate(['two', 'three', 'four', 'five', 'six', 'seven',
+                                   'eight', 'nine', 'ten'], 2):
+        text = text.str.replace(r'\b' + word + r'\b', str(number), regex=True)
+
+    parts = text.str.extract(r'(?<![\d/.])(\d+(?:\.\d+)?)\s*(?:(?:-|to)\s*(\d+(?:\.\d+)?))?\s*'
+                             r'(seconds?|secs?|s|minutes?|mins?|m|hours?|hrs?|h|days?|d)\b')
+    low = pd.to_numeric(parts[0])
+    high = pd.to_numeric(parts[1]).fillna(low)
+    unit = parts[2].str[0].map({'s': 1, 'm': 60, 'h': 3600, 'd': 86400})
+    seconds = ((low + high) / 2 * unit).values
+
+    bad = (np.isnan(seconds) & (text.str.strip() != '')).values
+    malformed = int(bad[codes[codes >= 0]].sum())
+
+    result = np.append(seconds, np.nan)[codes]
+    return (pd.Series(result, index=values.index, name=values.name), malformed)
+
+
 class JsonData:
     """This object allows to create and handle JSON data by reading a .json file.
     The format it can handle has the following form {index: {key1: value1},{key2:
-    value2}}
+    value2}}. JSON lines files (.jsonl, .jsonl.gz) are read lazily. The frame is
+    built in one pass, with the columns in alphabetical order and a default index.
     Args:
         path: The path to the JSON file
+        id_column: If given, the report IDs are kept in a column with this name
+        stream: Parses a .json file incrementally instead of loading its text
+        typed: Converts the columns with set_types
+        cache_dir: Directory of a Parquet copy of the frame, reused as long as the
+        content of path does not change
     """
 
-    def __init__(self, path):
+    categories = ['City', 'State', 'Shape']
+    dates = {'Date / Time': ['%m/%d/%y %H:%M', '%m/%d/%y'], 'Posted': ['%m/%d/%y']}
+    seconds = 'Seconds'
+
+    @metrics.timed('JsonData.load')
+    def __init__(self, path, id_column=None, stream=False, typed=False, cache_dir=None):
         self.log = logging.getLogger(self.__class__.__name__)
         self._df = pd.DataFrame()
+        self._id_column = id_column
+        self.malformed = {}
 
-        if ((not os.path.isfile(path)) or (type(path) != str)):
+        if ((type(path) != str) or (not os.path.isfile(path))):
             raise TypeError('arg should be a valid path/file')
 
+        cache_file = None
+        if (cache_dir):
+            cache_file = self.cache_path(path, cache_dir, id_column, typed)
+            if (os.path.isfile(cache_file)):
+                self._df = pd.read_parquet(cache_file)
+                self.log.info('DataFrame loaded from cache %s', cache_file)
+                return
+
+        ids = []
+        rows = []
         try:
             file_name = os.path.basename(path)
-            with open(path, 'r') as file:
-                content = file.read()
-            data = json.loads(content)
+            for record in iter_records(path, stream):
+                for report_id, fields in record.items():
+                    ids.append(report_id)
+                    rows.append(fields)
         except (OSError, FileNotFoundError):
             self.log.exception('Cannot read from ' +
                                os.getcwd() + os.sep + file_name)
 
-        for record in data:
-            tmp = pd.DataFrame(record).T
-            self._df = self._df.append(tmp, ignore_index=True)
+        if (rows):
+            self._df = pd.DataFrame.from_records(rows)
+            self._df = self._df.reindex(sorted(self._df.columns), axis=1)
+            if (id_column):
+                self._df.insert(0, id_column, ids)
+
+        if (typed):
+            self.set_types()
+        if (cache_file):
+            self.to_cache(cache_file)
+
+    @staticmethod
+    def cache_path(path, cache_dir, id_column=None, typed=False):
+        """
+        Returns the cache file of a JSON file. Its name contains a hash of the
+        content of the file and of the options, so that any change invalidates it.
+        Args:
+            path: The path to the JSON file
+            cache_dir: The directory of the cache files
+            id_column, typed: The options of the constructor
+        """
+        digest = file_hash(path, '{}|{}'.format(id_column, typed))
+        return os.path.join(cache_dir, '{}.{}.parquet'.format(os.path.basename(path), digest[:16]))
+
+    def to_cache(self, cache_file):
+        """
+        Writes the dataframe into a Parquet file and removes the stale cache
+        files of the same source. Requires pyarrow or fastparquet, without
+        them the cache is skipped.
+        Args:
+            cache_file: The path returned by cache_path
+        """
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            self._df.to_parquet(cache_file + '.tmp', index=False)
+            os.replace(cache_file + '.tmp', cache_file)
+        except ImportError:
+            self.log.warning('No Parquet engine available, the cache is not written')
+            return
+        except OSError:
+            self.log.error('Cannot write in ' + cache_file)
+            return
+
+        remove_stale(cache_file)
+
+    @metrics.timed()
+    def set_types(self):
+        """
+        Method for converting the columns into compact types: city, state
+        and shape become categoricals, date/time and posted timestamps and
+        the duration is converted into seconds in a new column. The dates
+        are parsed with the formats used by the website. The number of
+        values which cannot be parsed is logged and kept in self.malformed.
+        """
+        for column in self.categories:
+            if (column in self._df.columns):
+                self._df[column] = self._df[column].astype('category')
+
+        self.malformed = {}
+        for column, formats in self.dates.items():
+            if ((column in self._df.columns) and
+                    (not pd.api.types.is_datetime64_any_dtype(self._df[column]))):
+                self._df[column], self.malformed[column] = parse_dates(self._df[column], formats)
+
+        if ('Duration' in self._df.columns):
+            self._df[self.seconds], self.malformed['Duration'] = parse_durations(self._df['Duration'])
+
+        for column, count in self.malformed.items():
+            if (count):
+                self.log.warning('%s malformed values in column %s', count, column)
 
     def drop_columns(self, columns):
         """
@@ -82,21 +424,23 @@ class JsonData:
         """
 
         try:
-            self._df.to_json(output_file, orient='records')
+            self._df.to_json(output_file, orient='records', date_format='iso')
         except OSError as ose:
             self.log.error('Cannot write in this file')
 
-    def to_database(self, db):
+    @metrics.timed()
+    def to_database(self, db, chunk_size=1000):
         """
         Method for writing a cleanand flat output to a
         Mongo database.
         Example: [{name1: value1},{name2: value2}]
+        The records are written in chunks by DataBase.save_from_frame, whose
+        counts are returned: upserted on the ID when the report IDs are kept
+        (id_column), otherwise inserted into an empty collection.
         Args: The database name where to save the data
+            chunk_size: The number of records sent at a time
         """
-
-        clean_data_json = StringIO()
-        self._df.to_json(clean_data_json, orient='records')
-        db.save_from_json(clean_data_json)
+        return db.save_from_frame(self._df, self._id_column, chunk_size)
 
     def get_dataframe(self):
         """
@@ -112,12 +456,15 @@ class DataBase:
     Args:
         config: A python dict data structure containing: host, port,
         database name and collection name
+        client: An already connected client (e.g. mongomock), host and port
+        are then ignored
     """
 
-    def __init__(self, config):
+    def __init__(self, config, client=None):
         self.log = logging.getLogger(self.__class__.__name__)
         try:
-            client = MongoClient(config['host'], config['port'])
+            if (client is None):
+                client = MongoClient(config['host'], config['port'])
             self._db = client[config['db']]
             self._collection = self._db[config['collection']]
         except ConnectionFailure:
@@ -131,21 +478,197 @@ class DataBase:
         stream into the database
         Args:
             streamObj: The json data structure as stream object (StringIO)
+        The records are inserted in chunks by save_from_frame, only into an
+        empty collection.
         """
+        return self.save_from_frame(pd.DataFrame(json.loads(streamObj.getvalue())), None)
+
+    @metrics.timed()
+    def save_from_frame(self, df, key, chunk_size=1000, raise_errors=False):
+        """
+        Public method which writes a DataFrame into the database without any
+        intermediate JSON. The records are sent in chunks of chunk_size as
+        unordered bulk upserts keyed on the column key, so that loading the
+        same data again changes nothing. Without key the records can't be
+        matched, they are only inserted into an empty collection. Returns the
+        number of documents inserted, updated and unchanged.
+        Args:
+            df: The DataFrame to be written
+            key: The column holding the unique ID of the records, or None
+            chunk_size: The number of records sent at a time
+            raise_errors: Raises the write errors after logging them, e.g. so
+            that a failed load isn't cached as a successful one
+        """
+        if ((type(df) != pd.DataFrame) or ((key is not None) and (key not in df.columns))):
+            raise ValueError('Function signature is (DataFrame, key column)')
+
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
         try:
-            result = self._collection.count()
-            if (result == 0):
-                result = self._collection.insert_many(
-                    json.loads(streamObj.getvalue()))
-                self.log.info("DB populated with: %s documents",
-                              len(result.inserted_ids))
+            if (key is None):
+                if (self._collection.count_documents({}, limit=1)):
+                    self.log.info('The collection already contains data. Nothing inserted')
+                    return counts
             else:
-                self.log.info(
-                    'The collection already contains data. Nothing inserted')
+                self._collection.create_index(key, unique=True)
+            for start in range(0, len(df), chunk_size):
+                chunk = df.iloc[start:start + chunk_size].astype(object)
+                chunk = chunk.where(chunk.notna(), None)
+                if (key is None):
+                    result = self._collection.insert_many(chunk.to_dict('records'), ordered=False)
+                    counts['inserted'] += len(result.inserted_ids)
+                    continue
+                operations = [UpdateOne({key: record[key]}, {'$set': record}, upsert=True)
+                              for record in chunk.to_dict('records')]
+                result = self._collection.bulk_write(operations, ordered=False)
+                counts['inserted'] += result.upserted_count
+                counts['updated'] += result.modified_count
+                counts['unchanged'] += result.matched_count - result.modified_count
         except (BulkWriteError, PyMongoError):
             self.log.error('Error writing to the DB')
+            if (raise_errors):
+                raise
+
+        self.log.info('DB updated: %(inserted)s inserted, %(updated)s updated, '
+                      '%(unchanged)s unchanged', counts)
+        return counts
+
+    def ensure_indexes(self):
+        """
+        Creates the indexes on state and datetime used by the aggregations.
+        Creating an index which already exists is a no-op for MongoDB.
+        """
+        try:
+            self._collection.create_index('state')
+            self._collection.create_index('datetime')
+        except PyMongoError:
+            self.log.error('Error creating the indexes')
+
+    @metrics.timed()
+    def count_by_place(self, match=None, new_col='reports'):
+        """
+        Counts the documents per (city, state) on the server with an
+        aggregation pipeline. Only the counts are transferred.
+        Args:
+            match: A query filter applied before counting
+            new_col: The name of the column of the counts
+            return: A DataFrame with the columns city, state and new_col
+        """
+        return self._count({'city': '$city', 'state': '$state'}, [match or {}], new_col)
+
+    @metrics.timed()
+    def count_by_day(self, match=None, new_col='reports'):
+        """
+        Counts the documents per (day, state) on the server with an
+        aggregation pipeline. Documents without a valid date are ignored.
+        Args:
+            match: A query filter applied before counting
+            new_col: The name of the column of the counts
+            return: A DataFrame with the columns datetime (the day), state and
+            new_col
+        """
+        day = {'$dateToString': {'format': '%Y-%m-%d', 'date': '$datetime'}}
+        result = self._count({'datetime': day, 'state': '$state'},
+                             [match or {}, {'datetime': {'$type': 'date'}}], new_col)
+        result['datetime'] = pd.to_datetime(result['datetime'], format='%Y-%m-%d')
         return result
 
+    def _count(self, group, matches, new_col):
+        """
+        Private method running a $match/$group pipeline and returning the
+        groups with their number of documents as a DataFrame
+        """
+        self.ensure_indexes()
+        pipeline = [{'$match': match} for match in matches]
+        pipeline.append({'$group': {'_id': group, new_col: {'$sum': 1}}})
+
+        rows = []
+        try:
+            for doc in self._collection.aggregate(pipeline, allowDiskUse=True):
+                row = doc['_id']
+                row[new_col] = doc[new_col]
+                rows.append(row)
+        except PyMongoError:
+            self.log.error('Error performing the operation')
+
+        return pd.DataFrame(rows, columns=list(group) + [new_col])
+
+    def read_frames(self, query=None, projection=None, batch_size=10000,
+                    dates=('datetime',), categories=()):
+        """
+        Generator reading the result of a query as DataFrames of at most
+        batch_size rows. The documents are copied into columns as they come
+        from the cursor, so that they are never all held as dicts. The _id
+        field is dropped, dates are parsed and categorical columns converted
+        chunk by chunk.
+        Args:
+            query: The query filter
+            projection: The fields to be retrieved, all of them by default
+            batch_size: The number of documents per DataFrame and per round
+            trip to the server
+            dates: The columns holding dates
+            categories: The columns converted into categoricals
+        """
+        projection = dict(projection or {}, _id=0)
+        columns = {}
+        count = 0
+
+        try:
+            for doc in self._collection.find(query or {}, projection, batch_size=batch_size):
+                for key in doc:
+                    if (key not in columns):
+                        columns[key] = [None] * count
+                for key, values in columns.items():
+                    values.append(doc.get(key))
+                count += 1
+
+                if (count == batch_size):
+                    yield self._to_frame(columns, dates, categories)
+                    columns = {key: [] for key in columns}
+                    count = 0
+        except PyMongoError:
+            self.log.error('Error performing the operation')
+
+        if (count):
+            yield self._to_frame(columns, dates, categories)
+
+    @metrics.timed()
+    def read_frame(self, query=None, projection=None, batch_size=10000,
+                   dates=('datetime',), categories=()):
+        """
+        Reads the result of a query into a single DataFrame, concatenating the
+        chunks of read_frames. The categoricals of the chunks are merged.
+        Args: the same as read_frames
+        """
+        frames = list(self.read_frames(query, projection, batch_size, dates, categories))
+        if (not frames):
+            return pd.DataFrame()
+
+        for column in categories:
+            present = [frame for frame in frames if column in frame.columns]
+            if (present):
+                union = pd.api.types.union_categoricals([frame[column] for frame in present])
+                for frame in present:
+                    frame[column] = frame[column].cat.set_categories(union.categories)
+
+        df = pd.concat(frames, ignore_index=True)
+        del frames
+        return df
+
+    def _to_frame(self, columns, dates, categories):
+        """
+        Private method converting the columns of a chunk into a typed DataFrame
+        """
+        df = pd.DataFrame(columns)
+        for column in dates:
+            if ((column in df.columns) and (not pd.api.types.is_datetime64_any_dtype(df[column]))):
+                df[column], malformed = parse_dates(df[column], ['%Y-%m-%dT%H:%M:%S.%f', '%m/%d/%y %H:%M'])
+                if (malformed):
+                    self.log.warning('%s malformed values in column %s', malformed, column)
+        for column in categories:
+            if (column in df.columns):
+                df[column] = df[column].astype('category')
+        return df
+
     def get_connection(self):
         """
         Returns a reference to this object
@@ -157,12 +680,16 @@ class Coordinates:
     """
     Class object meant to contain information about US counties coordinates
     provided with a csv file. The main property of this class is a pandas
-    dataframe object (uscnts).
+    dataframe object (uscnts). The polygons are parsed once into NumPy arrays
+    (see parse_geometry), optionally kept in a cache next to the CSV data.
     Args:
         data_file: A cvs file with US counties coordinates as Polygons.
+        cache_dir: Directory of a .npz copy of the parsed polygons, reused as
+        long as the content of data_file does not change
     """
 
-    def __init__(self, data_file):
+    @metrics.timed('Coordinates.load')
+    def __init__(self, data_file, cache_dir=None):
         self.log = logging.getLogger(self.__class__.__name__)
         if ((data_file == '') or (not data_file)):
             raise TypeError('Constructor needs a valid CSV file')
@@ -170,6 +697,7 @@ class Coordinates:
         try:
             self._uscnts = pd.read_csv(data_file)
             self._tmp = None
+            self._tmp_counties = None
         except (OSError, FileNotFoundError, NameError):
             raise ValueError('Cannot read from ' + os.getcwd() + os.sep + data_file)
 
@@ -177,24 +705,304 @@ class Coordinates:
                            'FIPS formula', 'Has error', 'STATE num', 'COUNTY num'],
                           axis=1, inplace=True)
         self._uscnts.columns = ['city', 'state', 'geometry', 'gName']
+        self._geometry = self.load_geometry(data_file, cache_dir)
+        self.build_index()
+
+    def load_geometry(self, data_file, cache_dir=None):
+        """
+        Returns the parsed polygons of the counties, from the cache when it is
+        up to date, otherwise by parsing the geometry column.
+        Args:
+            data_file: The CSV file of the counties
+            cache_dir: The directory of the cache files, None disables the cache
+        """
+        cache_file = None
+        if (cache_dir):
+            cache_file = os.path.join(cache_dir, '{}.{}.npz'.format(
+                os.path.basename(data_file), file_hash(data_file)[:16]))
+            if (os.path.isfile(cache_file)):
+                with np.load(cache_file) as cached:
+                    return {key: cached[key] for key in cached.files}
+
+        geometry = self.parse_geometry(self._uscnts['geometry'])
+        if (cache_file):
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(cache_file + '.tmp', 'wb') as outfile:
+                    np.savez(outfile, **geometry)
+                os.replace(cache_file + '.tmp', cache_file)
+                remove_stale(cache_file)
+            except OSError:
+                self.log.error('Cannot write in ' + cache_file)
+        return geometry
+
+    @staticmethod
+    def parse_geometry(geometry):
+        """
+        Parses the KML polygons of all the counties at once. Originally the
+        coordinates are provided as <coordinates>lon,lat lon,lat ..</coordinates>
+        blocks, one per ring. They are turned into contiguous arrays:
+            coords: float64 array (points x 2) of longitude and latitude
+            ring_offsets: start of each ring in coords, plus the end
+            county_rings: start of the rings of each county, plus the end
+        Values which are not numbers become NaN.
+        Args:
+            geometry: The Series of the KML strings, one per county
+        """
+        geometry = geometry.fillna('').astype(str)
+        rings = re.findall(r'<coordinates>\s*(.*?)\s*</coordinates>', '\n'.join(geometry), re.S)
+        ring_counts = geometry.str.count('<coordinates>').values
+        points = pd.Series(rings, dtype=object).str.split()
+        ring_lengths = points.str.len().fillna(0).astype(np.int64).values
+
+        tokens = [point for ring in points for point in ring]
+        values = pd.Series(tokens, dtype=object).str.split(',', n=2, expand=True)
+        coords = np.empty((len(tokens), 2))
+        if (len(tokens)):
+            coords[:, 0] = pd.to_numeric(values[0], errors='coerce')
+            coords[:, 1] = pd.to_numeric(values[1], errors='coerce') if (1 in values) else np.nan
+
+        return {'coords': coords,
+                'ring_offsets': np.concatenate(([0], np.cumsum(ring_lengths))).astype(np.int64),
+                'county_rings': np.concatenate(([0], np.cumsum(ring_counts))).astype(np.int64)}
+
+    def county_coordinates(self, county, geometry=None):
+        """
+        Returns the (longitude, latitude) arrays of a county, the rings of a
+        multi polygon being separated by NaN.
+        Args:
+            county: The position of the county in the CSV file
+            geometry: The polygons to read from, the parsed ones by default
+        """
+        geometry = self._geometry if (geometry is None) else geometry
+        rings = geometry['county_rings']
+        offsets = geometry['ring_offsets'][rings[county]:rings[county + 1] + 1]
+        coords = geometry['coords']
+        if (len(offsets) < 2):
+            return (np.empty(0), np.empty(0))
+
+        parts = []
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            if (parts):
+                parts.append(np.full((1, 2), np.nan))
+            parts.append(coords[start:end])
+        county_coords = np.concatenate(parts)
+        return (county_coords[:, 0], county_coords[:, 1])
+
+    @staticmethod
+    def simplify(coords, ring_offsets, tolerance):
+        """
+        Douglas-Peucker simplification of all the rings at once. Instead of
+        recursing ring by ring, every iteration measures the points of all
+        the pending segments with NumPy and splits the segments whose
+        farthest point is more than tolerance away from the chord. Returns
+        the boolean mask of the points kept; the ends of the rings are
+        always kept.
+        Args:
+            coords: float array (points x 2)
+            ring_offsets: start of each ring in coords, plus the end
+            tolerance: The maximal distance of a removed point to the result
+        """
+        keep = np.zeros(len(coords), dtype=bool)
+        lengths = np.diff(ring_offsets)
+        starts = ring_offsets[:-1][lengths > 0]
+        ends = ring_offsets[1:][lengths > 0] - 1
+        keep[starts] = True
+        keep[ends] = True
+
+        while (len(starts)):
+            inner = ends - starts - 1
+            pending = inner > 0
+            starts, ends, inner = starts[pending], ends[pending], inner[pending]
+            if (not len(starts)):
+                break
+
+            segment = np.repeat(np.arange(len(starts)), inner)
+            first = np.repeat(np.cumsum(inner) - inner, inner)
+            points = np.repeat(starts + 1, inner) + np.arange(len(segment)) - first
+
+            a = coords[starts][segment]
+            b = coords[ends][segment]
+            chord = b - a
+            norm = np.hypot(chord[:, 0], chord[:, 1])
+            delta = coords[points] - a
+            cross = np.abs(chord[:, 0] * delta[:, 1] - chord[:, 1] * delta[:, 0])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                distance = np.where(norm > 0, cross / norm, np.hypot(delta[:, 0], delta[:, 1]))
+            distance = np.nan_to_num(distance, nan=np.inf)
+
+            # the first point of each segment in decreasing order of distance
+            order = np.lexsort((-distance, segment))
+            farthest = order[np.cumsum(inner) - inner]
+            split = distance[farthest] > tolerance
+            middle = points[farthest][split]
+            keep[middle] = True
+
+            starts, ends = (np.concatenate((starts[split], middle)),
+                            np.concatenate((middle, ends[split])))
+
+        return keep
+
+    @metrics.timed()
+    def simplify_geometry(self, tolerance, decimals=None):
+        """
+        Returns a simplified copy of the polygons. The coordinates are first
+        quantized to decimals digits (repeated points being removed), then
+        simplified with the given tolerance in degrees. Rings reduced to less
+        than 4 points are dropped, unless a county would lose all of them, in
+        which case its first ring is kept untouched.
+        Args:
+            tolerance: The tolerance of simplify, 0 only removes aligned points
+            decimals: The number of decimals kept, None for no quantization
+        """
+        coords = self._geometry['coords']
+        ring_offsets = self._geometry['ring_offsets']
+        county_rings = self._geometry['county_rings']
+        ring_lengths = np.diff(ring_offsets)
+        point_ring = np.repeat(np.arange(len(ring_lengths)), ring_lengths)
+        ring_county = np.repeat(np.arange(len(county_rings) - 1), np.diff(county_rings))
+
+        keep = np.ones(len(coords), dtype=bool)
+        if (decimals is not None):
+            coords = np.round(coords, decimals)
+            repeated = np.zeros(len(coords), dtype=bool)
+            repeated[1:] = (coords[1:] == coords[:-1]).all(axis=1)
+            repeated[ring_offsets[:-1][ring_lengths > 0]] = False
+            keep &= ~repeated
+
+        # the simplification works on the points left by the quantization
+        kept = np.flatnonzero(keep)
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(point_ring[kept], minlength=len(ring_lengths)))))
+        keep[kept] = self.simplify(coords[kept], offsets, tolerance)
+
+        counts = np.bincount(point_ring[keep], minlength=len(ring_lengths))
+        ring_ok = counts >= 4
+        county_ok = np.bincount(ring_county, weights=ring_ok, minlength=len(county_rings) - 1) > 0
+        lost = np.flatnonzero(~county_ok & (np.diff(county_rings) > 0))
+        for county in lost:
+            ring = county_rings[county]
+            keep[ring_offsets[ring]:ring_offsets[ring + 1]] = True
+            ring_ok[ring] = True
+
+        keep &= ring_ok[point_ring]
+        counts = np.bincount(point_ring[keep], minlength=len(ring_lengths))[ring_ok]
+        rings = np.bincount(ring_county[ring_ok], minlength=len(county_rings) - 1)
+        return {'coords': coords[keep],
+                'ring_offsets': np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+                'county_rings': np.concatenate(([0], np.cumsum(rings))).astype(np.int64)}
+
+    @metrics.timed()
+    def to_json_levels(self, output_file, levels, by_state=False):
+        """
+        Writes the result of combine_with once per level of detail, each level
+        in its own file named after output_file, e.g. geo_reports.national.json.
+        Args:
+            output_file: The name of the full resolution file
+            levels: A dict {name: (tolerance, decimals)} (see simplify_geometry)
+            by_state: Also splits every level into one file per state, so that
+            the detailed geometry can be fetched for the visible states only
+            return: The list of the files written
+        """
+        if (self._tmp is None):
+            raise ValueError('combine_with should be called first')
+
+        stem, extension = os.path.splitext(output_file)
+        written = []
+        for name, (tolerance, decimals) in levels.items():
+            geometry = self.simplify_geometry(tolerance, decimals)
+            coordinates = [self.county_coordinates(i, geometry) for i in self._tmp_counties]
+            level = self._tmp.drop(['longitude', 'latitude'], axis=1)
+            level['longitude'] = [lon.tolist() for lon, lat in coordinates]
+            level['latitude'] = [lat.tolist() for lon, lat in coordinates]
+
+            parts = [('{}.{}{}'.format(stem, name, extension), level)]
+            if (by_state):
+                parts += [('{}.{}.{}{}'.format(stem, name, state, extension), rows.reset_index(drop=True))
+                          for state, rows in level.groupby('state')]
+            for path, frame in parts:
+                frame.to_json(path)
+                written.append(path)
+            self.log.info('Level %s written with %s points', name, len(geometry['coords']))
+
+        return written
+
+    @metrics.timed()
+    def to_arrow(self, output_file, compression=None, geometry=None):
+        """
+        Writes the result of combine_with into an Arrow IPC file (see
+        write_arrow), the longitude and latitude being list<float32> columns
+        instead of the lists of numbers spelled out in the JSON file.
+        Args:
+            output_file: The Arrow file written
+            compression: None, 'lz4' or 'zstd'
+            geometry: The polygons written, e.g. a level of detail returned by
+            simplify_geometry, the parsed ones by default
+        """
+        if (self._tmp is None):
+            raise ValueError('combine_with should be called first')
+
+        coordinates = [self.county_coordinates(i, geometry) for i in self._tmp_counties]
+        table = frame_to_arrow(self._tmp.drop(['longitude', 'latitude'], axis=1),
+                               {'longitude': [lon for lon, lat in coordinates],
+                                'latitude': [lat for lon, lat in coordinates]})
+        write_arrow(table, output_file, compression)
+
+    @staticmethod
+    def normalize(city, state):
+        """
+        Returns the normalized (city, state) keys of two Series as a MultiIndex:
+        surrounding spaces are removed, cities are lower case and states upper case.
+        """
+        city = city.astype(object).fillna('').astype(str).str.strip().str.lower()
+        state = state.astype(object).fillna('').astype(str).str.strip().str.upper()
+        return pd.MultiIndex.from_arrays([city.values, state.values])
+
+    def build_index(self):
+        """
+        Builds once the index joining (city, state) to the counties. The
+        distinct normalized keys are numbered and every county gets the number
+        of its key. Counties without city, state or geometry are left out.
+        """
+        counties = self._uscnts
+        valid = (counties['city'].notna() & counties['state'].notna() &
+                 (counties['state'] != '') & counties['geometry'].notna())
+        self._counties = counties.loc[valid, ['city', 'state']].copy()
+        self._counties['county'] = np.flatnonzero(valid.values)
+
+        codes, self._keys = pd.factorize(self.normalize(self._counties['city'], self._counties['state']))
+        self._counties['key'] = codes
+
+    def get_counties(self):
+        """
+        Returns the counties of the index: their city, state, position in the
+        CSV file (county) and key number (key)
+        """
+        return self._counties.copy()
+
+    def lookup(self, other_df):
+        """
+        Returns the key numbers of the (city, state) of each row of other_df,
+        -1 for the places which are not a county.
+        Args:
+            other_df: A dataframe with the fields city and state
+        """
+        return self._keys.get_indexer(self.normalize(other_df['city'], other_df['state']))
 
     def arrange_coord(self):
         """
         Private method for munging the coordinates provided in the file. It sets each
-        cell into a more suitable datatype
-        """
-        self._tmp['longitude'] = self._tmp[['geometry']].apply(
-            lambda r: self.get_coordinates(r, 0), axis=1)
-        self._tmp['latitude'] = self._tmp[['geometry']].apply(
-            lambda r: self.get_coordinates(r, 1), axis=1)
-        self._tmp.drop(['geometry'], axis=1, inplace=True)
-        self._tmp['longitude'] = self._tmp['longitude'].apply(
-            lambda r: pd.to_numeric(r, errors='coerce'))
-        self._tmp['latitude'] = self._tmp['latitude'].apply(
-            lambda r: pd.to_numeric(r, errors='coerce'))
+        cell into a more suitable datatype, reading the polygons already parsed.
+        """
+        coordinates = [self.county_coordinates(i) for i in self._tmp['county']]
+
+        self._tmp['longitude'] = [lon.tolist() for lon, lat in coordinates]
+        self._tmp['latitude'] = [lat.tolist() for lon, lat in coordinates]
+        self._tmp_counties = self._tmp['county'].values
+        self._tmp.drop(['county'], axis=1, inplace=True)
         # self.log.info('Coordinates created as %s', pprint.pformat(self._tmp.head()))
 
-    def combine_with(self, other_df, new_col, function):
+    @metrics.timed()
+    def combine_with(self, other_df, new_col, function, by=None):
         """
         Public method with allows to combine a given dataframe which contains
         fields such as city and state to the coordinates dataframe. The match is
@@ -203,38 +1011,53 @@ class Coordinates:
             other_df: An external dataframe to merge the data with
             new_col: The name of the new column introduced by the aggregate function
             function: The name of the aggregate function to group by.
+            by: Optional list of other columns of other_df to group by (e.g.
+            shape), each county then has a row per value
             return: A new dataframe integrating the geo coordinates and applying
             the aggregate function.
+        When other_df already contains new_col (e.g. the counts returned by
+        DataBase.count_by_place) the function is applied to that column, so
+        'sum' combines pre-aggregated counts. Otherwise only 'size' is allowed,
+        counting the rows.
+        The rows are matched through the index of build_index and grouped on
+        the county numbers, the coordinates being attached at the end. The
+        counties are left untouched, so the same object can be combined with
+        many dataframes. As with a right merge, a county without any row gets
+        the function applied to a single missing value (1 for 'size', 0 for
+        'sum'), or no row at all when grouping by other columns.
         """
         if ((type(other_df) != pandas.core.frame.DataFrame) or (type(new_col) != str) or (type(function) != str)):
             raise ValueError(
                 'Function signature is (DataFrame, string, string')
 
-        self._uscnts = pd.merge(other_df, self._uscnts, how='right',
-                                sort=True, on=['city', 'state'])
-        self._uscnts['state'].replace('', np.nan, inplace=True)
-        self._tmp = self._uscnts.groupby(['city', 'state', 'geometry']).agg(
-            function).reset_index(name=new_col)
-        self.arrange_coord()
-
-    def get_coordinates(self, current, pos):
-        """
-        Private method for re-arranging the coordinates in a suitable form.
-        Originally cooordinates are provided as [{longitute,latitude}]. They are
-        turned into the form longitude=[x,y,..] and latitude=[x,y,..]
-        Args:
-            current = current row in the dataframe
-            pos = the indexed data
-        """
+        by = list(by or [])
+        keys = self.lookup(other_df)
+        if (new_col in other_df.columns):
+            values = other_df[new_col]
+        elif (function == 'size'):
+            values = pd.Series(1, index=other_df.index)
+        else:
+            raise ValueError('Column ' + new_col + ' is missing, only size counts the rows')
+        grouped = values.groupby([keys] + [other_df[column] for column in by], observed=True).agg(function)
+        grouped.index.names = ['key'] + by
 
-        current = re.sub('<.*?>', '', current[0])
-        coordinates = current.split(' ')
-        result = list()
+        if (by):
+            grouped = grouped.reset_index(name=new_col)
+            grouped = grouped[grouped['key'] >= 0]
+            self._tmp = pd.merge(self._counties, grouped, on='key')
+        else:
+            self._tmp = self._counties.copy()
+            result = grouped.reindex(self._tmp['key'].values)
+            if (result.isna().any()):
+                empty = pd.Series([np.nan]).agg(function)
+                result = result.fillna(empty)
+                if (pd.api.types.is_integer_dtype(grouped.dtype) and float(empty).is_integer()):
+                    result = result.astype(grouped.dtype)
+            self._tmp[new_col] = result.values
 
-        for coord in coordinates:
-            temp = coord.split(',')
-            result.append(temp[pos])
-        return result
+        self._tmp = self._tmp.sort_values(['city', 'state', 'county'] + by, kind='stable')
+        self._tmp = self._tmp.drop(['key'], axis=1).reset_index(drop=True)
+        self.arrange_coord()
 
     def get_coord_obj(self):
         """
@@ -252,6 +1075,12 @@ class TimeSerie:
         end: The final date
     """
 
+    # numpy unit of the buckets, pandas frequency of their range and output format
+    frequencies = {'hour': ('datetime64[h]', 'h', '%Y-%m-%d %H:00'),
+                   'day': ('datetime64[D]', 'D', '%Y-%m-%d'),
+                   'week': ('datetime64[D]', '7D', '%Y-%m-%d'),
+                   'month': ('datetime64[M]', 'MS', '%Y-%m')}
+
     def __init__(self, begin, end):
         self.log = logging.getLogger(self.__class__.__name__)
         if ((type(begin) != pd.Timestamp) or (type(end) != pd.Timestamp)):
@@ -266,7 +1095,27 @@ class TimeSerie:
         self._end = end
         self._ts = None
 
-    def combine_with(self, other_df, new_col, function):
+    @classmethod
+    def bucket(cls, values, freq):
+        """
+        Returns the start of the bucket of each date as datetime64[ns], weeks
+        starting on Monday. NaT stays NaT.
+        Args:
+            values: A datetime64 array
+            freq: One of hour, day, week and month
+        """
+        if (freq not in cls.frequencies):
+            raise ValueError('freq should be one of ' + ', '.join(cls.frequencies))
+
+        buckets = np.asarray(values, dtype='datetime64[ns]').astype(cls.frequencies[freq][0])
+        if (freq == 'week'):
+            # 1970-01-01 was a Thursday, the day 0 is 3 days after a Monday
+            days = buckets.astype(np.int64)
+            buckets = buckets - ((days + 3) % 7).astype('timedelta64[D]')
+        return buckets.astype('datetime64[ns]')
+
+    @metrics.timed()
+    def combine_with(self, other_df, new_col, function, freq='day', fill=False, window=None):
         """
         Public method with allows to combine a given dataframe which contains
         fields such as city and state to the TimeSerie dataframe. The match is
@@ -275,22 +1124,73 @@ class TimeSerie:
             other_df: An external dataframe to merge the data with
             new_col: The name of the new column introduced by the aggregate function
             function: The name of the aggregate function to group by.
+            freq: The size of the buckets: hour, day, week or month
+            fill: Adds the missing buckets of the [begin, end] window with 0
+            window: If given, a column new_col + '_rolling' holds the sum of
+            the last window buckets of each state
             return: A new dataframe integrating the geo coordinates and applying
             the aggregate function.
+        When other_df already contains new_col (e.g. the counts returned by
+        DataBase.count_by_day) the function is applied to that column, so
+        'sum' combines pre-aggregated counts. Otherwise only 'size' is
+        allowed, counting the rows.
+        The dates are bucketed on datetime64 values and only the buckets
+        between those of begin and end are kept. other_df is not modified.
         """
         if ((type(other_df) != pandas.core.frame.DataFrame) or (type(new_col) != str) or (type(function) != str)):
             raise ValueError(
                 'Function signature is (DataFrame, string, string')
 
-        self._ts = other_df
-        self._ts['state'].replace('', np.nan, inplace=True)
-        self._ts.sort_values(by=['datetime'], inplace=True)
-        self._ts.loc[(self._ts['datetime'] > self._begin) & (self._ts['datetime'] < self._end)]
-        self._ts['datetime'] = self._ts['datetime'].apply(lambda r: r.strftime('%Y-%m-%d'))
-        self._ts = self._ts.groupby(['datetime', 'state']).agg('size').reset_index(name=new_col)
-        self._ts.dropna(axis=0, how='any', inplace=True)
+        buckets = self.bucket(pd.to_datetime(other_df['datetime']).values, freq)
+        first, last = self.bucket([self._begin, self._end], freq)
+        states = other_df['state'].astype(object).values
+        mask = (pd.notna(states) & (states != '') & (buckets >= first) & (buckets <= last))
+
+        if (new_col in other_df.columns):
+            values = other_df[new_col].values[mask]
+        elif (function == 'size'):
+            values = np.ones(mask.sum(), dtype=np.int64)
+        else:
+            raise ValueError('Column ' + new_col + ' is missing, only size counts the rows')
+        grouped = pd.Series(values).groupby([buckets[mask], states[mask]]).agg(function)
+        grouped.index.names = ['datetime', 'state']
+
+        if (fill or window):
+            dates = pd.date_range(first, last, freq=self.frequencies[freq][1])
+            wide = grouped.unstack(fill_value=0).reindex(dates, fill_value=0)
+            wide.index.name = 'datetime'
+            if (fill):
+                grouped = wide.stack()
+                grouped.index.names = ['datetime', 'state']
 
-        self.log.info('TimeSerie built as: %s', pprint.pformat(self._ts.head()))
+        self._ts = grouped.reset_index(name=new_col)
+        if (window):
+            rolling = wide.rolling(window, min_periods=1).sum().stack()
+            if (pd.api.types.is_integer_dtype(grouped.dtype)):
+                rolling = rolling.astype(grouped.dtype)
+            self._ts[new_col + '_rolling'] = rolling.reindex(grouped.index).values
+
+        # the buckets are formatted once each, not per row
+        codes, uniques = pd.factorize(self._ts['datetime'])
+        self._ts['datetime'] = pd.Index(uniques).strftime(self.frequencies[freq][2])[codes]
+
+        # the frame is only formatted when it is logged
+        if (self.log.isEnabledFor(logging.DEBUG)):
+            self.log.debug('TimeSerie built as: %s', pprint.pformat(self._ts.head()))
+
+    @metrics.timed()
+    def to_arrow(self, output_file, compression=None):
+        """
+        Writes the result of combine_with into an Arrow IPC file (see
+        write_arrow), the dates and states being dictionary encoded.
+        Args:
+            output_file: The Arrow file written
+            compression: None, 'lz4' or 'zstd'
+        """
+        if (self._ts is None):
+            raise ValueError('combine_with should be called first')
+        df = self._ts.astype({'datetime': 'category', 'state': 'category'})
+        write_arrow(frame_to_arrow(df), output_file, compression)
 
     def get_ts(self):
         """
@@ -299,64 +1199,950 @@ class TimeSerie:
         return self._ts
 
 
-# MAIN
-def main():
-    log = get_logger(__name__)
-    log.info("BEGIN+")
+class Aggregates:
+    """
+    Materialized counts of the reports per (day, state) and per (city, state),
+    kept in a SQLite file next to the outputs. A ledger remembers the day and
+    place each report ID was counted under, so that loading reports again only
+    applies the differences: new reports are added, changed ones moved and
+    unchanged ones ignored. The (city, state) counts are combined with the
+    counties by Coordinates.combine_with.
+    Args:
+        path: The SQLite file of the tables
+    """
 
-    # Creates a JsonData object and prepared a DataFrame related to
-    jd = JsonData('data/data.json')
-    log.info('Creating DataFrame object %s from JSON file', jd)
-    cols = ['Summary']
-    jd.drop_columns(cols)
-    df = jd.get_dataframe()
+    tables = [
+        'CREATE TABLE IF NOT EXISTS reports (id TEXT PRIMARY KEY, day TEXT, city TEXT, state TEXT)',
+        'CREATE TABLE IF NOT EXISTS day_state (day TEXT, state TEXT, reports INTEGER, PRIMARY KEY (day, state))',
+        'CREATE TABLE IF NOT EXISTS places (city TEXT, state TEXT, reports INTEGER, PRIMARY KEY (city, state))']
+
+    def __init__(self, path):
+        self.log = logging.getLogger(self.__class__.__name__)
+        if ((not path) or (type(path) != str)):
+            raise TypeError('arg should be a valid path/file')
 
-    # Data munging operations on the dataframe. Eventually a correct format is saved into a JSON to file
-    df.columns = ['city', 'datetime', 'duration', 'posted', 'shape', 'state']
-    df['posted'] = df['posted'].str.replace('/', '-')
-    # jd.to_json_file('myCleanData.json')
-    # log.info('DataFrame ready as {}'.format(pprint.pprint(df.head())))
+        self._conn = sqlite3.connect(path)
+        with self._conn:
+            for table in self.tables:
+                self._conn.execute(table)
+
+    @metrics.timed()
+    def apply(self, df, key='id', chunk_size=10000):
+        """
+        Applies the reports of df to the counts. Only the reports which are
+        new or whose day, city or state changed since they were counted
+        modify the tables. Returns the number of reports inserted, updated
+        and unchanged.
+        Args:
+            df: A dataframe with the columns key, datetime, city and state
+            key: The column holding the report IDs
+            chunk_size: The number of reports compared at a time
+        """
+        if ((type(df) != pd.DataFrame) or (key not in df.columns)):
+            raise ValueError('Function signature is (DataFrame, key column)')
+
+        rows = self.ledger_rows(df, key)
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        with self._conn:
+            for start in range(0, len(rows), chunk_size):
+                self._apply_chunk(rows.iloc[start:start + chunk_size], counts)
+
+        self.log.info('Aggregates updated: %(inserted)s inserted, %(updated)s updated, '
+                      '%(unchanged)s unchanged', counts)
+        return counts
+
+    def rebuild(self, df, key='id'):
+        """
+        Drops every count and recomputes the tables from df, e.g. to verify
+        the result of the incremental updates.
+        Args:
+            df: The dataframe of all the reports
+            key: The column holding the report IDs
+        """
+        with self._conn:
+            for table in ('reports', 'day_state', 'places'):
+                self._conn.execute('DELETE FROM ' + table)
+        return self.apply(df, key)
+
+    @staticmethod
+    def ledger_rows(df, key):
+        """
+        Returns the id, day, city and state the reports are counted under. The
+        day is the ISO date of datetime, the places are normalized as in
+        Coordinates.normalize and empty cities and states are missing, so
+        they are left out of the counts of the places.
+        """
+        days = TimeSerie.bucket(pd.to_datetime(df['datetime']).values, 'day')
+        codes, uniques = pd.factorize(days)
+        day = pd.Index(uniques).strftime('%Y-%m-%d').values.astype(object)
+        places = Coordinates.normalize(df['city'], df['state'])
 
-    # Connects to an instance of MongoDB and populates it with data from file
-    config = {
-        'host': 'mongodb://172.17.0.3',
-        'port': 27017,
-        'db': 'assignment2',
-        'collection': 'ufo_reports'
-    }
+        rows = pd.DataFrame({'id': df[key].astype(str).values,
+                             'day': np.append(day, None)[codes],
+                             'city': places.get_level_values(0),
+                             'state': places.get_level_values(1)})
+        rows.loc[rows['city'] == '', 'city'] = None
+        rows.loc[rows['state'] == '', 'state'] = None
+        return rows.drop_duplicates('id', keep='last')
+
+    def _apply_chunk(self, rows, counts):
+        """
+        Private method comparing a chunk of reports to the ledger and applying
+        the differences to the counts
+        """
+        self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS chunk (id TEXT PRIMARY KEY)')
+        self._conn.execute('DELETE FROM chunk')
+        self._conn.executemany('INSERT INTO chunk VALUES (?)', ((i,) for i in rows['id']))
+        old = pd.read_sql_query('SELECT reports.id, day, city, state FROM reports JOIN chunk '
+                                'ON reports.id = chunk.id', self._conn)
+
+        merged = pd.merge(rows, old, on='id', how='left', suffixes=('', '_old'), indicator=True)
+        seen = (merged['_merge'] == 'both').values
+        same = seen.copy()
+        for column in ('day', 'city', 'state'):
+            new, previous = merged[column], merged[column + '_old']
+            same &= ((new == previous) | (new.isna() & previous.isna())).values
+
+        counts['inserted'] += int((~seen).sum())
+        counts['updated'] += int((seen & ~same).sum())
+        counts['unchanged'] += int(same.sum())
+
+        changed = merged[~same]
+        removed = changed[seen[~same]][['day_old', 'city_old', 'state_old']]
+        removed.columns = ['day', 'city', 'state']
+        self._apply_deltas(pd.concat([changed[['day', 'city', 'state']].assign(delta=1),
+                                      removed.assign(delta=-1)], ignore_index=True))
+        self._conn.executemany('INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?)',
+                               changed[['id', 'day', 'city', 'state']].itertuples(index=False, name=None))
+
+    def retract(self, ids, chunk_size=10000):
+        """
+        Removes reports from the counts and from the ledger, e.g. the reports
+        which stopped representing their cluster of near duplicates. The IDs
+        which were never counted are ignored. Returns the number of reports
+        removed.
+        Args:
+            ids: The report IDs
+            chunk_size: The number of reports removed at a time
+        """
+        ids = [str(i) for i in ids]
+        removed = 0
+        with self._conn:
+            self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS chunk (id TEXT PRIMARY KEY)')
+            for start in range(0, len(ids), chunk_size):
+                self._conn.execute('DELETE FROM chunk')
+                self._conn.executemany('INSERT OR IGNORE INTO chunk VALUES (?)',
+                                       ((i,) for i in ids[start:start + chunk_size]))
+                old = pd.read_sql_query('SELECT day, city, state FROM reports JOIN chunk '
+                                        'ON reports.id = chunk.id', self._conn)
+                self._apply_deltas(old.assign(delta=-1))
+                self._conn.execute('DELETE FROM reports WHERE id IN (SELECT id FROM chunk)')
+                removed += len(old)
+
+        self.log.info('Aggregates updated: %s retracted', removed)
+        return removed
+
+    def _apply_deltas(self, deltas):
+        """
+        Private method adding the delta of each row (day, city, state) to the
+        counts, the rows of a missing place or day being left out
+        """
+        for table, columns in (('day_state', ['day', 'state']), ('places', ['city', 'state'])):
+            valid = deltas[columns].notna().all(axis=1)
+            delta = deltas[valid].groupby(columns)['delta'].sum()
+            delta = delta[delta != 0]
+            self._conn.executemany(
+                'INSERT INTO {0} ({1}, {2}, reports) VALUES (?, ?, ?) ON CONFLICT ({1}, {2}) '
+                'DO UPDATE SET reports = reports + excluded.reports'.format(table, *columns),
+                ((a, b, int(n)) for (a, b), n in delta.items()))
+            self._conn.execute('DELETE FROM {} WHERE reports = 0'.format(table))
+
+    def day_state(self, exclude=None):
+        """
+        Returns the counts per (day, state) as a dataframe with the columns
+        datetime, state and reports, ready for TimeSerie.combine_with.
+        Args:
+            exclude: A list of states left out
+        """
+        df = self._read('SELECT day AS datetime, state, reports FROM day_state', exclude)
+        df['datetime'] = pd.to_datetime(df['datetime'], format='%Y-%m-%d')
+        return df
+
+    def places(self, exclude=None):
+        """
+        Returns the counts per (city, state) as a dataframe with the columns
+        city, state and reports, ready for Coordinates.combine_with.
+        Args:
+            exclude: A list of states left out
+        """
+        return self._read('SELECT city, state, reports FROM places', exclude)
+
+    def day_places(self, exclude=None):
+        """
+        Returns the counts per (day, city, state) read from the ledger as a
+        dataframe with the columns datetime, city, state and reports, the
+        reports without date having a missing datetime. Summed over the days
+        they are the place counts.
+        Args:
+            exclude: A list of states left out
+        """
+        df = self._read('SELECT * FROM (SELECT day AS datetime, city, state, COUNT(*) AS reports FROM reports '
+                        'WHERE city IS NOT NULL AND state IS NOT NULL GROUP BY day, city, state)', exclude)
+        df['datetime'] = pd.to_datetime(df['datetime'], format='%Y-%m-%d')
+        return df
 
+    def _read(self, query, exclude):
+        exclude = list(exclude or [])
+        if (exclude):
+            query += ' WHERE state NOT IN ({})'.format(', '.join('?' * len(exclude)))
+        return pd.read_sql_query(query + ' ORDER BY 1, 2', self._conn, params=exclude)
+
+    def close(self):
+        self._conn.close()
+
+
+# The names of the columns of the reports used by the stages of the pipeline
+column_names = {'City': 'city', 'Date / Time': 'datetime', 'Duration': 'duration', 'Posted': 'posted',
+                'Seconds': 'seconds', 'Shape': 'shape', 'State': 'state', 'Summary': 'summary'}
+
+
+class PartialCounts:
+    """
+    The counts per (city, state) and per (day, state) of a part of the
+    reports, as in the tables of Aggregates. Merging partial counts is
+    associative and commutative, so the partitions of the reports can be
+    counted separately, in any order, and combined.
+    Args:
+        place_counts: A Series of counts indexed by the normalized (city, state)
+        day_counts: A Series of counts indexed by the ISO (day, state)
+    """
+
+    def __init__(self, place_counts=None, day_counts=None):
+        def empty(names):
+            return pd.Series([], index=pd.MultiIndex.from_arrays([[], []], names=names), dtype=np.int64)
+        self.place_counts = empty(['city', 'state']) if place_counts is None else place_counts
+        self.day_counts = empty(['day', 'state']) if day_counts is None else day_counts
+
+    @classmethod
+    def from_frame(cls, df, key='id'):
+        """
+        Counts the reports of df like Aggregates.apply on empty tables
+        Args:
+            df: A dataframe with the columns key, datetime, city and state
+            key: The column holding the report IDs
+        """
+        rows = Aggregates.ledger_rows(df, key)
+        counts = []
+        for columns in (['city', 'state'], ['day', 'state']):
+            valid = rows[columns].notna().all(axis=1)
+            counts.append(rows[valid].groupby(columns).size().astype(np.int64))
+        return cls(*counts)
+
+    def merge(self, other):
+        """
+        Returns the sum of these counts and of other
+        """
+        return PartialCounts(*[mine.add(theirs, fill_value=0).astype(np.int64)
+                               for mine, theirs in ((self.place_counts, other.place_counts),
+                                                    (self.day_counts, other.day_counts))])
+
+    def __add__(self, other):
+        return self.merge(other)
+
+    def places(self, exclude=None):
+        """
+        Returns the counts per (city, state) as Aggregates.places does
+        """
+        return self._frame(self.place_counts, ['city', 'state'], exclude)
+
+    def day_state(self, exclude=None):
+        """
+        Returns the counts per (day, state) as Aggregates.day_state does
+        """
+        df = self._frame(self.day_counts, ['datetime', 'state'], exclude)
+        df['datetime'] = pd.to_datetime(df['datetime'], format='%Y-%m-%d')
+        return df
+
+    @staticmethod
+    def _frame(counts, columns, exclude):
+        # built from tuples as pandas.read_sql_query does, to get the same dtypes
+        counts = counts[~counts.index.get_level_values(1).isin(list(exclude or []))].sort_index()
+        return pd.DataFrame.from_records([key + (int(n),) for key, n in counts.items()],
+                                         columns=columns + ['reports'])
+
+
+# Splits a JSON lines file into byte ranges of about chunk_bytes starting on a line
+def partition_file(path, chunk_bytes=64 << 20):
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as file:
+        while (bounds[-1] + chunk_bytes < size):
+            file.seek(bounds[-1] + chunk_bytes)
+            file.readline()
+            if (file.tell() >= size):
+                break
+            bounds.append(file.tell())
+    bounds.append(size)
+    return [(path, start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+# Yields the partitions of the report files: byte ranges of the plain JSON
+# lines files, read by the workers, and lists of records for the other formats
+def iter_partitions(paths, chunk_bytes=64 << 20, chunk_size=100000):
+    for path in paths:
+        if (path.endswith('.jsonl')):
+            for partition in partition_file(path, chunk_bytes):
+                yield partition
+            continue
+
+        records = []
+        for record in iter_records(path, stream=True):
+            records.append(record)
+            if (len(records) == chunk_size):
+                yield records
+                records = []
+        if (records):
+            yield records
+
+
+# Builds the frame of some records of the scraper with their IDs and the given
+# fields, named as in the pipeline, the dates being parsed
+def records_frame(records, fields):
+    ids = []
+    rows = []
+    for record in records:
+        for report_id, values in record.items():
+            ids.append(report_id)
+            rows.append(values)
+
+    df = pd.DataFrame.from_records(rows, columns=fields)
+    for column, formats in JsonData.dates.items():
+        if (column in df.columns):
+            df[column] = parse_dates(df[column], formats)[0]
+    df.rename(columns=column_names, inplace=True)
+    df.insert(0, 'id', ids)
+    return df
+
+
+# Returns the records of a partition, reading its byte range if needed
+def read_partition(partition):
+    if (isinstance(partition, tuple)):
+        path, start, stop = partition
+        with open(path, 'rb') as file:
+            file.seek(start)
+            lines = file.read(stop - start).decode('utf-8').splitlines()
+        partition = [json.loads(line) for line in lines if line.strip()]
+    return partition
+
+
+# Returns the reports of df which represent their cluster of near duplicates
+def deduplicated(df, key='id'):
+    return df[df[key] == df['cluster']]
+
+
+# Parses and counts one partition, run in the worker processes
+def count_partition(partition):
+    df = records_frame(read_partition(partition), ['City', 'State', 'Date / Time'])
+    if (df.empty):
+        return PartialCounts()
+    return PartialCounts.from_frame(df, 'id')
+
+
+# Parses one partition and returns the fields needed to find its near
+# duplicates, with the MinHash signatures of the summaries
+def sign_partition(partition, dedup):
+    df = records_frame(read_partition(partition), ['City', 'State', 'Date / Time', 'Summary'])
+    return (df.drop(['summary'], axis=1), dedup.signatures(df['summary']))
+
+
+# Yields the results of function on the partitions of paths computed by a
+# pool of processes, in the order of the partitions
+def map_partitions(function, paths, processes=None, chunk_bytes=64 << 20, chunk_size=100000):
+    pending = deque()
+    processes = processes or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        # at most two partitions per worker are held in memory at a time
+        for partition in iter_partitions(paths, chunk_bytes, chunk_size):
+            pending.append(executor.submit(function, partition))
+            if (len(pending) >= 2 * processes):
+                yield pending.popleft().result()
+        while (pending):
+            yield pending.popleft().result()
+
+
+@metrics.timed()
+def partitioned_counts(paths, processes=None, chunk_bytes=64 << 20, chunk_size=100000, dedup=None):
+    """
+    Counts the reports of the files written by the scraper (e.g. one per
+    month) in a pool of processes, each partition being parsed and counted
+    by a worker, and merges the partial counts. Gives the same counts as
+    Aggregates.apply on the whole frame as long as the report IDs of
+    different partitions are distinct.
+    Args:
+        paths: The list of report files
+        processes: The number of worker processes, the number of CPUs by default
+        chunk_bytes: The size of the partitions of the .jsonl files
+        chunk_size: The number of records of the partitions of the other files
+        dedup: If given, a NearDuplicates object and only one report of each
+        cluster of near duplicates is counted. The workers then compute the
+        signatures and the clusters are found on all of them, as the near
+        duplicates of a block may be in different partitions.
+    """
+    if ((type(paths) != list) or (not all(os.path.isfile(path) for path in paths))):
+        raise TypeError('arg should be a list of valid paths/files')
+
+    if (dedup is None):
+        total = PartialCounts()
+        for counts in map_partitions(count_partition, paths, processes, chunk_bytes, chunk_size):
+            total = total.merge(counts)
+        return total
+
+    parts = list(map_partitions(partial(sign_partition, dedup=dedup), paths, processes, chunk_bytes, chunk_size))
+    df = pd.concat([part[0] for part in parts], ignore_index=True)
+    signatures = np.concatenate([part[1] for part in parts] + [np.zeros((0, dedup.num_perm), np.uint32)])
+    df['cluster'] = dedup.clusters(df['id'].values, dedup.blocks(df), signatures)
+    return PartialCounts.from_frame(deduplicated(df), 'id')
+
+
+class CountCube:
+    """
+    Precomputed counts of the reports per county and day (optionally per
+    shape too), stored as 2D prefix sums over (county, day) in a memory mapped
+    .npy file. The counties are ordered by state so that every state is a
+    contiguous range, hence the total of any time range over a county, a state
+    or the whole country is read with four lookups whatever their size.
+    Args:
+        path: The directory of a cube written by build
+    """
+
+    def __init__(self, path):
+        self.log = logging.getLogger(self.__class__.__name__)
+        if ((type(path) != str) or (not os.path.isdir(path))):
+            raise TypeError('arg should be a valid directory')
+
+        with open(os.path.join(path, 'cube.json'), 'r') as infile:
+            meta = json.load(infile)
+        self._prefix = np.load(os.path.join(path, 'cube.npy'), mmap_mode='r')
+        self._first = pd.Timestamp(meta['first'])
+        self._shapes = meta['shapes']
+        self._counties = pd.DataFrame(meta['counties'], columns=['city', 'state'])
+        self._county = {(city, state): i for i, (city, state) in enumerate(meta['counties'])}
+        states = self._counties['state'].values
+        starts = np.flatnonzero(np.r_[True, states[1:] != states[:-1]])
+        ends = np.r_[starts[1:], len(states)]
+        self._states = {states[start]: (start, end) for start, end in zip(starts, ends)}
+
+    @classmethod
+    @metrics.timed('CountCube.build')
+    def build(cls, df, coordinates, path, shapes=False):
+        """
+        Counts the reports of df per county and day and writes the cube into
+        path. Reports without date or county are left out.
+        Args:
+            df: A dataframe with the columns city, state and datetime (and
+            shape if shapes is set)
+            coordinates: The Coordinates object matching the places to counties
+            path: The directory where the cube is written
+            shapes: Adds a dimension for the shapes
+            return: The CountCube loaded from path
+        """
+        counties = coordinates.get_counties().sort_values(['state', 'city', 'county'], kind='stable')
+        counties = counties.reset_index(drop=True)
+        first_county = pd.Series(counties.index, index=counties['key']).groupby(level=0).first()
+
+        keys = coordinates.lookup(df)
+        county = first_county.reindex(keys).fillna(-1).astype(np.int64).values
+        days = TimeSerie.bucket(pd.to_datetime(df['datetime']).values, 'day')
+        valid = (county >= 0) & ~np.isnat(days)
+        first = days[valid].min() if valid.any() else np.datetime64('1970-01-01', 'ns')
+        day = ((days[valid] - first) // np.timedelta64(1, 'D')).astype(np.int64)
+        county = county[valid]
+        n_days = int(day.max()) + 1 if len(day) else 1
+
+        if (shapes):
+            shape_codes, shape_names = pd.factorize(df['shape'].astype(object).fillna('').values[valid])
+            shape_names = [str(name) for name in shape_names]
+        else:
+            shape_codes, shape_names = np.zeros(len(day), dtype=np.int64), []
+        n_shapes = max(len(shape_names), 1)
+
+        # the reports sorted by (shape, county), so that each block of counties is a slice
+        rows = shape_codes * len(counties) + county
+        order = np.argsort(rows, kind='stable')
+        rows, day = rows[order], day[order]
+
+        os.makedirs(path, exist_ok=True)
+        prefix = np.lib.format.open_memmap(os.path.join(path, 'cube.npy'), mode='w+', dtype=np.int32,
+                                           shape=(n_shapes, len(counties) + 1, n_days + 1))
+        prefix[:, 0, :] = 0
+        prefix[:, :, 0] = 0
+        # the prefix sums are written block by block of counties, only one block being in memory
+        block = max(1, (1 << 22) // n_days)
+        for shape in range(n_shapes):
+            above = np.zeros(n_days, dtype=np.int64)
+            for c0 in range(0, len(counties), block):
+                c1 = min(c0 + block, len(counties))
+                first_row = shape * len(counties)
+                lo, hi = np.searchsorted(rows, [first_row + c0, first_row + c1])
+                counts = np.bincount((rows[lo:hi] - first_row - c0) * n_days + day[lo:hi],
+                                     minlength=(c1 - c0) * n_days).reshape(c1 - c0, n_days)
+                sums = np.cumsum(np.cumsum(counts, axis=1), axis=0) + above
+                prefix[shape, c0 + 1:c1 + 1, 1:] = sums
+                above = sums[-1]
+        prefix.flush()
+        del prefix
+
+        with open(os.path.join(path, 'cube.json'), 'w') as outfile:
+            json.dump({'first': str(pd.Timestamp(first).date()), 'shapes': shape_names,
+                       'counties': counties[['city', 'state']].values.tolist()}, outfile)
+        return cls(path)
+
+    def _days(self, begin, end):
+        """
+        Private method returning the [t0, t1) range of prefix columns of the
+        days between begin and end included
+        """
+        if ((begin is not None) and (end is not None) and (pd.Timestamp(begin) > pd.Timestamp(end))):
+            raise ValueError('End of the interval cannot be before begin')
+        n_days = self._prefix.shape[2] - 1
+        t0 = 0 if (begin is None) else (pd.Timestamp(begin).normalize() - self._first).days
+        t1 = n_days if (end is None) else (pd.Timestamp(end).normalize() - self._first).days + 1
+        return (min(max(t0, 0), n_days), min(max(t1, 0), n_days))
+
+    def _shape_slices(self, shape):
+        if (shape is None):
+            return slice(None)
+        if (shape not in self._shapes):
+            return []
+        return [self._shapes.index(shape)]
+
+    def total(self, begin=None, end=None, state=None, county=None, shape=None):
+        """
+        Returns the number of reports between the days begin and end included,
+        in a county, a state or the whole country, optionally of one shape.
+        Args:
+            begin, end: The first and last days, None for no bound
+            state: A state abbreviation
+            county: A (county, state) tuple, as named in the counties file
+            shape: A shape, when the cube was built with shapes
+        """
+        t0, t1 = self._days(begin, end)
+        if (county is not None):
+            c0 = self._county.get(tuple(county), -1)
+            c0, c1 = (c0, c0 + 1) if (c0 >= 0) else (0, 0)
+        elif (state is not None):
+            c0, c1 = self._states.get(state, (0, 0))
+        else:
+            c0, c1 = (0, len(self._counties))
+
+        p = self._prefix[self._shape_slices(shape)]
+        return int((p[:, c1, t1] - p[:, c0, t1] - p[:, c1, t0] + p[:, c0, t0]).sum())
+
+    def top_counties(self, begin=None, end=None, n=10, state=None, shape=None):
+        """
+        Returns the n counties with the most reports between begin and end as a
+        dataframe with the columns city, state and reports.
+        Args:
+            begin, end: The first and last days, None for no bound
+            n: The number of counties returned
+            state: Restricts the ranking to the counties of a state
+            shape: A shape, when the cube was built with shapes
+        """
+        t0, t1 = self._days(begin, end)
+        c0, c1 = self._states.get(state, (0, 0)) if (state is not None) else (0, len(self._counties))
+        p = self._prefix[self._shape_slices(shape)]
+        window = (p[:, c0:c1 + 1, t1] - p[:, c0:c1 + 1, t0]).sum(axis=0)
+        reports = np.diff(window)
+
+        order = np.argsort(-reports, kind='stable')[:n]
+        result = self._counties.iloc[c0 + order].reset_index(drop=True)
+        result['reports'] = reports[order]
+        return result
+
+
+class Pipeline:
+    """
+    Runs a set of stages forming a dependency graph. The output of every
+    stage is pickled into cache_dir under a key hashing the stage name, its
+    parameters, the keys of its inputs and the content of its input files, so
+    that a stage only runs again when one of these changes. The stages whose
+    inputs are ready run in parallel.
+    Args:
+        cache_dir: The directory of the stage outputs
+        workers: The number of stages run at the same time
+    """
+
+    def __init__(self, cache_dir, workers=2):
+        self.log = logging.getLogger(self.__class__.__name__)
+        if (type(cache_dir) != str):
+            raise TypeError('arg should be a string')
+        if (workers < 1):
+            raise ValueError('workers should be at least 1')
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._cache_dir = cache_dir
+        self._workers = workers
+        self._stages = {}
+        self._keys = {}
+
+    def add(self, name, function, inputs=(), params=None, files=(), outputs=(), cache=True):
+        """
+        Adds a stage computing function(*results of inputs, **params). The
+        inputs must have been added before, which keeps the graph acyclic.
+        Args:
+            name: The name of the stage
+            function: The callable of the stage
+            inputs: The names of the stages whose results are passed to function
+            params: A dict of JSON serializable keyword arguments of function
+            files: The paths of the files read by the stage
+            outputs: The paths written by the stage, it runs again if one is missing
+            cache: False for stages cheap to run or whose result can't be pickled
+        """
+        if (name in self._stages):
+            raise ValueError('stage {} already exists'.format(name))
+        missing = [i for i in inputs if i not in self._stages]
+        if (missing):
+            raise ValueError('unknown inputs {} of stage {}'.format(missing, name))
+
+        self._stages[name] = {'function': function, 'inputs': list(inputs), 'params': dict(params or {}),
+                              'files': list(files), 'outputs': list(outputs), 'cache': cache}
+        return self
+
+    def key(self, name):
+        """
+        Returns the cache key of a stage
+        """
+        if (name not in self._keys):
+            stage = self._stages[name]
+            salt = json.dumps([name, stage['params'], [self.key(i) for i in stage['inputs']]],
+                              sort_keys=True, default=str)
+            digest = hashlib.sha1(salt.encode('utf-8'))
+            for path in stage['files']:
+                digest.update(file_hash(path).encode('utf-8'))
+            self._keys[name] = digest.hexdigest()
+        return self._keys[name]
+
+    def sinks(self):
+        """
+        Returns the names of the stages which are not an input of another stage
+        """
+        inputs = {i for stage in self._stages.values() for i in stage['inputs']}
+        return [name for name in self._stages if name not in inputs]
+
+    def cache_file(self, name):
+        return os.path.join(self._cache_dir, '{}.{}.pkl'.format(name, self.key(name)))
+
+    def is_cached(self, name):
+        stage = self._stages[name]
+        return (stage['cache'] and os.path.isfile(self.cache_file(name)) and
+                all(os.path.exists(path) for path in stage['outputs']))
+
+    def plan(self, targets=None, force=()):
+        """
+        Returns the list of stages to run, in dependency order, to get the
+        results of targets (the stages no other stage depends on by default).
+        A target or an input of a stage to be run is run when it isn't cached
+        or is forced. Any other stage upstream of the targets is run when one
+        of its outputs is missing (e.g. a deleted database file).
+        Args:
+            targets: The names of the wanted stages
+            force: The names of the stages to run even if cached
+        """
+        self._keys = {}
+        run = set()
+        if (targets is None):
+            targets = self.sinks()
+
+        visited = {}
+
+        def visit(name, needed):
+            # needed: the result of the stage is used by a stage run or is a target
+            if (visited.get(name, False) or (name in visited and not needed)):
+                return
+            visited[name] = needed
+            stage = self._stages[name]
+            if (needed):
+                runs = (name in force) or (not self.is_cached(name))
+            else:
+                runs = not all(os.path.exists(path) for path in stage['outputs'])
+            if (runs):
+                run.add(name)
+            for i in stage['inputs']:
+                visit(i, runs)
+
+        for name in targets:
+            visit(name, True)
+        return [name for name in self._stages if name in run]
+
+    def run(self, targets=None, force=()):
+        """
+        Runs the invalidated stages and returns a dict {stage: result} for the
+        targets (the stages no other stage depends on by default)
+        Args:
+            targets: The names of the wanted stages
+            force: The names of the stages to run even if cached
+        """
+        targets = list(self.sinks() if targets is None else targets)
+        unknown = [name for name in list(targets) + list(force) if name not in self._stages]
+        if (unknown):
+            raise ValueError('unknown stages {}'.format(unknown))
+
+        to_run = self.plan(targets, force)
+        self.log.info('Stages to run: %s', to_run)
+        futures = {}
+
+        def result(name):
+            if (name in futures):
+                return futures[name].result()
+            return self.load(name)
+
+        def execute(name):
+            # The inputs are submitted before, the FIFO queue of the pool
+            # guarantees they are started before this stage waits on them
+            stage = self._stages[name]
+            args = [result(i) for i in stage['inputs']]
+            start = time.perf_counter()
+            with metrics.stage('pipeline.' + name):
+                value = stage['function'](*args, **stage['params'])
+            self.log.info('Stage %s ran in %.2fs', name, time.perf_counter() - start)
+            if (stage['cache']):
+                self.store(name, value)
+            return value
+
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            for name in to_run:
+                futures[name] = executor.submit(execute, name)
+            return {name: result(name) for name in targets}
+
+    def load(self, name):
+        with open(self.cache_file(name), 'rb') as infile:
+            return pickle.load(infile)
+
+    def store(self, name, value):
+        cache_file = self.cache_file(name)
+        tmp_file = cache_file + '.tmp'
+        with open(tmp_file, 'wb') as outfile:
+            pickle.dump(value, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+        remove_stale(cache_file)
+
+
+# STAGES
+# Reads the scraped reports into a typed frame with the column names used by the other stages
+def load_stage(data_file, cache_dir=None, keep_summary=False):
+    jd = JsonData(data_file, id_column='id', typed=True, cache_dir=cache_dir)
+    if (not keep_summary):
+        jd.drop_columns(['Summary'])
+    df = jd.get_dataframe()
+    df.rename(columns=column_names, inplace=True)
+    return df
+
+
+# Upserts the reports into MongoDB
+def mongo_stage(df, config):
+    log = logging.getLogger('mongo_stage')
     log.info('DB config: host: %s port: %s', config['host'], config['port'])
-    mongo_db = DataBase(config)
-    jd.to_database(mongo_db)
-
-    # Performs a query against the DB in order to collect the necessary data
-    cursor = mongo_db.get_connection()
-    cursor = cursor.find({"state": {"$nin": ['AK', 'HI', 'PR', 'MP', 'VI', 'AS', 'GU']}},
-                         {"city": 1, "state": 1, "datetime": 1})
-
-    # Build a dataframe from the query results. Then remove _id field
-    df = pd.DataFrame(list(cursor))
-    df.drop(['_id'], axis=1, inplace=True)
-    df['datetime'] = pd.to_datetime(df['datetime'])
-    log.info('DataFrame retrieved from DB as %s', pprint.pformat(df.head()))
-
-    # Creates an object Coordinates and merges it with our df
-    coord = Coordinates('data/US_Counties.csv')
-    coord.combine_with(df, 'reports', 'size')
-    num_rep = coord.get_coord_obj()
-    coord_output_file = 'geo_reports.json'
-    num_rep.to_json(coord_output_file)
-    log.info("Coordinates data as JSON in {}/{}".format(os.getcwd(), coord_output_file))
-
-    # Creates an object TimeSerie and builds its related df
-    begin = pd.Timestamp(datetime.date(2017, 1, 1))
-    end = pd.Timestamp(datetime.date(2017, 12, 31))
-    ts = TimeSerie(begin, end)
-    ts.combine_with(df, 'reports', 'size')
-    ts_output_file = 'ts_reports.json'
-    ts.get_ts().to_json(ts_output_file)
-    log.info("Time series data as JSON in {}/{}".format(os.getcwd(), ts_output_file))
-    log.info('DataFrame retrieved from TimeSerie object as %s', pprint.pformat(ts.get_ts().head()))
+    # a failed write raises, so that the stage isn't cached and runs again
+    return DataBase(config).save_from_frame(df, 'id', raise_errors=True)
+
+
+# Counts the reports stored by the mongo stage on the server, see DataBase.count_by_place
+def mongo_counts_stage(stored, config, exclude=()):
+    db = DataBase(config)
+    match = {'state': {'$nin': list(exclude)}} if exclude else None
+    return db.count_by_place(match), db.count_by_day(match)
+
+
+# Applies the new and changed reports to the materialized counts
+def aggregates_stage(df, path, exclude=(), deduplicate=False):
+    aggregates = Aggregates(path)
+    try:
+        if (deduplicate):
+            # the reports which stopped representing their cluster are no longer counted
+            aggregates.retract(df.loc[df['id'] != df['cluster'], 'id'])
+            df = deduplicated(df)
+        aggregates.apply(df, 'id')
+        return aggregates.places(exclude), aggregates.day_state(exclude)
+    finally:
+        aggregates.close()
+
+
+# Counts the reports file by file in a process pool, without loading them in one frame
+def partitioned_stage(paths, exclude=(), deduplicate=False, processes=None):
+    counts = partitioned_counts(list(paths), processes, dedup=NearDuplicates() if deduplicate else None)
+    return counts.places(exclude), counts.day_state(exclude)
+
+
+# Adds the cluster of near duplicates of every report
+def dedup_stage(df):
+    df = df.copy()
+    df['cluster'] = NearDuplicates().find(df, 'id', 'summary')
+    return df.drop(['summary'], axis=1)
+
+
+# Indexes the summaries of the new and changed reports
+def search_stage(paths, path, chunk_size=100000, chunk_bytes=64 << 20):
+    index = SearchIndex(path)
+    for partition in iter_partitions(paths, chunk_bytes, chunk_size):
+        index.add(records_frame(read_partition(partition), ['Summary', 'State', 'Shape', 'Date / Time']))
+    index.save()
+    return path
+
+
+def counties_stage(data_file, cache_dir=None):
+    return Coordinates(data_file, cache_dir=cache_dir)
+
+
+# Merges the place counts with the counties and writes them with their levels of
+# detail, as JSON or as Arrow when output_file ends with .arrow
+def geo_stage(aggregates, coord, output_file, levels=None, compression=None):
+    places, days = aggregates
+    coord.combine_with(places, 'reports', 'sum')
+    if (output_file.endswith('.arrow')):
+        coord.to_arrow(output_file, compression)
+        stem = output_file[:-len('.arrow')]
+        for name, (tolerance, decimals) in (levels or {}).items():
+            coord.to_arrow('{}.{}.arrow'.format(stem, name), compression,
+                           coord.simplify_geometry(tolerance, decimals))
+    else:
+        coord.get_coord_obj().to_json(output_file)
+        if (levels):
+            coord.to_json_levels(output_file, {name: tuple(level) for name, level in levels.items()},
+                                 by_state=True)
+    logging.getLogger('geo_stage').info("Coordinates data in %s", os.path.abspath(output_file))
+    return coord.get_coord_obj()
+
+
+# Writes the reports per day and state in the [begin, end] window, as JSON or
+# as Arrow when output_file ends with .arrow
+def timeserie_stage(aggregates, begin, end, output_file, freq='day', compression=None):
+    places, days = aggregates
+    ts = TimeSerie(pd.Timestamp(begin), pd.Timestamp(end))
+    ts.combine_with(days, 'reports', 'sum', freq=freq)
+    if (output_file.endswith('.arrow')):
+        ts.to_arrow(output_file, compression)
+    else:
+        ts.get_ts().to_json(output_file)
+    logging.getLogger('timeserie_stage').info("Time series data in %s", os.path.abspath(output_file))
+    return ts.get_ts()
+
+
+def cube_stage(df, coord, path, deduplicate=False):
+    CountCube.build(deduplicated(df) if deduplicate else df, coord, path)
+    return path
+
+
+def build_pipeline(args):
+    """
+    Returns the Pipeline of the data munging stages configured by the
+    command line arguments
+    """
+    out = partial(os.path.join, args.output_dir)
+    pipeline = Pipeline(args.cache_dir, workers=args.workers)
+    if (args.processes):
+        # the partitioned mode never holds all the reports in one frame, so
+        # the stages needing it (mongo and cube) are left out
+        pipeline.add('aggregates', partial(partitioned_stage, processes=args.processes),
+                     params={'paths': args.data, 'exclude': args.exclude, 'deduplicate': args.dedup},
+                     files=args.data)
+    else:
+        pipeline.add('load', load_stage, params={'data_file': args.data[0], 'cache_dir': args.cache_dir,
+                                                 'keep_summary': args.dedup},
+                     files=args.data[:1])
+        # the reports with their clusters of near duplicates replace the loaded ones
+        reports = 'load'
+        if (args.dedup):
+            pipeline.add('dedup', dedup_stage, ['load'])
+            reports = 'dedup'
+        if (args.mongo_host):
+            config = {'host': args.mongo_host, 'port': args.mongo_port, 'db': args.db,
+                      'collection': args.collection}
+            pipeline.add('mongo', mongo_stage, [reports], {'config': config})
+        if (args.counts == 'mongo'):
+            # the counts depend on the whole collection, they are never cached
+            pipeline.add('aggregates', mongo_counts_stage, ['mongo'], {'config': config, 'exclude': args.exclude},
+                         cache=False)
+        else:
+            # the ledger of the raw and deduplicated counts can't be shared
+            sqlite_file = 'aggregates_dedup.sqlite' if args.dedup else 'aggregates.sqlite'
+            pipeline.add('aggregates', aggregates_stage, [reports],
+                         {'path': out(sqlite_file), 'exclude': args.exclude, 'deduplicate': args.dedup},
+                         outputs=[out(sqlite_file)])
+    pipeline.add('search', search_stage, params={'paths': args.data, 'path': out('search_index')},
+                 files=args.data, outputs=[out('search_index')])
+    pipeline.add('counties', counties_stage, params={'data_file': args.counties, 'cache_dir': args.cache_dir},
+                 files=[args.counties], cache=False)
+    geo_file, ts_file = out('geo_reports.' + args.format), out('ts_reports.' + args.format)
+    pipeline.add('geo', geo_stage, ['aggregates', 'counties'],
+                 {'output_file': geo_file, 'levels': {'national': (0.05, 3), 'state': (0.005, 4)},
+                  'compression': args.compression},
+                 outputs=[geo_file])
+    pipeline.add('timeserie', timeserie_stage, ['aggregates'],
+                 {'begin': args.begin, 'end': args.end, 'freq': args.freq, 'output_file': ts_file,
+                  'compression': args.compression},
+                 outputs=[ts_file])
+    if (not args.processes):
+        pipeline.add('cube', cube_stage, [reports, 'counties'],
+                     {'path': out('count_cube'), 'deduplicate': args.dedup}, outputs=[out('count_cube')])
+    return pipeline
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Prepares the UFO reports for the visualisations')
+    parser.add_argument('--data', nargs='+', default=['data/data.json'],
+                        help='the scraped reports, several files (e.g. months) with --processes')
+    parser.add_argument('--counties', default='data/US_Counties.csv', help='the counties geometry')
+    parser.add_argument('--output-dir', default='.', help='where the results are written')
+    parser.add_argument('--cache-dir', default='data/cache', help='where the stage outputs are cached')
+    parser.add_argument('--mongo-host', default='mongodb://172.17.0.3', help='empty to skip MongoDB')
+    parser.add_argument('--mongo-port', type=int, default=27017)
+    parser.add_argument('--db', default='assignment2')
+    parser.add_argument('--collection', default='ufo_reports')
+    parser.add_argument('--begin', default='2017-01-01', help='first day of the time series')
+    parser.add_argument('--end', default='2017-12-31', help='last day of the time series')
+    parser.add_argument('--freq', default='day', choices=sorted(TimeSerie.frequencies))
+    parser.add_argument('--format', default='json', choices=['json', 'arrow'],
+                        help='format of the geo and time series outputs, arrow requires pyarrow')
+    parser.add_argument('--compression', default=None, choices=['lz4', 'zstd'],
+                        help='compression of the arrow outputs, which are memory mapped when uncompressed')
+    parser.add_argument('--exclude', nargs='*', default=['AK', 'HI', 'PR', 'MP', 'VI', 'AS', 'GU'],
+                        help='states left out of the counts')
+    parser.add_argument('--workers', type=int, default=2, help='stages run in parallel')
+    parser.add_argument('--dedup', action='store_true',
+                        help='counts only one report of each cluster of near duplicates')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='counts the reports in this many processes instead of one frame')
+    parser.add_argument('--counts', default='sqlite', choices=['sqlite', 'mongo'],
+                        help='counts the reports in the SQLite aggregates or with a MongoDB aggregation')
+    parser.add_argument('--force', nargs='*', default=[], help='stages to run even if cached')
+    parser.add_argument('--stages', nargs='*', default=None, help='stages wanted, all by default')
+    parser.add_argument('--metrics', default=None,
+                        help='collects the timings of the stages into METRICS.json and METRICS.prom')
+    args = parser.parse_args(argv)
+    if ((len(args.data) > 1) and (not args.processes)):
+        parser.error('several --data files require --processes')
+    if ((args.counts == 'mongo') and ((not args.mongo_host) or args.dedup or args.processes)):
+        parser.error('--counts mongo requires --mongo-host, without --dedup and --processes')
+    if ((args.format == 'arrow') and (pyarrow is None)):
+        parser.error('--format arrow requires pyarrow')
+    return args
+
+
+# MAIN
+def main(argv=None):
+    log = get_logger(__name__)
+    log.info("BEGIN+")
+
+    args = parse_args(argv)
+    os.makedirs(args.output_dir, exist_ok=True)
+    if (args.metrics):
+        metrics.enable()
+    results = build_pipeline(args).run(args.stages, force=args.force)
+    if (('timeserie' in results) and log.isEnabledFor(logging.DEBUG)):
+        log.debug('DataFrame retrieved from TimeSerie object as %s', pprint.pformat(results['timeserie'].head()))
+    if (args.metrics):
+        metrics.write(args.metrics)
+        log.info('Metrics written in %s.json and %s.prom', args.metrics, args.metrics)
 
     log.info("END-\n")
 
@@ -1,35 +1,266 @@
 from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from html.parser import HTMLParser
+from metrics import metrics
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlparse
+import argparse
+import gzip
+import hashlib
+import os
 import requests
+import threading
 import re
 import json
 import time
 
 
-# This function accepts an URL as parameter and returns a BSOB
-def get_soup_object(url):
-    # set a user-agent to be sent with request
-    headers = {
-        "user-agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) \
-        Chrome/61.0.3163.100 Safari/537.36"
-    }
+stem = 'http://www.nuforc.org/webreports/'
 
+# the links to the month pages and to the report pages
+link_pattern = re.compile(r'/*[0-9]{6}\.html$')
+
+# set a user-agent to be sent with request
+headers = {
+    "user-agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) \
+    Chrome/61.0.3163.100 Safari/537.36"
+}
+
+
+class RateLimiter:
+    """
+    Thread safe limiter which spaces out the requests sent to the same host.
+    Args:
+        rate: The maximum number of requests per second for each host. None
+        disables the limit.
+    """
+
+    def __init__(self, rate=None):
+        if ((rate is not None) and (rate <= 0)):
+            raise ValueError('The rate should be a positive number')
+
+        self._interval = 1.0 / rate if rate else 0.0
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        """
+        Blocks the calling thread until a request to the host of url is allowed
+        Args:
+            url: The URL about to be requested
+        """
+        if (not self._interval):
+            return
+
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next.get(host, now))
+            self._next[host] = slot + self._interval
+
+        if (slot > now):
+            time.sleep(slot - now)
+
+
+# Creates a keep-alive session whose connection pool is sized for the number of workers.
+# Failed connections and transient HTTP errors are retried with exponential backoff.
+def get_session(workers=1, retries=3, backoff=0.5):
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=frozenset(['GET']))
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retry)
+
+    session = requests.Session()
+    session.headers.update(headers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class HttpCache:
+    """
+    On-disk cache of the pages downloaded. Every page is stored together with its
+    ETag/Last-Modified headers, which are sent back as a conditional GET the next
+    time the same URL is requested.
+    Args:
+        cache_dir: The directory holding the cached pages
+    """
+
+    def __init__(self, cache_dir):
+        if ((not cache_dir) or (type(cache_dir) != str)):
+            raise TypeError('arg should be a valid directory')
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._dir = cache_dir
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return (os.path.join(self._dir, key + '.html'), os.path.join(self._dir, key + '.json'))
+
+    def load(self, url):
+        """
+        Returns the cached (text, validators) of url or (None, {}) on a miss
+        Args:
+            url: The URL of the page
+        """
+        page_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path, 'r') as meta_file:
+                validators = json.load(meta_file)
+            with open(page_path, 'r', encoding='utf-8') as page_file:
+                return (page_file.read(), validators)
+        except (OSError, ValueError):
+            return (None, {})
+
+    def store(self, url, response):
+        """
+        Writes a response into the cache. Pages without validators are not kept.
+        Args:
+            url: The URL of the page
+            response: The requests.Response received
+        """
+        validators = {}
+        if ('ETag' in response.headers):
+            validators['If-None-Match'] = response.headers['ETag']
+        if ('Last-Modified' in response.headers):
+            validators['If-Modified-Since'] = response.headers['Last-Modified']
+        if (not validators):
+            return
+
+        page_path, meta_path = self._paths(url)
+        for path, content in ((page_path, response.text), (meta_path, json.dumps(validators))):
+            with open(path + '.tmp', 'w', encoding='utf-8') as outfile:
+                outfile.write(content)
+            os.replace(path + '.tmp', path)
+
+
+class CrawlState:
+    """
+    Persistent state of a crawl keyed by the report IDs. It records the reports
+    already retrieved and the month pages fully processed, so that an interrupted
+    or repeated crawl only retrieves what it is missing.
+    Args:
+        path: The JSON file where the checkpoints are written
+    """
+
+    def __init__(self, path):
+        if ((not path) or (type(path) != str)):
+            raise TypeError('arg should be a valid path/file')
+
+        self._path = path
+        self._months = {}
+        self._reports = {}
+        self._lock = threading.Lock()
+
+        if (os.path.isfile(path)):
+            with open(path, 'r') as infile:
+                content = json.load(infile)
+            self._months = content['months']
+            self._reports = content['reports']
+
+    def is_complete(self, link):
+        return link in self._months
+
+    def has_report(self, report_id):
+        record = self._reports.get(report_id)
+        return (record is not None) and (record.get('Summary') is not None)
+
+    def get_report(self, report_id):
+        return self._reports[report_id]
+
+    def add_report(self, report_id, record):
+        with self._lock:
+            self._reports[report_id] = record
+
+    def complete(self, link, ids):
+        """
+        Marks a month page as processed with the ids it contains
+        """
+        with self._lock:
+            self._months[link] = list(ids)
+
+    def records(self, link):
+        """
+        Returns the records of a completed month page as a list of {id: record}
+        """
+        return [{i: self._reports[i]} for i in self._months[link]]
+
+    def checkpoint(self):
+        """
+        Atomically writes the state to disk
+        """
+        with self._lock:
+            content = json.dumps({'months': self._months, 'reports': self._reports})
+        with open(self._path + '.tmp', 'w') as outfile:
+            outfile.write(content)
+        os.replace(self._path + '.tmp', self._path)
+
+
+# Downloads a page and returns (text, changed). With a cache, a conditional GET is sent and
+# changed is False when the server answers 304 Not Modified. Returns (None, False) on failure.
+def get_page(url, session=None, limiter=None, cache=None):
     print("Retrieving from: " + url)
 
-    response = requests.get(url, headers)
-    if (response.ok):
-        # parse the raw HTML into a `soup' object
-        soupObj = BeautifulSoup(response.text, "html.parser")
+    cached, validators = cache.load(url) if (cache is not None) else (None, {})
+
+    if (limiter is not None):
+        limiter.wait(url)
+
+    start = time.perf_counter()
+    try:
+        if (session is not None):
+            response = session.get(url, headers=validators)
+        else:
+            response = requests.get(url, headers=dict(headers, **validators))
+    except requests.RequestException:
+        metrics.inc('http_errors_total')
+        print("There was a problem reading from the URL: " + url)
+        return (None, False)
 
-        return soupObj
+    if (metrics.enabled):
+        record_response(response, time.perf_counter() - start)
+
+    if ((response.status_code == 304) and (cached is not None)):
+        return (cached, False)
+    elif (response.ok):
+        if (cache is not None):
+            cache.store(url, response)
+        return (response.text, True)
     else:
         print("There was a problem reading from the URL: " + url)
+        return (None, False)
+
+
+# Adds the latency, size, status and retries of a response to the metrics.
+# The retries are those of the urllib3 Retry of the session, which are
+# hidden from requests.
+def record_response(response, seconds):
+    metrics.observe('http_request_seconds', seconds)
+    metrics.inc('http_requests_total', status=response.status_code)
+    metrics.inc('http_response_bytes_total', len(response.content))
+    retries = getattr(response.raw, 'retries', None)
+    history = getattr(retries, 'history', None)
+    if (history):
+        metrics.inc('http_retries_total', len(history))
+
+
+# This function accepts an URL as parameter and returns a BSOB
+def get_soup_object(url, session=None, limiter=None, cache=None):
+    text, changed = get_page(url, session, limiter, cache)
+    if (text is None):
         return None
 
+    # parse the raw HTML into a `soup' object
+    soupObj = BeautifulSoup(text, "html.parser")
+
+    return soupObj
+
 
 # Extracts the links from a BSOB provided as a parameter
 def extract_links(soupObj):
     result = []
-    pattern = re.compile("\/*[0-9]{6}\.html$")
     if (soupObj is None):
         print("The BSOB object is null")
         return None
@@ -38,7 +269,7 @@ def extract_links(soupObj):
 
     for link in links:
         href = link.attrs['href']
-        match = re.search(pattern, href)
+        match = link_pattern.search(href)
         if (match):
             result.append(href.replace('.html', ''))
 
@@ -55,13 +286,12 @@ def get_event_content(soupObj):
         headers = headers.strip().split('\n')
         table = soupObj.find('table').tbody
 
+        # every row gives a record, the missing cells of a malformed row being empty
         for row in table.findAll("tr"):
             cols = row.findAll("td")
-            if len(cols) == len(headers):
-
-                tmp_dict = {}
-                for header, i in zip(headers, range(len(headers))):
-                    tmp_dict[header] = cols[i].text
+            tmp_dict = {}
+            for header, i in zip(headers, range(len(headers))):
+                tmp_dict[header] = cols[i].text if i < len(cols) else ''
 
             result.append(tmp_dict)
 
@@ -71,17 +301,205 @@ def get_event_content(soupObj):
     return result
 
 
-# Saves the content of a list of dictionary data into a formatted JSON file.
-def save_to_file(records_list):
-    with open('data.json', 'w') as outfile:
-        json.dump(records_list, outfile, indent=4)
+class PageParser(HTMLParser):
+    """
+    Single pass parser used by the fast extraction path. Instead of building a
+    tree like BeautifulSoup it only keeps what the scraper reads from a page: the
+    report links, the header and the body rows of the first table and the first
+    cell of the last row.
+    """
+
+    pattern = link_pattern
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.links = []
+        self.header = None
+        self.rows = None
+        self.last_cell = None
+        self._table = 0
+        self._header = None
+        self._tbody = False
+        self._row = None
+        self._cell = None
+        self._last_tr = False
+        self._last_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if (tag == 'a'):
+            href = dict(attrs).get('href')
+            if (href and self.pattern.search(href)):
+                self.links.append(href.replace('.html', ''))
+        elif (tag == 'table'):
+            if (self._table >= 0):
+                self._table += 1
+        elif (tag == 'tbody'):
+            if ((self._table > 0) and (self.rows is None)):
+                self.rows = []
+                self._tbody = True
+        elif (tag == 'tr'):
+            self._close_row()
+            if ((self._table > 0) and (self.header is None) and (self._header is None)):
+                self._header = []
+            elif (self._tbody):
+                self._row = []
+            self._last_tr = True
+            self.last_cell = None
+            self._last_depth = 0
+        elif (tag == 'td'):
+            self._close_cell()
+            if (self._row is not None):
+                self._cell = []
+            if (self._last_depth):
+                self._last_depth += 1
+            elif (self._last_tr and (self.last_cell is None)):
+                self.last_cell = []
+                self._last_depth = 1
+
+    def handle_endtag(self, tag):
+        if (tag == 'table'):
+            if (self._table > 0):
+                self._table -= 1
+                if (self._table == 0):
+                    self._close_row()
+                    self._tbody = False
+                    self._table = -1
+        elif (tag == 'tbody'):
+            self._close_row()
+            self._tbody = False
+        elif (tag == 'tr'):
+            self._close_row()
+        elif (tag == 'td'):
+            self._close_cell()
+            if (self._last_depth):
+                self._last_depth -= 1
+
+    def handle_data(self, data):
+        if (self._header is not None):
+            self._header.append(data)
+        if (self._cell is not None):
+            self._cell.append(data)
+        if (self._last_depth):
+            self.last_cell.append(data)
+
+    def _close_cell(self):
+        if (self._cell is not None):
+            self._row.append(''.join(self._cell))
+            self._cell = None
+
+    def _close_row(self):
+        if (self._header is not None):
+            self.header = ''.join(self._header)
+            self._header = None
+        self._close_cell()
+        if (self._row is not None):
+            self.rows.append(self._row)
+            self._row = None
+
+
+# Fast equivalent of extract_links and get_event_content on the raw HTML of a month page [level 2].
+# Returns (ids, records), one record per row, the missing cells of a malformed row being empty.
+@metrics.timed('scraper.parse_event_page')
+def parse_event_page(text):
+    parser = PageParser()
+    parser.feed(text)
+    parser.close()
+
+    if ((parser.header is None) or (parser.rows is None)):
+        return (parser.links, None)
+
+    headers = parser.header.strip().split('\n')
+    records = [{header: cols[i] if i < len(cols) else '' for i, header in enumerate(headers)}
+               for cols in parser.rows]
+    return (parser.links, records)
+
+
+# Fast equivalent of get_extended_summary on the raw HTML of a report page [level 3]
+@metrics.timed('scraper.parse_summary_page')
+def parse_summary_page(text):
+    parser = PageParser()
+    parser.feed(text)
+    parser.close()
+
+    if (parser.last_cell is None):
+        return None
+    return ''.join(parser.last_cell)
+
+
+class RecordWriter:
+    """
+    Streams records to a file as they are parsed, one compact JSON document per
+    line. A `.jsonl' file holds one record per line, a `.json' file wraps the same
+    lines into a JSON list. A trailing `.gz' compresses the output with gzip.
+    Args:
+        output_file: The file to write the records in
+        fsync_every: Number of records after which the file is flushed to disk.
+        0 leaves it to the operating system.
+    """
+
+    def __init__(self, output_file, fsync_every=0):
+        if ((not output_file) or (type(output_file) != str)):
+            raise TypeError('arg should be a valid path/file')
+
+        name = output_file[:-3] if output_file.endswith('.gz') else output_file
+        self._as_list = name.endswith('.json')
+        self._fsync_every = fsync_every
+        self.count = 0
+
+        if (output_file.endswith('.gz')):
+            self._file = gzip.open(output_file, 'wt', encoding='utf-8')
+        else:
+            self._file = open(output_file, 'w', encoding='utf-8')
+
+        if (self._as_list):
+            self._file.write('[')
+
+    def write(self, record):
+        """
+        Appends a record to the file
+        Args:
+            record: A dict of the form {id: {field: value}}
+        """
+        if (self._as_list):
+            self._file.write(',\n' if self.count else '\n')
+        self._file.write(json.dumps(record, separators=(',', ':')))
+        if (not self._as_list):
+            self._file.write('\n')
+
+        self.count += 1
+        if (self._fsync_every and (self.count % self._fsync_every == 0)):
+            self.sync()
+
+    def sync(self):
+        """
+        Flushes the records written so far to disk
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if (self._as_list):
+            self._file.write('\n]\n')
+        if (self._fsync_every):
+            self.sync()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 # Provided with a URL as argument, extracts an enhanced summary which is located on another page [level 3]
-def get_extended_summary(url):
+def get_extended_summary(url, session=None, limiter=None, cache=None, fast=False):
+    if (fast):
+        text, changed = get_page(url, session, limiter, cache)
+        return parse_summary_page(text) if (text is not None) else None
+
     try:
         summary = ''
-        bsob = get_soup_object(url)
+        bsob = get_soup_object(url, session, limiter, cache)
         summary = bsob.findAll("tr")[-1].td.get_text()
     except AttributeError as ae:
         return None
@@ -89,39 +507,96 @@ def get_extended_summary(url):
     return summary
 
 
-# Receives a list of links, it parses the relative pages [level 2]. Furthermore, it uses the filename as an ID for each record. The result is written into a JSON file.
-def retrieve_data(links):
-    data = []
+# Receives a list of links, it parses the relative pages [level 2]. Furthermore, it uses the filename as an ID for each record. The records are
+# streamed into `output_file' as soon as they are parsed (see RecordWriter), and their number is returned.
+# The summaries of a page are fetched by a pool of `workers' threads sharing one keep-alive session, at most `rate'
+# requests per second per host. Records keep the order of the index whatever the number of workers.
+# With a `cache_dir' pages are revalidated with conditional GETs, and with a `state_file' a checkpoint is written after
+# every month page: unchanged months and reports already retrieved are not downloaded again.
+# `fast' selects the single pass extraction (parse_event_page/parse_summary_page) instead of BeautifulSoup.
+@metrics.timed('scraper.retrieve_data')
+def retrieve_data(links, base_url=None, output_file='data.jsonl', workers=1, rate=None, retries=3, backoff=0.5,
+                  cache_dir=None, state_file=None, fsync_every=0, fast=True):
     tmp = []
     ids = []
+    base_url = base_url or stem
+    session = get_session(workers, retries, backoff)
+    limiter = RateLimiter(rate)
+    cache = HttpCache(cache_dir) if cache_dir else None
+    state = CrawlState(state_file) if state_file else None
+    fetch_summary = partial(get_extended_summary, session=session, limiter=limiter, cache=cache, fast=fast)
+    writer = RecordWriter(output_file, fsync_every)
 
     try:
-        for link in links:
-            inner_soup = get_soup_object(stem + link + '.html')
-            ids = extract_links(inner_soup)
-            # print(ids)
-            tmp = get_event_content(inner_soup)
-            # print(tmp)
-            if (len(ids) != len(tmp)):
-                print("Unexpected HTML format on page " + link)
-                raise
-
-            for i, j in zip(ids, range(len(tmp))):
-                tmp[j]['Summary'] = get_extended_summary(stem + i + '.html')
-                data.append({i: tmp[j]})
-
-            # print(data)
-
-        save_to_file(data)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for link in links:
+                text, changed = get_page(base_url + link + '.html', session, limiter, cache)
+                if ((state is not None) and (not changed) and state.is_complete(link)):
+                    for record in state.records(link):
+                        writer.write(record)
+                    continue
+
+                if (text is None):
+                    ids, tmp = (None, None)
+                elif (fast):
+                    ids, tmp = parse_event_page(text)
+                else:
+                    inner_soup = BeautifulSoup(text, "html.parser")
+                    ids = extract_links(inner_soup)
+                    tmp = get_event_content(inner_soup)
+                if (len(ids) != len(tmp)):
+                    # the reports can't be matched to their links, the month is left for a later crawl
+                    print("Unexpected HTML format on page " + link + ", skipped")
+                    continue
+
+                missing = [i for i in ids if (state is None) or (not state.has_report(i))]
+                # executor.map yields the summaries in the order of the ids
+                summaries = dict(zip(missing, executor.map(
+                    fetch_summary, [base_url + i + '.html' for i in missing])))
+                for i, j in zip(ids, range(len(tmp))):
+                    if (i in summaries):
+                        tmp[j]['Summary'] = summaries[i]
+                    else:
+                        # the row of the changed month page is kept, only its summary comes from the state
+                        tmp[j]['Summary'] = state.get_report(i)['Summary']
+                    if (state is not None):
+                        state.add_report(i, tmp[j])
+                    writer.write({i: tmp[j]})
+
+                if (state is not None):
+                    state.complete(link, ids)
+                    state.checkpoint()
+
     except TypeError:
         print("Cannot read from page " + link)
     finally:
-        save_to_file(data)
+        writer.close()
+        if (state is not None):
+            state.checkpoint()
+        session.close()
 
+    return writer.count
 
-# Main Block
-stem = 'http://www.nuforc.org/webreports/'
 
-outer_soup = get_soup_object(stem + "ndxevent.html")
-pages = extract_links(outer_soup)
-retrieve_data(pages)
+# Main Block
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scrapes the NUFORC reports into a JSON file')
+    parser.add_argument('--workers', type=int, default=1, help='number of concurrent requests')
+    parser.add_argument('--rate', type=float, default=None, help='maximum requests per second per host')
+    parser.add_argument('--cache-dir', default=None, help='directory of the on-disk HTTP cache')
+    parser.add_argument('--state', default=None, help='checkpoint file of a resumable crawl')
+    parser.add_argument('--output', default='data.jsonl', help='output file (.jsonl, .json, optionally .gz)')
+    parser.add_argument('--fsync-every', type=int, default=0, help='records written between two fsync calls')
+    parser.add_argument('--metrics', default=None,
+                        help='collects the request and parsing metrics into METRICS.json and METRICS.prom')
+    args = parser.parse_args()
+    if (args.metrics):
+        metrics.enable()
+
+    cache = HttpCache(args.cache_dir) if args.cache_dir else None
+    outer_soup = get_soup_object(stem + "ndxevent.html", cache=cache)
+    pages = extract_links(outer_soup)
+    retrieve_data(pages, workers=args.workers, rate=args.rate, cache_dir=args.cache_dir, state_file=args.state,
+                  output_file=args.output, fsync_every=args.fsync_every)
+    if (args.metrics):
+        metrics.write(args.metrics)
@@ -0,0 +1,339 @@
+import bisect
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class _NoStage:
+    """
+    The context manager returned by Metrics.stage while disabled
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class _Stage:
+    def __init__(self, metrics, name):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        self.peak = None
+        self._metrics._open_stage(self)
+        self._wall = time.perf_counter()
+        self._cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *args):
+        cpu = time.thread_time() - self._cpu
+        wall = time.perf_counter() - self._wall
+        self._metrics._close_stage(self)
+        self._metrics.add_stage(self._name, wall, cpu, self.peak)
+        return False
+
+
+def current_rss():
+    """
+    Returns the current resident set size of the process in bytes, None
+    where /proc is missing (e.g. macOS, Windows)
+    """
+    try:
+        with open('/proc/self/statm', 'rb') as infile:
+            return int(infile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def high_water_rss():
+    """
+    Returns the peak resident set size of the process in bytes since the last
+    reset_high_water_rss, None where /proc is missing
+    """
+    try:
+        with open('/proc/self/status', 'rb') as infile:
+            for line in infile:
+                if (line.startswith(b'VmHWM:')):
+                    # in kilobytes
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def reset_high_water_rss():
+    """
+    Resets the peak resident set size of the process to its current value
+    (Linux only). Returns False when it can't be done.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as outfile:
+            outfile.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size of the process so far in bytes, None
+    where the resource module is missing (Windows)
+    """
+    if (resource is None):
+        return None
+    # kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if (sys.platform == 'darwin') else rss * 1024
+
+
+class Metrics:
+    """
+    Opt-in collector of the timings of the stages and of the HTTP requests.
+    While disabled (the default) every call returns at once, so the
+    instrumented code pays one attribute lookup. Once enabled, the stages
+    record their wall time, the CPU time of the thread running them (so
+    concurrent stages don't count each other) and the peak RSS of the process
+    during the stage, which concurrent stages do share. On Linux the peak is
+    the high water mark of the kernel, reset when a stage starts; otherwise
+    a thread samples the RSS every sample_interval seconds while stages are
+    running, and the peak is None without /proc. The
+    requests record their latency in a histogram, and counters the bytes
+    transferred, the retries and the status codes. The summary adds the
+    process wide CPU time and peak RSS. The collector is thread safe; the
+    work done in child processes or in threads started by a stage is not
+    part of its CPU time.
+    Args:
+        buckets: The upper bounds in seconds of the latency histogram
+        sample_interval: The seconds between two samples of the RSS where the
+        high water mark can't be reset
+    """
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, buckets=None, sample_interval=0.01):
+        self.enabled = False
+        if (buckets is not None):
+            self.buckets = tuple(sorted(buckets))
+        self.sample_interval = sample_interval
+        self._lock = threading.Lock()
+        self._running = set()
+        self._reset_peak = True
+        self._sampler = None
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+        return self
+
+    def disable(self):
+        self.enabled = False
+        return self
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+            self._counters = {}
+            self._histograms = {}
+
+    def stage(self, name):
+        """
+        Returns a context manager measuring the code it wraps as the stage name
+        """
+        if (not self.enabled):
+            return _NO_STAGE
+        return _Stage(self, name)
+
+    def timed(self, name=None):
+        """
+        Decorator measuring every call of a function as a stage, named after
+        the function by default
+        """
+        def decorator(function):
+            stage_name = name or function.__qualname__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if (not self.enabled):
+                    return function(*args, **kwargs)
+                with _Stage(self, stage_name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _update_peaks(self):
+        """
+        Private method raising the peak of the running stages to the RSS
+        reached since the last update, called with the lock held
+        """
+        rss = high_water_rss() if (self._reset_peak) else current_rss()
+        if (rss is None):
+            return
+        for stage in self._running:
+            stage.peak = max(stage.peak or 0, rss)
+
+    def _open_stage(self, stage):
+        with self._lock:
+            # the peak of the running stages is kept before the reset
+            self._update_peaks()
+            if (self._reset_peak):
+                self._reset_peak = reset_high_water_rss()
+            stage.peak = current_rss()
+            self._running.add(stage)
+            if ((not self._reset_peak) and (stage.peak is not None) and (self._sampler is None)):
+                self._sampler = threading.Thread(target=self._sample, name='rss-sampler', daemon=True)
+                self._sampler.start()
+
+    def _close_stage(self, stage):
+        with self._lock:
+            self._update_peaks()
+            self._running.discard(stage)
+
+    def _sample(self):
+        """
+        Private method of the thread sampling the RSS while stages are running
+        """
+        while (True):
+            time.sleep(self.sample_interval)
+            with self._lock:
+                if (not self._running):
+                    self._sampler = None
+                    return
+                self._update_peaks()
+
+    def add_stage(self, name, wall, cpu, rss=None):
+        """
+        Adds a call of a stage: its wall and thread CPU seconds and the peak
+        RSS in bytes during the call
+        """
+        with self._lock:
+            stage = self._stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'thread_cpu_seconds': 0.0,
+                                                   'peak_rss_bytes': None})
+            stage['calls'] += 1
+            stage['wall_seconds'] += wall
+            stage['thread_cpu_seconds'] += cpu
+            if (rss is not None):
+                stage['peak_rss_bytes'] = max(stage['peak_rss_bytes'] or 0, rss)
+
+    def inc(self, name, value=1, **labels):
+        """
+        Adds value to the counter name with the given labels
+        """
+        if (not self.enabled):
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Adds a value (in seconds) to the histogram name with the given labels
+        """
+        if (not self.enabled):
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if (histogram is None):
+                histogram = self._histograms[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0,
+                                                     'count': 0}
+            # the first bucket whose bound is >= value
+            histogram['counts'][bisect.bisect_left(self.buckets, value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def summary(self):
+        """
+        Returns the collected values as a JSON serializable dict
+        """
+        def name(key):
+            labels = ','.join('{}={}'.format(k, v) for k, v in key[1])
+            return key[0] + ('{' + labels + '}' if labels else '')
+
+        with self._lock:
+            histograms = {}
+            for key, histogram in self._histograms.items():
+                histograms[name(key)] = {
+                    'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'],
+                                        histogram['counts'])),
+                    'sum': histogram['sum'], 'count': histogram['count'],
+                    'mean': histogram['sum'] / histogram['count']}
+            return {'process': {'cpu_seconds': time.process_time(), 'peak_rss_bytes': peak_rss()},
+                    'stages': {stage: dict(values) for stage, values in self._stages.items()},
+                    'counters': {name(key): value for key, value in self._counters.items()},
+                    'histograms': histograms}
+
+    def to_prometheus(self, prefix='ufo_'):
+        """
+        Returns the collected values in the Prometheus text exposition format
+        """
+        def labels(pairs, extra=()):
+            pairs = list(pairs) + list(extra)
+            if (not pairs):
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for k, v in pairs) + '}'
+
+        lines = []
+        with self._lock:
+            stages = sorted(self._stages.items())
+            for metric, kind, value in (('process_cpu_seconds_total', 'counter', time.process_time()),
+                                        ('process_peak_rss_bytes', 'gauge', peak_rss())):
+                if (value is not None):
+                    lines.append('# TYPE {}{} {}'.format(prefix, metric, kind))
+                    lines.append('{}{} {}'.format(prefix, metric, value))
+
+            for metric, field, kind in (('stage_calls_total', 'calls', 'counter'),
+                                        ('stage_wall_seconds_total', 'wall_seconds', 'counter'),
+                                        ('stage_thread_cpu_seconds_total', 'thread_cpu_seconds', 'counter'),
+                                        ('stage_peak_rss_bytes', 'peak_rss_bytes', 'gauge')):
+                if (stages):
+                    lines.append('# TYPE {}{} {}'.format(prefix, metric, kind))
+                for stage, values in stages:
+                    if (values[field] is not None):
+                        lines.append('{}{}{} {}'.format(prefix, metric, labels([('stage', stage)]), values[field]))
+
+            typed = set()
+            for (name, pairs), value in sorted(self._counters.items()):
+                if (name not in typed):
+                    lines.append('# TYPE {}{} counter'.format(prefix, name))
+                    typed.add(name)
+                lines.append('{}{}{} {}'.format(prefix, name, labels(pairs), value))
+
+            for (name, pairs), histogram in sorted(self._histograms.items()):
+                if (name not in typed):
+                    lines.append('# TYPE {}{} histogram'.format(prefix, name))
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip([str(bound) for bound in self.buckets] + ['+Inf'], histogram['counts']):
+                    cumulative += count
+                    lines.append('{}{}_bucket{} {}'.format(prefix, name, labels(pairs, [('le', bound)]), cumulative))
+                lines.append('{}{}_sum{} {}'.format(prefix, name, labels(pairs), histogram['sum']))
+                lines.append('{}{}_count{} {}'.format(prefix, name, labels(pairs), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, prefix):
+        """
+        Writes the JSON summary into prefix.json and the Prometheus text into
+        prefix.prom
+        """
+        with open(prefix + '.json', 'w') as outfile:
+            json.dump(self.summary(), outfile, indent=2, sort_keys=True)
+        with open(prefix + '.prom', 'w') as outfile:
+            outfile.write(self.to_prometheus())
+
+
+_NO_STAGE = _NoStage()
+
+# The collector shared by the scraper and the munging code
+metrics = Metrics()
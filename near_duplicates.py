@@ -0,0 +1,177 @@
+import numpy as np
+import pandas as pd
+import logging
+
+
+class NearDuplicates:
+    """
+    Finds the reports filed several times with slightly different wording.
+    The summaries are represented by the MinHash signatures of their
+    character shingles, and only the reports of the same block (state, day)
+    whose signatures share a band (locality sensitive hashing) are compared,
+    so the cost grows with the number of reports rather than with the pairs.
+    Two reports are near duplicates when the estimated Jaccard similarity of
+    their shingles reaches the threshold; the clusters are the connected
+    groups of near duplicates.
+    Args:
+        num_perm: The number of hash functions of the signatures
+        bands: The number of LSH bands, which must divide num_perm
+        shingle: The number of characters of the shingles
+        threshold: The minimum estimated similarity of near duplicates
+        seed: The seed of the hash functions, the same seed gives the same signatures
+    """
+
+    def __init__(self, num_perm=64, bands=16, shingle=5, threshold=0.5, seed=1):
+        self.log = logging.getLogger(self.__class__.__name__)
+        if ((num_perm < 1) or (bands < 1) or (num_perm % bands)):
+            raise ValueError('bands should divide num_perm')
+        if ((shingle < 1) or (not 0 < threshold <= 1)):
+            raise ValueError('shingle should be positive and threshold in (0, 1]')
+
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle = shingle
+        self.threshold = threshold
+        rnd = np.random.RandomState(seed)
+        # multiply-shift hash functions: odd 64 bits multipliers, the high 32 bits are kept
+        self._a = rnd.randint(0, 1 << 62, num_perm).astype(np.uint64) * np.uint64(4) + np.uint64(1)
+        self._b = rnd.randint(0, 1 << 62, num_perm).astype(np.uint64)
+        self._band_mix = rnd.randint(1, 1 << 62, num_perm // bands).astype(np.uint64) | np.uint64(1)
+
+    @staticmethod
+    def normalize(texts):
+        """
+        Returns the texts in lower case, every run of other characters than
+        letters and digits being a single space
+        """
+        texts = pd.Series(texts, dtype=object).fillna('').astype(str).str.lower()
+        return texts.str.replace(r'[^a-z0-9]+', ' ', regex=True).str.strip()
+
+    def signatures(self, texts, batch_size=10000):
+        """
+        Returns the MinHash signatures of the texts as an array of shape
+        (len(texts), num_perm). The texts shorter than a shingle get a row of
+        2**32 - 1 and are never near duplicates.
+        Args:
+            texts: A list or Series of strings (missing values allowed)
+            batch_size: The number of texts hashed at a time
+        """
+        texts = self.normalize(texts).tolist()
+        result = np.full((len(texts), self.num_perm), np.iinfo(np.uint32).max, dtype=np.uint32)
+        for start in range(0, len(texts), batch_size):
+            self._sign(texts[start:start + batch_size], result[start:start + batch_size])
+        return result
+
+    def _sign(self, texts, out):
+        """
+        Private method writing the signatures of a batch of texts into out
+        """
+        # the normalized texts are ASCII, one byte per character
+        data = np.frombuffer('\n'.join(texts).encode('ascii'), dtype=np.uint8).astype(np.uint64)
+        lengths = np.array([len(text) for text in texts], dtype=np.int64)
+        ends = np.cumsum(lengths + 1) - 1
+        starts = ends - lengths
+        windows = np.maximum(lengths - self.shingle + 1, 0)
+        if (not windows.sum()):
+            return
+
+        # rolling polynomial hash of every shingle inside a text
+        doc = np.repeat(np.arange(len(texts)), windows)
+        position = np.arange(windows.sum()) - np.repeat(np.cumsum(windows) - windows, windows) + starts[doc]
+        hashes = np.zeros(len(position), dtype=np.uint64)
+        for j in range(self.shingle):
+            hashes = (hashes * np.uint64(257) + data[position + j]) & np.uint64(0xFFFFFFFF)
+
+        first = np.cumsum(windows) - windows
+        signed = windows > 0
+        for i in range(self.num_perm):
+            values = (self._a[i] * hashes + self._b[i]) >> np.uint64(32)
+            out[signed, i] = np.minimum.reduceat(values, first[signed])
+
+    @staticmethod
+    def blocks(df):
+        """
+        Returns the block number of each report of df, the reports of the same
+        state and day sharing their block, -1 when the state or the date is
+        missing
+        Args:
+            df: A dataframe with the columns state and datetime
+        """
+        state = df['state'].astype(object).fillna('').astype(str).str.strip().str.upper()
+        day = pd.to_datetime(df['datetime']).dt.floor('D')
+        codes, uniques = pd.factorize(pd.MultiIndex.from_arrays([state.values, day.values]))
+        return np.where((state.values != '') & day.notna().values, codes, -1)
+
+    def clusters(self, ids, blocks, signatures):
+        """
+        Returns the cluster of each report: the smallest report ID of its
+        group of near duplicates, its own ID when it has none. The result
+        doesn't depend on the order of the reports.
+        Args:
+            ids: The report IDs
+            blocks: The block numbers returned by blocks
+            signatures: The signatures returned by signatures
+        """
+        ids = np.asarray(ids, dtype=object)
+        order = np.argsort(ids.astype(str), kind='stable')
+        ids, blocks, signatures = ids[order], np.asarray(blocks)[order], signatures[order]
+        n = len(ids)
+
+        empty = (signatures == np.iinfo(np.uint32).max).all(axis=1)
+        valid = np.flatnonzero((blocks >= 0) & ~empty)
+        rows = signatures.shape[1] // self.bands
+        candidates = []
+        for band in range(self.bands):
+            values = signatures[valid, band * rows:(band + 1) * rows].astype(np.uint64)
+            keys = (values * self._band_mix).sum(axis=1)
+            # the reports of the same block and band values are consecutive once sorted
+            sorting = np.lexsort((valid, keys, blocks[valid]))
+            members, group_keys = valid[sorting], np.c_[blocks[valid][sorting], keys[sorting]]
+            starts = np.r_[True, (group_keys[1:] != group_keys[:-1]).any(axis=1)]
+            # the end of the bucket of each member
+            end = np.r_[np.flatnonzero(starts)[1:], len(members)][np.cumsum(starts) - 1]
+            # every pair of a bucket, at the distance d in the sorted members
+            position = np.arange(len(members))
+            d = 1
+            while (True):
+                position = position[position + d < end[position]]
+                if (not len(position)):
+                    break
+                candidates.append(members[position] * n + members[position + d])
+                d += 1
+
+        left = right = np.arange(n)[:0]
+        if (candidates):
+            pairs = np.unique(np.concatenate(candidates))
+            a, b = pairs // n, pairs % n
+            similar = (signatures[a] == signatures[b]).mean(axis=1) >= self.threshold
+            left, right = a[similar], b[similar]
+
+        labels = np.arange(n)
+        while (True):
+            # every report points to the smallest one it is connected to
+            new = labels.copy()
+            np.minimum.at(new, left, labels[right])
+            np.minimum.at(new, right, labels[left])
+            new = new[new]
+            if (np.array_equal(new, labels)):
+                break
+            labels = new
+
+        result = np.empty(n, dtype=object)
+        result[order] = ids[labels]
+        self.log.info('%s of %s reports are near duplicates of another one', int((labels != np.arange(n)).sum()), n)
+        return result
+
+    def find(self, df, key='id', text='summary'):
+        """
+        Returns the clusters of the reports of df as a Series aligned on df
+        Args:
+            df: A dataframe with the columns key, text, state and datetime
+            key: The column holding the report IDs
+            text: The column holding the summaries
+        """
+        if ((type(df) != pd.DataFrame) or (key not in df.columns) or (text not in df.columns)):
+            raise ValueError('Function signature is (DataFrame, key column, text column)')
+        clusters = self.clusters(df[key].astype(str).values, self.blocks(df), self.signatures(df[text]))
+        return pd.Series(clusters, index=df.index, name='cluster')
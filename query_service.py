@@ -0,0 +1,365 @@
+import numpy as np
+import pandas as pd
+import logging
+import argparse
+import json
+import os
+import threading
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from data_munging import Aggregates, Coordinates, TimeSerie
+from metrics import metrics
+
+
+class LRUCache:
+    """
+    Thread safe cache of the encoded responses, the least recently used ones
+    being evicted once their total size exceeds max_bytes.
+    Args:
+        max_bytes: The maximum total size of the cached values
+    """
+
+    def __init__(self, max_bytes=32 << 20):
+        if ((type(max_bytes) != int) or (max_bytes < 0)):
+            raise ValueError('max_bytes should be a positive integer')
+
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Returns the value of key, None when it is not cached
+        """
+        with self._lock:
+            value = self._items.get(key)
+            if (value is None):
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Caches value (bytes) under key, unless it is larger than the cache
+        """
+        if (len(value) > self.max_bytes):
+            return
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if (previous is not None):
+                self.size -= len(previous)
+            self._items[key] = value
+            self.size += len(value)
+            while (self.size > self.max_bytes):
+                key, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._items), 'bytes': self.size, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class QueryService:
+    """
+    Answers the dashboard queries (county counts, time series per state and
+    top N) from the counts of Aggregates held in memory, so no JSON output is
+    parsed again. The counts per (day, county, state) are read once from the
+    ledger and every query filters them on the date window and the states.
+    The encoded answers are kept in an LRU cache which is emptied whenever
+    the counts are loaded again: by load, or at the next query after the
+    SQLite file was modified (e.g. by data_munging).
+    Args:
+        aggregates_path: The SQLite file written by the aggregates stage
+        counties_file: The CSV file of the counties
+        cache_dir: The cache directory of the parsed polygons
+        cache_bytes: The size of the cache of the answers
+    """
+
+    queries = ('counties', 'timeseries', 'top')
+
+    def __init__(self, aggregates_path, counties_file, cache_dir=None, cache_bytes=32 << 20):
+        self.log = logging.getLogger(self.__class__.__name__)
+        if ((not aggregates_path) or (type(aggregates_path) != str)):
+            raise TypeError('arg should be a valid path/file')
+
+        self._path = aggregates_path
+        self._coord = Coordinates(counties_file, cache_dir=cache_dir)
+        self._counties = self._coord.get_counties().sort_values(['city', 'state', 'county'], kind='stable')
+        self._counties = self._counties.reset_index(drop=True)
+        self.cache = LRUCache(cache_bytes)
+        self._lock = threading.Lock()
+        self._version = None
+        self.generation = 0
+        self.load()
+
+    def file_version(self):
+        """
+        Returns the modification time and size of the SQLite file
+        """
+        try:
+            stat = os.stat(self._path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def load(self, df=None, key='id'):
+        """
+        Reads the counts again and empties the cache. The reports of df, if
+        given, are first applied to the aggregates.
+        Args:
+            df: A dataframe of new or changed reports, see Aggregates.apply
+            key: The column holding the report IDs
+        """
+        with self._lock:
+            # a connection per load, the queries run in the threads of the server
+            aggregates = Aggregates(self._path)
+            try:
+                if (df is not None):
+                    aggregates.apply(df, key)
+                counts = aggregates.day_places()
+            finally:
+                aggregates.close()
+
+            counts['key'] = self._coord.lookup(counts)
+            counts['state'] = counts['state'].astype(str)
+            self._counts = counts[['datetime', 'key', 'state', 'reports']]
+            self._version = self.file_version()
+            self.generation += 1
+            self.cache.clear()
+        self.log.info('%s counts loaded from %s', len(counts), self._path)
+
+    def refresh(self):
+        """
+        Loads the counts again if the SQLite file changed since the last load
+        """
+        if (self.file_version() != self._version):
+            self.load()
+
+    def _filter(self, begin=None, end=None, states=None):
+        """
+        Private method returning the counts of the days between begin and end
+        included and of the given states. The counts without date are only
+        kept when the window has no bound.
+        """
+        counts = self._counts
+        mask = np.ones(len(counts), dtype=bool)
+        if (begin is not None):
+            mask &= (counts['datetime'] >= pd.Timestamp(begin).normalize()).values
+        if (end is not None):
+            mask &= (counts['datetime'] <= pd.Timestamp(end).normalize()).values
+        if (states):
+            mask &= counts['state'].isin(states).values
+        return counts[mask]
+
+    def counties(self, begin=None, end=None, states=None, geometry=False):
+        """
+        Returns the number of reports of every county as a dataframe with the
+        columns city, state and reports (0 for the counties without report),
+        as geo_reports.json.
+        Args:
+            begin, end: The first and last days, None for no bound
+            states: A list of states, all the counties by default
+            geometry: Adds the longitude and latitude lists of the counties
+        """
+        counts = self._filter(begin, end, states)
+        reports = counts['reports'].groupby(counts['key'].values).sum()
+        result = self._counties
+        if (states):
+            result = result[result['state'].isin(states)]
+        result = result.reset_index(drop=True)
+        result['reports'] = reports.reindex(result['key'].values, fill_value=0).values.astype(np.int64)
+        if (geometry):
+            coordinates = [self._coord.county_coordinates(i) for i in result['county']]
+            result['longitude'] = [lon.tolist() for lon, lat in coordinates]
+            result['latitude'] = [lat.tolist() for lon, lat in coordinates]
+        return result.drop(['county', 'key'], axis=1)
+
+    def timeseries(self, begin=None, end=None, states=None, freq='day'):
+        """
+        Returns the number of reports per date and state as a dataframe with
+        the columns datetime, state and reports, as ts_reports.json.
+        Args:
+            begin, end: The first and last days, the whole data by default
+            states: A list of states, all of them by default
+            freq: The size of the buckets: hour, day, week or month
+        """
+        if (freq not in TimeSerie.frequencies):
+            raise ValueError('freq should be one of ' + ', '.join(TimeSerie.frequencies))
+        counts = self._filter(begin, end, states)
+        counts = counts[counts['datetime'].notna()]
+        if (not len(counts)):
+            return pd.DataFrame({'datetime': [], 'state': [], 'reports': []})
+
+        begin = counts['datetime'].min() if (begin is None) else pd.Timestamp(begin)
+        end = counts['datetime'].max() if (end is None) else pd.Timestamp(end)
+        ts = TimeSerie(begin, end)
+        ts.combine_with(counts, 'reports', 'sum', freq=freq)
+        return ts.get_ts()
+
+    def top(self, n=10, begin=None, end=None, states=None, by='county'):
+        """
+        Returns the n counties (columns city, state and reports) or states
+        (columns state and reports) with the most reports.
+        Args:
+            n: The number of rows returned
+            begin, end: The first and last days, None for no bound
+            states: A list of states, all of them by default
+            by: county or state
+        """
+        if (by == 'county'):
+            result = self.counties(begin, end, states)
+        elif (by == 'state'):
+            counts = self._filter(begin, end, states)
+            result = counts.groupby('state', as_index=False)['reports'].sum()
+        else:
+            raise ValueError('by should be county or state')
+        if (n < 0):
+            raise ValueError('n should be positive')
+        return result.sort_values('reports', ascending=False, kind='stable').head(n).reset_index(drop=True)
+
+    def query(self, name, params):
+        """
+        Returns the answer of a query as JSON records (bytes), from the cache
+        when the same query was answered since the counts were loaded.
+        Args:
+            name: One of counties, timeseries and top
+            params: A dict of the lists of values of the query string
+        """
+        if (name not in self.queries):
+            raise KeyError(name)
+        self.refresh()
+
+        def value(field, default=None):
+            values = params.get(field)
+            return values[-1] if values else default
+
+        states = sorted({state.strip().upper() for values in params.get('state', [])
+                         for state in values.split(',') if state.strip()})
+        try:
+            begin = pd.Timestamp(value('begin')) if value('begin') else None
+            end = pd.Timestamp(value('end')) if value('end') else None
+            n = int(value('n', 10))
+        except ValueError:
+            raise ValueError('begin and end should be dates and n an integer')
+        if ((begin is not None) and (end is not None) and (begin > end)):
+            raise ValueError('begin cannot be after end')
+
+        generation = self.generation
+        key = (generation, name, begin, end, tuple(states), value('freq', 'day'),
+               value('geometry', '0') in ('1', 'true'), n, value('by', 'county'))
+        body = self.cache.get(key)
+        if (body is not None):
+            metrics.inc('query_cache_hits_total', query=name)
+            return body
+        metrics.inc('query_cache_misses_total', query=name)
+
+        with metrics.stage('query.' + name):
+            if (name == 'counties'):
+                result = self.counties(begin, end, states, geometry=key[6])
+            elif (name == 'timeseries'):
+                result = self.timeseries(begin, end, states, freq=key[5])
+            else:
+                result = self.top(n, begin, end, states, by=key[8])
+            body = result.to_json(orient='records').encode('utf-8')
+        # the answers computed while the counts were loaded again are not kept
+        if (generation == self.generation):
+            self.cache.put(key, body)
+        return body
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    HTTP interface of the QueryService of the server:
+        GET /counties?begin=&end=&state=&geometry=1
+        GET /timeseries?begin=&end=&state=&freq=
+        GET /top?n=&by=county|state&begin=&end=&state=
+        GET /stats returns the statistics of the cache
+        POST /reload loads the counts again
+    The states are given as state=CA&state=NV or state=CA,NV.
+    """
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        name = url.path.strip('/')
+        if (name == 'stats'):
+            stats = dict(self.server.service.cache.stats(), generation=self.server.service.generation)
+            self.reply(200, json.dumps(stats).encode('utf-8'))
+            return
+        try:
+            body = self.server.service.query(name, parse_qs(url.query))
+        except KeyError:
+            self.reply(404, json.dumps({'error': 'unknown query ' + name}).encode('utf-8'))
+            return
+        except ValueError as e:
+            self.reply(400, json.dumps({'error': str(e)}).encode('utf-8'))
+            return
+        self.reply(200, body)
+
+    def do_POST(self):
+        if (urlsplit(self.path).path.strip('/') != 'reload'):
+            self.reply(404, json.dumps({'error': 'unknown action'}).encode('utf-8'))
+            return
+        self.server.service.load()
+        self.reply(200, json.dumps({'generation': self.server.service.generation}).encode('utf-8'))
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger(self.__class__.__name__).debug(format, *args)
+
+
+def make_server(service, host='127.0.0.1', port=8050):
+    """
+    Returns the threaded HTTP server of a QueryService, port 0 picking a free
+    port
+    """
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serves the report counts to the dashboards')
+    parser.add_argument('--aggregates', default='aggregates.sqlite', help='the SQLite file of the counts')
+    parser.add_argument('--counties', default='data/US_Counties.csv', help='the counties geometry')
+    parser.add_argument('--cache-dir', default='data/cache', help='where the parsed polygons are cached')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--cache-mb', type=int, default=32, help='size of the cache of the answers')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    service = QueryService(args.aggregates, args.counties, args.cache_dir, cache_bytes=args.cache_mb << 20)
+    server = make_server(service, args.host, args.port)
+    logging.getLogger('query_service').info('Serving on http://%s:%s', *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
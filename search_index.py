@@ -0,0 +1,373 @@
+import numpy as np
+import pandas as pd
+import logging
+import json
+import os
+import re
+import zlib
+
+
+def tokenize(text):
+    """
+    Returns the list of lower case words and numbers of a text, apostrophes
+    being removed ("didn't" gives "didnt")
+    Args:
+        text: A string, None or NaN give no tokens
+    """
+    if (not isinstance(text, str)):
+        return []
+    return re.findall(r'[a-z0-9]+', text.lower().replace("'", ''))
+
+
+def parse_query(query):
+    """
+    Splits a query into its keywords and its phrases, the phrases being the
+    parts between double quotes. Returns (keywords, phrases), each phrase
+    being a list of tokens.
+    Args:
+        query: A string such as 'orange "three lights" hovering'
+    """
+    phrases = [tokenize(phrase) for phrase in re.findall(r'"([^"]*)"', query)]
+    keywords = tokenize(re.sub(r'"[^"]*"', ' ', query))
+    return (keywords, [phrase for phrase in phrases if phrase])
+
+
+class Segment:
+    """
+    An immutable part of the index. The postings of all the terms are held in
+    a few contiguous arrays: the postings of the term t are at
+    term_offsets[t]:term_offsets[t + 1] of docs (local document numbers) and
+    tfs (term frequencies), and its positions, in the same order, at
+    pos_offsets[t]:pos_offsets[t + 1] of positions.
+    Args:
+        arrays: A dict of the arrays of the segment, as written by save
+    """
+
+    fields = ['terms', 'term_offsets', 'docs', 'tfs', 'pos_offsets', 'positions',
+              'ids', 'states', 'shapes', 'dates', 'lengths', 'checksums']
+
+    def __init__(self, arrays):
+        for field in self.fields:
+            setattr(self, field, arrays[field])
+        self.vocabulary = {term: i for i, term in enumerate(self.terms.tolist())}
+
+    @classmethod
+    def build(cls, tokens, ids, states, shapes, dates, checksums):
+        """
+        Builds a segment from the tokens of each document
+        Args:
+            tokens: A list of lists of tokens, one per document
+            ids, states, shapes, dates, checksums: The fields of the documents
+        """
+        vocabulary = {}
+        codes = [[vocabulary.setdefault(token, len(vocabulary)) for token in doc] for doc in tokens]
+        lengths = np.array([len(doc) for doc in codes], dtype=np.uint32)
+        terms = np.array(list(vocabulary), dtype=str)
+        term = np.fromiter((code for doc in codes for code in doc), dtype=np.int64, count=int(lengths.sum()))
+        doc = np.repeat(np.arange(len(codes), dtype=np.int64), lengths)
+        position = np.arange(len(term), dtype=np.int64) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return cls(cls.arrays_from_tokens(terms, term, doc, position, {
+            'ids': np.array(ids, dtype=str), 'states': np.array(states, dtype=str),
+            'shapes': np.array(shapes, dtype=str), 'dates': np.array(dates, dtype='datetime64[s]'),
+            'lengths': lengths, 'checksums': np.array(checksums, dtype=np.uint32)}))
+
+    @staticmethod
+    def arrays_from_tokens(terms, term, doc, position, documents):
+        """
+        Returns the arrays of a segment from one entry per token: its term
+        number in terms, its document and its position
+        """
+        order = np.lexsort((position, doc, term))
+        term, doc, position = term[order], doc[order], position[order]
+
+        new_posting = np.ones(len(term), dtype=bool)
+        new_posting[1:] = (term[1:] != term[:-1]) | (doc[1:] != doc[:-1])
+        starts = np.flatnonzero(new_posting)
+        tfs = np.diff(np.r_[starts, len(term)]).astype(np.uint32)
+        posting_term = term[starts]
+
+        arrays = {
+            'terms': terms,
+            'term_offsets': np.searchsorted(posting_term, np.arange(len(terms) + 1)).astype(np.int64),
+            'docs': doc[starts].astype(np.uint32),
+            'tfs': tfs,
+            'pos_offsets': np.searchsorted(term, np.arange(len(terms) + 1)).astype(np.int64),
+            'positions': position.astype(np.uint32)}
+        arrays.update(documents)
+        return arrays
+
+    def postings(self, token):
+        """
+        Returns the local document numbers and frequencies of a term, empty
+        arrays when the segment doesn't contain it
+        """
+        t = self.vocabulary.get(token)
+        if (t is None):
+            return (self.docs[:0], self.tfs[:0])
+        return (self.docs[self.term_offsets[t]:self.term_offsets[t + 1]],
+                self.tfs[self.term_offsets[t]:self.term_offsets[t + 1]])
+
+    def phrase_docs(self, phrase):
+        """
+        Returns the sorted local numbers of the documents containing the
+        tokens of phrase one after the other
+        """
+        keys = None
+        for i, token in enumerate(phrase):
+            t = self.vocabulary.get(token)
+            if (t is None):
+                return self.docs[:0]
+            docs, tfs = self.postings(token)
+            positions = self.positions[self.pos_offsets[t]:self.pos_offsets[t + 1]].astype(np.int64)
+            # (document, position of the first token) of every occurrence
+            start = (np.repeat(docs.astype(np.int64), tfs) << 32) + positions - i
+            keys = start if (keys is None) else np.intersect1d(keys, start, assume_unique=False)
+        return np.unique(keys >> 32).astype(np.uint32)
+
+    def save(self, path):
+        np.savez_compressed(path, **{field: getattr(self, field) for field in self.fields})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls({field: arrays[field] for field in cls.fields})
+
+
+class SearchIndex:
+    """
+    Inverted index over the summaries of the reports, ranked with BM25. The
+    index is made of segments: every call to add indexes the new or changed
+    reports into a new segment and marks their previous versions as deleted,
+    so updates never rewrite the existing postings. merge compacts the
+    segments into one. The index is persisted in a directory holding one
+    compressed .npz file per segment and an index.json file.
+    Args:
+        path: The directory of the index, created if needed
+        k1, b: The BM25 parameters
+    """
+
+    def __init__(self, path, k1=1.2, b=0.75):
+        self.log = logging.getLogger(self.__class__.__name__)
+        if ((not path) or (type(path) != str)):
+            raise TypeError('arg should be a valid path')
+
+        self._path = path
+        self.k1 = k1
+        self.b = b
+        self._segments = []
+        self._names = []
+        self._deleted = []
+        self._where = {}
+        self._length = 0
+
+        meta_file = os.path.join(path, 'index.json')
+        if (os.path.isfile(meta_file)):
+            with open(meta_file, 'r') as infile:
+                meta = json.load(infile)
+            for entry in meta['segments']:
+                segment = Segment.load(os.path.join(path, entry['name']))
+                deleted = np.zeros(len(segment.ids), dtype=bool)
+                deleted[entry['deleted']] = True
+                self._append(segment, entry['name'], deleted)
+            self.log.info('Index of %s reports loaded from %s', len(self), path)
+
+    def __len__(self):
+        return len(self._where)
+
+    def _append(self, segment, name, deleted):
+        number = len(self._segments)
+        self._segments.append(segment)
+        self._names.append(name)
+        self._deleted.append(deleted)
+        self._length += int(segment.lengths[~deleted].sum())
+        for local in np.flatnonzero(~deleted):
+            self._where[segment.ids[local]] = (number, local)
+
+    @staticmethod
+    def checksum(summary, state, shape, date):
+        return zlib.crc32('{}|{}|{}|{}'.format(summary, state, shape, date).encode('utf-8'))
+
+    def add(self, df, key='id', text='summary'):
+        """
+        Indexes the reports of df which are new or changed since they were
+        indexed and returns their number. The optional columns state, shape
+        and datetime are kept for filtering.
+        Args:
+            df: A dataframe with the columns key and text
+            key: The column holding the report IDs
+            text: The column holding the summaries
+        """
+        if ((type(df) != pd.DataFrame) or (key not in df.columns) or (text not in df.columns)):
+            raise ValueError('Function signature is (DataFrame, key column, text column)')
+
+        ids = df[key].astype(str).tolist()
+        states = self._column(df, 'state').str.upper().tolist()
+        shapes = self._column(df, 'shape').str.lower().tolist()
+        dates = pd.to_datetime(df['datetime']).values if ('datetime' in df.columns) else \
+            np.full(len(df), np.datetime64('NaT'))
+        summaries = df[text].tolist()
+
+        # the last version of each report, if it differs from the indexed one
+        latest = {}
+        for i, report_id in enumerate(ids):
+            latest[report_id] = i
+        rows = []
+        checksums = []
+        for report_id, i in latest.items():
+            checksum = self.checksum(summaries[i], states[i], shapes[i], dates[i])
+            where = self._where.get(report_id)
+            if ((where is None) or (self._segments[where[0]].checksums[where[1]] != checksum)):
+                rows.append(i)
+                checksums.append(checksum)
+        if (not rows):
+            return 0
+
+        for i in rows:
+            where = self._where.pop(ids[i], None)
+            if (where is not None):
+                self._deleted[where[0]][where[1]] = True
+                self._length -= int(self._segments[where[0]].lengths[where[1]])
+
+        segment = Segment.build([tokenize(summaries[i]) for i in rows], [ids[i] for i in rows],
+                                [states[i] for i in rows], [shapes[i] for i in rows],
+                                dates[rows], checksums)
+        self._append(segment, None, np.zeros(len(rows), dtype=bool))
+        self.log.info('%s reports indexed', len(rows))
+        return len(rows)
+
+    @staticmethod
+    def _column(df, column):
+        if (column not in df.columns):
+            return pd.Series('', index=df.index)
+        return df[column].astype(object).fillna('').astype(str).str.strip()
+
+    def merge(self):
+        """
+        Rewrites all the segments into a single one without the deleted
+        reports
+        """
+        if ((len(self._segments) < 2) and not any(deleted.any() for deleted in self._deleted)):
+            return
+
+        terms = {}
+        parts = []
+        documents = {field: [] for field in ['ids', 'states', 'shapes', 'dates', 'lengths', 'checksums']}
+        base = 0
+        for segment, deleted in zip(self._segments, self._deleted):
+            keep = ~deleted
+            renumber = np.cumsum(keep) - 1 + base
+            codes = np.array([terms.setdefault(term, len(terms)) for term in segment.terms.tolist()],
+                             dtype=np.int64)
+            counts = np.diff(segment.pos_offsets)
+            term = np.repeat(codes, counts)
+            doc = np.repeat(segment.docs.astype(np.int64), segment.tfs)
+            live = keep[doc]
+            parts.append((term[live], renumber[doc[live]], segment.positions[live].astype(np.int64)))
+            for field in documents:
+                documents[field].append(getattr(segment, field)[keep])
+            base += int(keep.sum())
+
+        term, doc, position = (np.concatenate([part[i] for part in parts]) for i in range(3))
+        documents = {field: np.concatenate(values) for field, values in documents.items()}
+        segment = Segment(Segment.arrays_from_tokens(np.array(list(terms), dtype=str), term, doc,
+                                                     position, documents))
+
+        self._segments, self._names, self._deleted, self._where = [], [], [], {}
+        self._length = 0
+        self._append(segment, None, np.zeros(len(segment.ids), dtype=bool))
+
+    def save(self):
+        """
+        Writes the segments added since the last save and the deletions
+        """
+        os.makedirs(self._path, exist_ok=True)
+        for number in range(len(self._segments)):
+            if (self._names[number] is None):
+                name = 'segment_{}_{}.npz'.format(number, os.urandom(4).hex())
+                self._segments[number].save(os.path.join(self._path, name))
+                self._names[number] = name
+
+        meta = {'segments': [{'name': name, 'deleted': np.flatnonzero(deleted).tolist()}
+                             for name, deleted in zip(self._names, self._deleted)]}
+        tmp_file = os.path.join(self._path, 'index.json.tmp')
+        with open(tmp_file, 'w') as outfile:
+            json.dump(meta, outfile)
+        os.replace(tmp_file, os.path.join(self._path, 'index.json'))
+
+        # the segments replaced by a merge
+        for name in os.listdir(self._path):
+            if (name.endswith('.npz') and (name not in self._names)):
+                os.remove(os.path.join(self._path, name))
+
+    def search(self, query, n=10, state=None, shape=None, begin=None, end=None):
+        """
+        Returns the n reports best matching the query, ranked by BM25, as a
+        dataframe with the columns id, score, state, shape and datetime.
+        A report matches when it contains every keyword and every phrase
+        (between double quotes) of the query.
+        Args:
+            query: The keywords and phrases, e.g. 'orange "three lights"'
+            n: The number of reports returned
+            state, shape: Keep only the reports of this state / shape
+            begin, end: Keep only the reports of this date range (inclusive)
+        """
+        keywords, phrases = parse_query(query)
+        terms = list(dict.fromkeys(keywords + [token for phrase in phrases for token in phrase]))
+        columns = ['id', 'score', 'state', 'shape', 'datetime']
+        if (not terms):
+            return pd.DataFrame(columns=columns)
+
+        total = len(self._where)
+        average = max(self._length / max(total, 1), 1.0)
+        # the deleted versions of the reports don't count, so merging doesn't change the scores
+        frequencies = {term: sum(int((~deleted[segment.postings(term)[0]]).sum())
+                                 for segment, deleted in zip(self._segments, self._deleted))
+                       for term in terms}
+        idf = {term: np.log(1 + (total - df + 0.5) / (df + 0.5)) for term, df in frequencies.items()}
+
+        # only the postings of the query terms are read, never all the documents
+        results = []
+        for segment, deleted in zip(self._segments, self._deleted):
+            candidates = None
+            for term in terms:
+                docs = segment.postings(term)[0]
+                if (candidates is not None):
+                    docs = np.intersect1d(candidates, docs, assume_unique=True)
+                candidates = docs
+            for phrase in phrases:
+                candidates = np.intersect1d(candidates, segment.phrase_docs(phrase), assume_unique=True)
+            candidates = candidates[~deleted[candidates]]
+            candidates = candidates[self._filter(segment, candidates, state, shape, begin, end)]
+            if (not len(candidates)):
+                continue
+
+            scores = np.zeros(len(candidates))
+            norm = self.k1 * (1 - self.b + self.b * segment.lengths[candidates] / average)
+            for term in terms:
+                docs, tfs = segment.postings(term)
+                tfs = tfs[np.searchsorted(docs, candidates)].astype(np.float64)
+                scores += idf[term] * tfs * (self.k1 + 1) / (tfs + norm)
+            results.append(pd.DataFrame({'id': segment.ids[candidates], 'score': scores,
+                                         'state': segment.states[candidates], 'shape': segment.shapes[candidates],
+                                         'datetime': segment.dates[candidates].astype('datetime64[ns]')}))
+
+        found = pd.concat(results, ignore_index=True) if results else pd.DataFrame(columns=columns)
+        found = found.sort_values(['score', 'id'], ascending=[False, True], kind='stable')
+        return found.head(n).reset_index(drop=True)
+
+    @staticmethod
+    def _filter(segment, docs, state, shape, begin, end):
+        """
+        Returns the mask of the local documents docs matching the filters
+        """
+        mask = np.ones(len(docs), dtype=bool)
+        if (state is not None):
+            mask &= (segment.states[docs] == state.upper())
+        if (shape is not None):
+            mask &= (segment.shapes[docs] == shape.lower())
+        if (begin is not None):
+            mask &= (segment.dates[docs] >= np.datetime64(pd.Timestamp(begin), 's'))
+        if (end is not None):
+            # end is a day, the reports of the whole day are kept
+            mask &= (segment.dates[docs] < np.datetime64(pd.Timestamp(end) + pd.Timedelta(days=1), 's'))
+        return mask
@@ -4,10 +4,137 @@ import pandas as pd
 import numpy as np
 import pymongo
 from io import StringIO
-from pandas.testing import assert_frame_equal
-from pymongo.errors import BulkWriteError
-from data_munging import JsonData, DataBase, Coordinates, TimeSerie
+from pandas.testing import assert_frame_equal, assert_series_equal
+from pymongo.errors import BulkWriteError, PyMongoError
+from data_munging import (JsonData, DataBase, Coordinates, TimeSerie, Aggregates, CountCube, Pipeline,
+                          PartialCounts, partitioned_counts,
+                          iter_records, iter_json_list, parse_dates, parse_durations,
+                          read_arrow, list_buffers)
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from bs4 import BeautifulSoup
+from functools import partial
+import benchmarks
+import data_munging
+import data_scrapper
+from metrics import Metrics, current_rss, metrics
+from search_index import SearchIndex, tokenize, parse_query
+from near_duplicates import NearDuplicates
+from query_service import LRUCache, QueryService, make_server
+import json
+import logging
 import os
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import zlib
+from unittest import mock
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+def build_fixture_pages():
+    """
+    Builds a small copy of the NUFORC website: an index page, two month pages
+    and one summary page per report. Returns a dict {path: html}.
+    """
+    pages = {}
+    index = '<html><body><table>'
+    for month, days in (('201711', range(1, 4)), ('201710', range(1, 3))):
+        index += '<tr><td><a href="ndxe' + month + '.html">' + month + '</a></td></tr>'
+        rows = ''
+        for day in days:
+            report = month[2:4] + month[4:] + '/S' + month[2:] + '%02d' % day
+            rows += ('<tr><td><a href="' + report + '.html">' + month[4:] + '/' + str(day) +
+                     '/' + month[2:4] + ' 04:30</a></td><td>St. Louis</td><td>MO</td>'
+                     '<td>Light</td><td>1 hour</td><td>Short text ' + report + '</td>'
+                     '<td>' + month[4:] + '/' + str(day) + '/' + month[2:4] + '</td></tr>')
+            pages[report + '.html'] = ('<html><body><table><tr><td>header</td></tr>'
+                                       '<tr><td>Long summary of ' + report + '</td></tr>'
+                                       '</table></body></html>')
+        pages['ndxe' + month + '.html'] = (
+            '<html><body><table><thead><tr>\n<th>Date / Time</th>\n<th>City</th>\n'
+            '<th>State</th>\n<th>Shape</th>\n<th>Duration</th>\n<th>Summary</th>\n'
+            '<th>Posted</th>\n</tr></thead><tbody>' + rows + '</tbody></table></body></html>')
+    pages['ndxevent.html'] = index + '</table></body></html>'
+    return pages
+
+
+def write_counties_csv(path, counties=None):
+    """
+    Writes a CSV file in the format of US_Counties.csv. Each county is given as
+    (name, state, [rings]), a ring being a list of (longitude, latitude).
+    """
+    if (counties is None):
+        counties = [('St. Louis', 'MO', [[(-90.1, 38.6), (-90.2, 38.7), (-90.3, 38.6), (-90.1, 38.6)]]),
+                    ('Boston', 'MA', [[(-71.0, 42.3), (-71.1, 42.4), (-71.2, 42.3), (-71.0, 42.3)],
+                                      [(-70.9, 42.2), (-70.8, 42.25), (-70.9, 42.2)]]),
+                    ('Austin', 'TX', [[(-97.7, 30.2), (-97.8, 30.3), (-97.9, 30.2), (-97.7, 30.2)]])]
+
+    rows = []
+    for i, (name, state, rings) in enumerate(counties):
+        polygons = ''.join('<Polygon><outerBoundaryIs><LinearRing><coordinates>' +
+                           ' '.join('%s,%s' % point for point in ring) +
+                           '</coordinates></LinearRing></outerBoundaryIs></Polygon>' for ring in rings)
+        if (len(rings) > 1):
+            polygons = '<MultiGeometry>' + polygons + '</MultiGeometry>'
+        rows.append({'State-County': state + '-' + name, 'state abbr': state, 'value': i,
+                     'GEO_ID': i, 'GEO_ID2': i, 'County Name': name, 'State Abbr': state,
+                     'geometry': polygons, 'Geographic Name': name + ', ' + state,
+                     'FIPS formula': i, 'Has error': 0, 'STATE num': i, 'COUNTY num': i})
+    pd.DataFrame(rows).to_csv(path, index=False)
+    return counties
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    pages = {}
+    hits = []
+    failures = {}
+
+    def do_GET(self):
+        path = self.path.lstrip('/')
+        page = self.pages.get(path)
+        self.hits.append(path)
+        if (self.failures.get(path)):
+            self.failures[path] -= 1
+            self.send_error(503)
+            return
+        if (page is None):
+            self.send_error(404)
+            return
+        body = page.encode('utf-8')
+        etag = '"%x"' % zlib.crc32(body)
+        if (self.headers.get('If-None-Match') == etag):
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_main(argv):
+    """
+    Runs data_munging.main with a plain logger instead of the one of
+    get_logger, so that no application.log is left in the working directory
+    """
+    with mock.patch.object(data_munging, 'get_logger', logging.getLogger):
+        data_munging.main(argv)
 
 
 class TestSuite(unittest.TestCase):
@@ -103,6 +230,1274 @@ class TestSuite(unittest.TestCase):
                          "Failed to handle an empty input argument")
 
 
+class TestJsonData(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.records = [
+            {'1711/S171101': {'Date / Time': '11/9/17 04:30', 'City': 'St. Louis', 'State': 'MO',
+                              'Shape': 'Unknown', 'Duration': '1 hour', 'Summary': 'a', 'Posted': '11/9/17'}},
+            {'1711/S171102': {'Date / Time': '11/8/17 21:00', 'City': 'Boston', 'State': 'MA',
+                              'Shape': 'Light', 'Duration': '5 minutes', 'Summary': None, 'Posted': '11/9/17'}},
+            {'1710/S171001': {'Date / Time': '10/1/17 20:15', 'City': 'Austin', 'State': 'TX',
+                              'Duration': '2 min', 'Summary': 'c', 'Posted': '10/2/17'}}]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_records(self, name):
+        path = os.path.join(self.tmp_dir.name, name)
+        with data_scrapper.RecordWriter(path) as writer:
+            for record in self.records:
+                writer.write(record)
+        return path
+
+    def test_bulk_load(self):
+        # Same frame as the one built by appending one row per record
+        expected = pd.concat([pd.DataFrame(record).T for record in self.records],
+                             ignore_index=True, sort=True)
+
+        for name in ('data.json', 'data.jsonl.gz'):
+            path = self.write_records(name)
+            assert_frame_equal(JsonData(path).get_dataframe(), expected)
+            assert_frame_equal(JsonData(path, stream=True).get_dataframe(), expected)
+
+            df = JsonData(path, id_column='id').get_dataframe()
+            self.assertEqual(list(df['id']), ['1711/S171101', '1711/S171102', '1710/S171001'])
+            assert_frame_equal(df.drop(['id'], axis=1), expected)
+
+    def test_cache(self):
+        path = self.write_records('data.jsonl')
+        cache_dir = os.path.join(self.tmp_dir.name, 'cache')
+
+        df = JsonData(path, typed=True, cache_dir=cache_dir).get_dataframe()
+        self.assertEqual(str(df['State'].dtype), 'category')
+        self.assertEqual(df['Date / Time'][0], pd.Timestamp(2017, 11, 9, 4, 30))
+        self.assertEqual(df['Posted'][2], pd.Timestamp(2017, 10, 2))
+
+        # The second load comes from the cache
+        cache_file = JsonData.cache_path(path, cache_dir, typed=True)
+        self.assertTrue(os.path.isfile(cache_file))
+        assert_frame_equal(JsonData(path, typed=True, cache_dir=cache_dir).get_dataframe(), df)
+
+        # A change of the source invalidates the cache
+        self.records = self.records[:2]
+        self.write_records('data.jsonl')
+        self.assertEqual(len(JsonData(path, typed=True, cache_dir=cache_dir).get_dataframe()), 2)
+        self.assertEqual(os.listdir(cache_dir),
+                         [os.path.basename(JsonData.cache_path(path, cache_dir, typed=True))])
+
+    def test_parsers(self):
+        dates, malformed = parse_dates(pd.Series(['11/9/17 04:30', '11/9/17', 'bad', None, '']),
+                                       ['%m/%d/%y %H:%M', '%m/%d/%y'])
+        self.assertEqual(list(dates[:2]), [pd.Timestamp(2017, 11, 9, 4, 30), pd.Timestamp(2017, 11, 9)])
+        self.assertTrue(dates[2:].isna().all())
+        self.assertEqual(malformed, 1)
+
+        dates, malformed = parse_dates(pd.Series([datetime.datetime(2017, 11, 9, 4, 30), '11/9/17', None]),
+                                       ['%m/%d/%y'])
+        self.assertEqual(list(dates[:2]), [pd.Timestamp(2017, 11, 9, 4, 30), pd.Timestamp(2017, 11, 9)])
+        self.assertEqual(malformed, 0)
+
+        durations, malformed = parse_durations(pd.Series(['1 hour', '5-10 min', 'about 30 seconds',
+                                                          'two hours', 'a few minutes', None]))
+        self.assertEqual(list(durations[:4]), [3600, 450, 30, 7200])
+        self.assertTrue(durations[4:].isna().all())
+        self.assertEqual(malformed, 1)
+
+        jd = JsonData(self.write_records('data.jsonl'), typed=True)
+        self.assertEqual(list(jd.get_dataframe()['Seconds']), [3600, 300, 120])
+        self.assertEqual(jd.malformed, {'Date / Time': 0, 'Posted': 0, 'Duration': 0})
+
+    def test_iter_json_list(self):
+        text = json.dumps(self.records, indent=4)
+        self.assertEqual(list(iter_json_list(StringIO(text), chunk_size=7)), self.records)
+        self.assertEqual(list(iter_json_list(StringIO('[ ]'))), [])
+
+        with self.assertRaises(ValueError):
+            list(iter_json_list(StringIO('{"a": 1}')))
+
+
+@unittest.skipIf(mongomock is None, 'mongomock is not installed')
+class TestDataBase(unittest.TestCase):
+    def setUp(self):
+        self.config = {'host': None, 'port': None, 'db': 'assignment2', 'collection': 'unittest'}
+        self.client = mongomock.MongoClient()
+        self.db = DataBase(self.config, client=self.client)
+        self.df = pd.DataFrame({'id': ['a', 'b', 'c'],
+                                'state': pd.Categorical(['MO', 'MA', None]),
+                                'datetime': pd.to_datetime(['2017-11-09 04:30', None, '2017-10-01 00:00']),
+                                'seconds': [3600.0, np.nan, 120.0]})
+
+    def test_save_from_frame(self):
+        self.assertEqual(self.db.save_from_frame(self.df, 'id', chunk_size=2),
+                         {'inserted': 3, 'updated': 0, 'unchanged': 0})
+
+        # Loading again is idempotent, only the changed and new records are written
+        df = pd.concat([self.df, pd.DataFrame({'id': ['d'], 'state': ['TX']})], ignore_index=True)
+        df.loc[0, 'seconds'] = 60.0
+        self.assertEqual(self.db.save_from_frame(df, 'id', chunk_size=2),
+                         {'inserted': 1, 'updated': 1, 'unchanged': 2})
+
+        docs = pd.DataFrame(list(self.db.get_connection().find({}, {'_id': 0}).sort('id')))
+        self.assertEqual(len(docs), 4)
+        self.assertEqual(docs['seconds'][0], 60.0)
+        self.assertEqual(docs['datetime'][2], pd.Timestamp(2017, 10, 1))
+        self.assertIsNone(self.db.get_connection().find_one({'id': 'c'})['state'])
+
+        with self.assertRaises(ValueError):
+            self.db.save_from_frame(self.df, 'report')
+
+    def test_save_without_key(self):
+        buff = StringIO()
+        tmp = pd.DataFrame(np.arange(6).reshape(3, 2), columns=list('AB'))
+        tmp.to_json(buff, orient='records')
+        self.assertEqual(self.db.save_from_json(buff), {'inserted': 3, 'updated': 0, 'unchanged': 0})
+        # Without key the records can't be matched, a populated collection is left untouched
+        self.assertEqual(self.db.save_from_frame(tmp, None)['inserted'], 0)
+        docs = pd.DataFrame(list(self.db.get_connection().find({}, {'_id': 0})))
+        assert_frame_equal(docs, tmp)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'data.json')
+            with open(path, 'w') as outfile:
+                json.dump([{'1711/S171101': {'City': 'St. Louis', 'Date / Time': '11/9/17 04:30'}}], outfile)
+            config = {'host': None, 'port': None, 'db': 'assignment2', 'collection': 'nokey'}
+            db = DataBase(config, client=self.client)
+            self.assertEqual(JsonData(path, typed=True).to_database(db)['inserted'], 1)
+            self.assertEqual(db.get_connection().find_one()['Date / Time'], datetime.datetime(2017, 11, 9, 4, 30))
+
+    def test_read_frames(self):
+        self.db.save_from_frame(self.df, 'id')
+        self.db.get_connection().insert_one({'id': 'd', 'state': 'TX', 'datetime': '2017-10-02T10:00:00.000'})
+
+        frames = list(self.db.read_frames(projection={'id': 1, 'state': 1, 'datetime': 1}, batch_size=3))
+        self.assertEqual([len(frame) for frame in frames], [3, 1])
+        self.assertEqual(list(frames[0].columns), ['id', 'state', 'datetime'])
+
+        df = self.db.read_frame({'state': {'$ne': 'MA'}}, batch_size=2, categories=['state'])
+        self.assertEqual(list(df['id']), ['a', 'c', 'd'])
+        self.assertEqual(str(df['state'].dtype), 'category')
+        self.assertTrue(pd.api.types.is_datetime64_any_dtype(df['datetime']))
+        self.assertEqual(df['datetime'][2], pd.Timestamp(2017, 10, 2, 10))
+        self.assertNotIn('_id', df.columns)
+
+        # The dates stored as such are kept when strings are in the same chunk
+        df = self.db.read_frame(batch_size=10)
+        self.assertEqual(list(df['datetime']), [pd.Timestamp(2017, 11, 9, 4, 30), pd.NaT,
+                                                pd.Timestamp(2017, 10, 1), pd.Timestamp(2017, 10, 2, 10)])
+
+    def test_aggregations(self):
+        df = pd.DataFrame({'id': ['a', 'b', 'c', 'd', 'e'],
+                           'city': ['St. Louis', 'St. Louis', 'Boston', 'Anchorage', 'Boston'],
+                           'state': ['MO', 'MO', 'MA', 'AK', 'MA'],
+                           'datetime': pd.to_datetime(['2017-11-09 04:30', '2017-11-09 21:00',
+                                                       '2017-11-09 22:00', '2017-11-09 23:00', None])})
+        self.db.save_from_frame(df, 'id')
+        match = {'state': {'$nin': ['AK']}}
+
+        places = self.db.count_by_place(match).sort_values('city').reset_index(drop=True)
+        expected = df[df['state'] != 'AK'].groupby(['city', 'state']).size().reset_index(name='reports')
+        assert_frame_equal(places, expected)
+
+        days = self.db.count_by_day(match).sort_values('state').reset_index(drop=True)
+        self.assertEqual(days.to_dict('records'),
+                         [{'datetime': pd.Timestamp(2017, 11, 9), 'state': 'MA', 'reports': 1},
+                          {'datetime': pd.Timestamp(2017, 11, 9), 'state': 'MO', 'reports': 2}])
+
+        ts = TimeSerie(pd.Timestamp(2017, 1, 1), pd.Timestamp(2017, 12, 31))
+        ts.combine_with(days, 'reports', 'sum')
+        self.assertEqual(list(ts.get_ts()['reports']), [1, 2])
+
+        indexes = [index['key'] for index in self.db.get_connection().list_indexes()]
+        self.assertIn({'state': 1}, indexes)
+        self.assertIn({'datetime': 1}, indexes)
+
+        # A failed write raises from the mongo stage, which isn't cached
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pipeline = Pipeline(tmp_dir).add('frame', lambda: df, cache=False)
+            pipeline.add('mongo', data_munging.mongo_stage, ['frame'], {'config': self.config})
+            with mock.patch('data_munging.MongoClient', return_value=self.client), \
+                    mock.patch.object(self.db.get_connection().__class__, 'bulk_write', side_effect=PyMongoError):
+                with self.assertRaises(PyMongoError):
+                    pipeline.run()
+            self.assertEqual(pipeline.plan(), ['frame', 'mongo'])
+            self.assertEqual(self.db.save_from_frame(df, 'id')['unchanged'], 5)
+
+        # The pipeline can count with the aggregation instead of the SQLite aggregates
+        with mock.patch('data_munging.MongoClient', return_value=self.client):
+            stage_places, stage_days = data_munging.mongo_counts_stage(None, self.config, ['AK'])
+        assert_frame_equal(stage_places.sort_values('city').reset_index(drop=True), places)
+        self.assertEqual(len(stage_days), 2)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            data, counties = os.path.join(tmp_dir, 'data.jsonl'), os.path.join(tmp_dir, 'US_Counties.csv')
+            for path in (data, counties):
+                open(path, 'w').close()
+            args = data_munging.parse_args(['--counts', 'mongo', '--data', data, '--counties', counties,
+                                            '--cache-dir', tmp_dir, '--output-dir', tmp_dir])
+            pipeline = data_munging.build_pipeline(args)
+            self.assertEqual(pipeline.plan(['aggregates']), ['load', 'mongo', 'aggregates'])
+        with self.assertRaises(SystemExit):
+            data_munging.parse_args(['--counts', 'mongo', '--mongo-host', ''])
+
+
+class TestCoordinates(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.csv = os.path.join(self.tmp_dir.name, 'US_Counties.csv')
+        self.counties = write_counties_csv(self.csv)
+        self.reports = pd.DataFrame({'city': ['St. Louis', 'St. Louis', 'Austin', 'Nowhere'],
+                                     'state': ['MO', 'MO', 'TX', 'MO']})
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_parse_geometry(self):
+        coord = Coordinates(self.csv)
+        geometry = coord.parse_geometry(pd.read_csv(self.csv)['geometry'])
+        self.assertEqual(list(geometry['county_rings']), [0, 1, 3, 4])
+        self.assertEqual(list(geometry['ring_offsets']), [0, 4, 8, 11, 15])
+        self.assertEqual(geometry['coords'].shape, (15, 2))
+
+        lon, lat = coord.county_coordinates(1)
+        self.assertEqual(len(lon), 8)
+        self.assertTrue(np.isnan(lon[4]) and np.isnan(lat[4]))
+        self.assertEqual(list(lat[:4]), [42.3, 42.4, 42.3, 42.3])
+
+        bad = coord.parse_geometry(pd.Series(['<coordinates>1,2 x,4</coordinates>', np.nan]))
+        self.assertTrue(np.isnan(bad['coords'][1, 0]))
+        self.assertEqual(list(bad['county_rings']), [0, 1, 1])
+
+    def test_geometry_cache(self):
+        cache_dir = os.path.join(self.tmp_dir.name, 'cache')
+        first = Coordinates(self.csv, cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        second = Coordinates(self.csv, cache_dir)
+        for key in ('coords', 'ring_offsets', 'county_rings'):
+            np.testing.assert_array_equal(first._geometry[key], second._geometry[key])
+
+        write_counties_csv(self.csv, self.counties[:2])
+        self.assertEqual(len(Coordinates(self.csv, cache_dir)._geometry['county_rings']), 3)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    def test_combine_with(self):
+        coord = Coordinates(self.csv)
+        coord.combine_with(self.reports, 'reports', 'size')
+        result = coord.get_coord_obj().set_index('city')
+        self.assertEqual(result.loc['St. Louis', 'reports'], 2)
+        self.assertEqual(result.loc['St. Louis', 'longitude'], [-90.1, -90.2, -90.3, -90.1])
+        self.assertEqual(result.loc['Austin', 'latitude'], [30.2, 30.3, 30.2, 30.2])
+
+        # Same result as the right merge on the counties followed by a group by
+        counties = pd.read_csv(self.csv)[['County Name', 'State Abbr', 'geometry']]
+        counties.columns = ['city', 'state', 'geometry']
+        merged = pd.merge(self.reports, counties, how='right', on=['city', 'state'])
+        expected = merged.groupby(['city', 'state', 'geometry']).size().reset_index(name='reports')
+        self.assertEqual(list(result['reports']), list(expected['reports']))
+
+        # The same object can be combined again, with normalized keys
+        counts = self.reports.groupby(['city', 'state']).size().reset_index(name='reports')
+        counts['city'] = ' ' + counts['city'].str.upper()
+        coord.combine_with(counts, 'reports', 'sum')
+        result = coord.get_coord_obj().set_index('city')
+        self.assertEqual(list(result['reports']), [1, 0, 2])
+
+        shapes = self.reports.assign(shape=['Light', 'Disk', 'Light', 'Light'])
+        coord.combine_with(shapes, 'reports', 'size', by=['shape'])
+        result = coord.get_coord_obj()
+        self.assertEqual(result[['city', 'shape', 'reports']].values.tolist(),
+                         [['Austin', 'Light', 1], ['St. Louis', 'Disk', 1], ['St. Louis', 'Light', 1]])
+        self.assertEqual(result['longitude'][0], [-97.7, -97.8, -97.9, -97.7])
+
+        # Without the column only the rows can be counted
+        with self.assertRaises(ValueError):
+            coord.combine_with(self.reports, 'reports', 'sum')
+
+    def test_levels_of_detail(self):
+        t = np.linspace(0, 2 * np.pi, 101)
+        circle = np.c_[np.cos(t), np.sin(t)]
+        circle[-1] = circle[0]
+        line = np.c_[np.arange(5.0), np.zeros(5)]
+        keep = Coordinates.simplify(np.r_[circle, line], np.array([0, 101, 106]), 0.01)
+        self.assertTrue(10 < keep[:101].sum() < 101)
+        self.assertEqual(list(keep[101:]), [True, False, False, False, True])
+
+        coord = Coordinates(self.csv)
+        coord.combine_with(self.reports, 'reports', 'size')
+        geometry = coord.simplify_geometry(1.0, decimals=0)
+        # every ring collapses, each county keeps its first ring untouched
+        self.assertEqual(list(geometry['county_rings']), [0, 1, 2, 3])
+        self.assertEqual(len(geometry['coords']), 12)
+
+        output = os.path.join(self.tmp_dir.name, 'geo_reports.json')
+        files = coord.to_json_levels(output, {'national': (1.0, 0), 'full': (0, None)}, by_state=True)
+        self.assertEqual(len(files), 8)
+        national = pd.read_json(os.path.join(self.tmp_dir.name, 'geo_reports.national.json'))
+        self.assertEqual(list(national['reports']), list(coord.get_coord_obj()['reports']))
+        # the second ring of Boston has only 3 points, it is dropped
+        full = pd.read_json(os.path.join(self.tmp_dir.name, 'geo_reports.full.MA.json'))
+        self.assertEqual(full['longitude'][0], [-71.0, -71.1, -71.2, -71.0])
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_arrow(self):
+        coord = Coordinates(self.csv)
+        self.assertRaises(ValueError, coord.to_arrow, os.path.join(self.tmp_dir.name, 'geo.arrow'))
+        coord.combine_with(self.reports, 'reports', 'size')
+        expected = coord.get_coord_obj()
+
+        for compression in (None, 'zstd'):
+            output = os.path.join(self.tmp_dir.name, 'geo.arrow')
+            coord.to_arrow(output, compression)
+            table = read_arrow(output)
+            self.assertEqual(str(table.schema.field('longitude').type), 'list<item: float>')
+            df = table.to_pandas()
+            self.assertEqual(df[['city', 'state', 'reports']].values.tolist(),
+                             expected[['city', 'state', 'reports']].values.tolist())
+            # the values are float32, the ring separators of Boston stay NaN
+            np.testing.assert_allclose(df['latitude'][0], expected['latitude'][0], rtol=1e-6)
+            self.assertTrue(np.isnan(df['longitude'][1][4]))
+
+        # Uncompressed, the buffers are views of the mapped file, nothing is allocated
+        coord.to_arrow(output)
+        table = read_arrow(output, columns=['longitude'])
+        allocated = pyarrow.total_allocated_bytes()
+        values, offsets = list_buffers(table, 'longitude')
+        self.assertEqual(pyarrow.total_allocated_bytes(), allocated)
+        self.assertEqual(list(offsets), [0, 4, 12, 16])
+        self.assertEqual(values.dtype, np.float32)
+        buffer = table.column('longitude').chunk(0).values.buffers()[1]
+        self.assertTrue(np.shares_memory(values, np.frombuffer(buffer, dtype=np.uint8)))
+
+        # A level of detail is written from its simplified polygons
+        coord.to_arrow(output, geometry=coord.simplify_geometry(1.0, decimals=0))
+        self.assertEqual(list(list_buffers(read_arrow(output, memory_map=False), 'latitude')[1]), [0, 4, 8, 12])
+        self.assertRaises(ValueError, coord.to_arrow, output, 'gzip')
+
+
+class TestTimeSerie(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame({'datetime': pd.to_datetime(['2017-11-09 04:30', '2017-11-09 21:00',
+                                                            '2017-11-12 00:00', '2016-01-01 00:00', None]),
+                                'state': ['MO', 'MA', 'MO', 'MO', '']})
+        self.ts = TimeSerie(pd.Timestamp(2017, 11, 8), pd.Timestamp(2017, 11, 12))
+
+    def test_window(self):
+        original = self.df.copy()
+        self.ts.combine_with(self.df, 'reports', 'size')
+        assert_frame_equal(self.df, original)
+        self.assertEqual(self.ts.get_ts().values.tolist(),
+                         [['2017-11-09', 'MA', 1], ['2017-11-09', 'MO', 1], ['2017-11-12', 'MO', 1]])
+
+        # Other functions need the column they are applied to
+        with self.assertRaises(ValueError):
+            self.ts.combine_with(self.df, 'duration', 'mean')
+        self.ts.combine_with(self.df.assign(duration=[60, 30, 10, 5, 1]), 'duration', 'mean')
+        self.assertEqual(self.ts.get_ts()['duration'].tolist(), [30, 60, 10])
+
+    def test_buckets(self):
+        self.ts.combine_with(self.df, 'reports', 'size', freq='week')
+        self.assertEqual(self.ts.get_ts().values.tolist(), [['2017-11-06', 'MA', 1], ['2017-11-06', 'MO', 2]])
+
+        self.ts.combine_with(self.df, 'reports', 'size', freq='hour')
+        self.assertEqual(list(self.ts.get_ts()['datetime']), ['2017-11-09 04:00', '2017-11-09 21:00',
+                                                              '2017-11-12 00:00'])
+
+        self.ts.combine_with(self.df, 'reports', 'size', freq='month')
+        self.assertEqual(list(self.ts.get_ts()['datetime']), ['2017-11', '2017-11'])
+
+        with self.assertRaises(ValueError):
+            self.ts.combine_with(self.df, 'reports', 'size', freq='year')
+
+    def test_fill_and_rolling(self):
+        self.ts.combine_with(self.df, 'reports', 'size', fill=True, window=2)
+        df = self.ts.get_ts()
+        self.assertEqual(len(df), 10)
+        mo = df[df['state'] == 'MO']
+        self.assertEqual(list(mo['reports']), [0, 1, 0, 0, 1])
+        self.assertEqual(list(mo['reports_rolling']), [0, 1, 1, 0, 1])
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_arrow(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = os.path.join(tmp_dir, 'ts.arrow')
+            self.assertRaises(ValueError, self.ts.to_arrow, output)
+            self.ts.combine_with(self.df, 'reports', 'size', fill=True)
+            self.ts.to_arrow(output, compression='lz4')
+            table = read_arrow(output)
+            self.assertTrue(pyarrow.types.is_dictionary(table.schema.field('state').type))
+            df = table.to_pandas()
+            self.assertEqual(df.astype({'datetime': str, 'state': str}).values.tolist(),
+                             self.ts.get_ts().values.tolist())
+
+
+class TestAggregates(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'aggregates.sqlite')
+        self.df = pd.DataFrame({'id': ['a', 'b', 'c', 'd'],
+                                'city': pd.Categorical(['St. Louis', 'St. Louis', 'Boston', 'Anchorage']),
+                                'state': pd.Categorical(['MO', 'MO', 'MA', 'AK']),
+                                'datetime': pd.to_datetime(['2017-11-09 04:30', '2017-11-09 21:00',
+                                                            '2017-11-10 22:00', None])})
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_incremental(self):
+        aggregates = Aggregates(self.path)
+        self.assertEqual(aggregates.apply(self.df.iloc[:2]), {'inserted': 2, 'updated': 0, 'unchanged': 0})
+        self.assertEqual(aggregates.apply(self.df), {'inserted': 2, 'updated': 0, 'unchanged': 2})
+        aggregates.close()
+
+        # The tables persist and re-ingested reports are not counted twice
+        aggregates = Aggregates(self.path)
+        df = self.df.copy()
+        df['state'] = df['state'].cat.add_categories(['IL'])
+        df.loc[1, 'state'] = 'IL'
+        self.assertEqual(aggregates.apply(df), {'inserted': 0, 'updated': 1, 'unchanged': 3})
+
+        self.assertEqual(aggregates.day_state(exclude=['AK']).values.tolist(),
+                         [[pd.Timestamp(2017, 11, 9), 'IL', 1], [pd.Timestamp(2017, 11, 9), 'MO', 1],
+                          [pd.Timestamp(2017, 11, 10), 'MA', 1]])
+        self.assertEqual(aggregates.places().values.tolist(),
+                         [['anchorage', 'AK', 1], ['boston', 'MA', 1], ['st. louis', 'IL', 1],
+                          ['st. louis', 'MO', 1]])
+
+        # A full rebuild gives the same tables
+        incremental = (aggregates.day_state(), aggregates.places())
+        self.assertEqual(aggregates.rebuild(df)['inserted'], 4)
+        assert_frame_equal(aggregates.day_state(), incremental[0])
+        assert_frame_equal(aggregates.places(), incremental[1])
+
+        # The reports without city are counted per day but not per place
+        self.assertEqual(aggregates.apply(pd.DataFrame({'id': ['e', 'f'], 'city': [None, ' '], 'state': ['MO', 'MO'],
+                                                        'datetime': pd.to_datetime(['2017-11-10'] * 2)})),
+                         {'inserted': 2, 'updated': 0, 'unchanged': 0})
+        self.assertEqual(aggregates.places()['city'].tolist(), ['anchorage', 'boston', 'st. louis', 'st. louis'])
+        self.assertEqual(aggregates.day_state().values.tolist()[-1], [pd.Timestamp(2017, 11, 10), 'MO', 2])
+
+        # Retracted reports leave the counts and the ledger, unknown IDs are ignored
+        self.assertEqual(aggregates.retract(['e', 'zz']), 1)
+        self.assertEqual(aggregates.day_state().values.tolist()[-1], [pd.Timestamp(2017, 11, 10), 'MO', 1])
+        self.assertEqual(aggregates.apply(self.df.iloc[:1])['unchanged'], 1)
+        self.assertEqual(aggregates.retract([]), 0)
+
+        # Summed over the days the ledger counts are the place counts
+        day_places = aggregates.day_places(exclude=['IL'])
+        self.assertEqual(day_places['datetime'].isna().sum(), 1)
+        self.assertEqual(day_places.groupby(['city', 'state'])['reports'].sum().reset_index().values.tolist(),
+                         aggregates.places(exclude=['IL']).values.tolist())
+        aggregates.close()
+
+
+    def test_dedup_representatives(self):
+        # The representative of the cluster of b and c changes to a, then c leaves the cluster
+        df = pd.DataFrame({'id': ['a', 'b', 'c'], 'city': ['Austin'] * 3, 'state': ['TX'] * 3,
+                           'datetime': pd.to_datetime(['2017-11-09'] * 3), 'cluster': ['b', 'b', 'b']})
+        for rows, clusters, expected in ((['b', 'c'], ['b', 'b'], 1), (['a', 'b', 'c'], ['a', 'a', 'a'], 1),
+                                         (['a', 'b', 'c'], ['a', 'a', 'c'], 2)):
+            run = df.set_index('id').loc[rows].reset_index().assign(cluster=clusters)
+            places, days = data_munging.aggregates_stage(run, self.path, deduplicate=True)
+            self.assertEqual(places.values.tolist(), [['austin', 'TX', expected]])
+            self.assertEqual(days['reports'].tolist(), [expected])
+
+
+class TestCountCube(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        csv = os.path.join(self.tmp_dir.name, 'US_Counties.csv')
+        write_counties_csv(csv)
+        self.coord = Coordinates(csv)
+        self.df = pd.DataFrame({'city': ['St. Louis', 'St. Louis', 'Austin', 'Boston', 'Boston', 'Nowhere'],
+                                'state': ['MO', 'MO', 'TX', 'MA', 'MA', 'MO'],
+                                'shape': ['Light', 'Disk', 'Light', 'Light', 'Light', 'Light'],
+                                'datetime': pd.to_datetime(['2017-11-09 04:30', '2017-11-12 21:00',
+                                                            '2017-11-10 22:00', '2017-11-09 01:00',
+                                                            None, '2017-11-09 01:00'])})
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_queries(self):
+        path = os.path.join(self.tmp_dir.name, 'cube')
+        cube = CountCube.build(self.df, self.coord, path, shapes=True)
+        self.assertTrue(isinstance(CountCube(path)._prefix, np.memmap))
+
+        self.assertEqual(cube.total(), 4)
+        self.assertEqual(cube.total(state='MO'), 2)
+        self.assertEqual(cube.total(begin='2017-11-10'), 2)
+        self.assertEqual(cube.total('2017-11-09', '2017-11-10', state='MO'), 1)
+        self.assertEqual(cube.total(county=('Austin', 'TX'), end='2017-11-10'), 1)
+        self.assertEqual(cube.total(shape='Light'), 3)
+        self.assertEqual(cube.total(state='WA'), 0)
+        self.assertEqual(cube.total('2018-01-01', '2018-12-31'), 0)
+        self.assertRaises(ValueError, cube.total, '2017-11-11', '2017-11-08')
+        self.assertRaises(ValueError, cube.top_counties, '2017-11-11', '2017-11-08')
+
+        # Built block by block of counties, the prefix sums are those of the whole cube
+        counts = np.zeros((2, 3, 4), dtype=np.int64)
+        for county, shape, day in ((1, 0, 0), (1, 1, 3), (2, 0, 1), (0, 0, 0)):
+            counts[shape, county, day] += 1
+        np.testing.assert_array_equal(np.asarray(cube._prefix)[:, 1:, 1:],
+                                      np.cumsum(np.cumsum(counts, axis=1), axis=2))
+
+        top = cube.top_counties(n=2)
+        self.assertEqual(top.values.tolist(), [['St. Louis', 'MO', 2], ['Boston', 'MA', 1]])
+        top = cube.top_counties('2017-11-10', '2017-11-12', n=5, shape='Light')
+        self.assertEqual(top['reports'].tolist(), [1, 0, 0])
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp_dir.name, 'cache')
+        self.source = os.path.join(self.tmp_dir.name, 'source.txt')
+        with open(self.source, 'w') as outfile:
+            outfile.write('1 2 3')
+        self.calls = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def stage(self, name, function):
+        def run(*args, **kwargs):
+            self.calls.append(name)
+            return function(*args, **kwargs)
+        return run
+
+    def build(self, factor=2, barrier=None):
+        def read(path):
+            with open(path) as infile:
+                return [int(x) for x in infile.read().split()]
+
+        def branch(function):
+            def run(values, **kwargs):
+                if (barrier is not None):
+                    barrier.wait()
+                return function(values, **kwargs)
+            return run
+
+        pipeline = Pipeline(self.cache_dir, workers=2)
+        pipeline.add('read', self.stage('read', read), params={'path': self.source}, files=[self.source])
+        pipeline.add('scale', self.stage('scale', branch(lambda values, factor: [x * factor for x in values])),
+                     ['read'], {'factor': factor})
+        pipeline.add('total', self.stage('total', branch(sum)), ['read'])
+        pipeline.add('report', self.stage('report', lambda scaled, total: (scaled, total)), ['scale', 'total'])
+        return pipeline
+
+    def test_cache(self):
+        self.assertEqual(self.build().run(), {'report': ([2, 4, 6], 6)})
+        self.assertEqual(self.calls, ['read', 'scale', 'total', 'report'])
+
+        # Nothing changed, the result is read from the cache
+        self.calls = []
+        self.assertEqual(self.build().run(), {'report': ([2, 4, 6], 6)})
+        self.assertEqual(self.calls, [])
+
+        # A parameter only invalidates its stage and the ones depending on it
+        self.assertEqual(self.build(3).run(), {'report': ([3, 6, 9], 6)})
+        self.assertEqual(self.calls, ['scale', 'report'])
+
+        # The content of an input file invalidates everything downstream
+        self.calls = []
+        with open(self.source, 'w') as outfile:
+            outfile.write('1 2')
+        self.assertEqual(self.build(3).run(['total']), {'total': 3})
+        self.assertEqual(self.calls, ['read', 'total'])
+        self.calls = []
+        self.assertEqual(self.build(3).run(force=['total']), {'report': ([3, 6], 3)})
+        self.assertEqual(sorted(self.calls), ['report', 'scale', 'total'])
+
+    def test_graph(self):
+        pipeline = self.build()
+        self.assertRaises(ValueError, pipeline.add, 'read', len)
+        self.assertRaises(ValueError, pipeline.add, 'other', len, ['missing'])
+        self.assertRaises(ValueError, pipeline.run, ['missing'])
+        self.assertEqual(pipeline.plan(['scale']), ['read', 'scale'])
+
+    def test_main(self):
+        data = os.path.join(self.tmp_dir.name, 'data.jsonl')
+        counties = os.path.join(self.tmp_dir.name, 'US_Counties.csv')
+        output_dir = os.path.join(self.tmp_dir.name, 'out')
+        write_counties_csv(counties)
+        with data_scrapper.RecordWriter(data) as writer:
+            writer.write({'1711/S171101': {'Date / Time': '11/9/17 04:30', 'City': 'St. Louis', 'State': 'MO',
+                                           'Shape': 'Light', 'Duration': '1 hour', 'Summary': 'a',
+                                           'Posted': '11/9/17'}})
+            writer.write({'1711/S171102': {'Date / Time': '11/8/17 21:00', 'City': 'Boston', 'State': 'MA',
+                                           'Shape': 'Light', 'Duration': '5 min', 'Summary': 'b',
+                                           'Posted': '11/9/17'}})
+        argv = ['--data', data, '--counties', counties, '--output-dir', output_dir, '--cache-dir',
+                self.cache_dir, '--mongo-host', '', '--begin', '2017-11-01', '--end', '2017-11-30']
+
+        run_main(argv)
+        geo = pd.read_json(os.path.join(output_dir, 'geo_reports.json'))
+        self.assertEqual(geo['reports'].tolist(), [0, 1, 1])
+        ts = pd.read_json(os.path.join(output_dir, 'ts_reports.json'))
+        self.assertEqual(ts['reports'].sum(), 2)
+        self.assertEqual(CountCube(os.path.join(output_dir, 'count_cube')).total(), 2)
+
+        # A new window only runs the time series again
+        args = data_munging.parse_args(argv[:-4] + ['--begin', '2017-11-09', '--end', '2017-11-30'])
+        self.assertEqual(data_munging.build_pipeline(args).plan(), ['timeserie'])
+
+        # The ledger is an output of the aggregates, it is rebuilt when deleted
+        os.remove(os.path.join(output_dir, 'aggregates.sqlite'))
+        self.assertEqual(data_munging.build_pipeline(data_munging.parse_args(argv)).plan(), ['aggregates'])
+        run_main(argv)
+        self.assertTrue(os.path.exists(os.path.join(output_dir, 'aggregates.sqlite')))
+
+        # The Arrow outputs hold the same results
+        if (pyarrow is not None):
+            run_main(argv + ['--format', 'arrow', '--compression', 'zstd'])
+            geo_arrow = read_arrow(os.path.join(output_dir, 'geo_reports.arrow')).to_pandas()
+            self.assertEqual(geo_arrow[['city', 'state', 'reports']].values.tolist(),
+                             geo[['city', 'state', 'reports']].values.tolist())
+            ts_arrow = read_arrow(os.path.join(output_dir, 'ts_reports.arrow')).to_pandas()
+            self.assertEqual(ts_arrow['reports'].tolist(), ts['reports'].tolist())
+            self.assertTrue(os.path.isfile(os.path.join(output_dir, 'geo_reports.national.arrow')))
+
+    def test_parallel(self):
+        # Both branches wait for each other, which only completes if they run at the same time
+        barrier = threading.Barrier(2, timeout=10)
+        self.assertEqual(self.build(barrier=barrier).run(), {'report': ([2, 4, 6], 6)})
+
+
+class TestPartitionedCounts(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.counties = os.path.join(self.tmp_dir.name, 'US_Counties.csv')
+        write_counties_csv(self.counties)
+        places = [('St. Louis', 'MO'), ('st. louis ', 'mo'), ('Boston', 'MA'), ('Austin', 'TX'),
+                  ('Anchorage', 'AK'), ('Nowhere', ''), (None, 'TX')]
+        self.months = {}
+        for i in range(60):
+            month = 10 + i % 2
+            city, state = places[i % len(places)]
+            fields = {'Date / Time': '%d/%d/17 %02d:00' % (month, i % 28 + 1, i % 24), 'City': city,
+                      'State': state, 'Shape': 'Light', 'Duration': '1 hour', 'Summary': 'x' * i,
+                      'Posted': '%d/28/17' % month}
+            if (i % 13 == 0):
+                fields['Date / Time'] = 'unknown'
+            self.months.setdefault(month, []).append({'%d/S%03d' % (month, i): fields})
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, name, records):
+        path = os.path.join(self.tmp_dir.name, name)
+        with data_scrapper.RecordWriter(path) as writer:
+            for record in records:
+                writer.write(record)
+        return path
+
+    def test_counts(self):
+        records = self.months[10] + self.months[11]
+        aggregates = Aggregates(os.path.join(self.tmp_dir.name, 'aggregates.sqlite'))
+        df = JsonData(self.write('all.jsonl', records), id_column='id', typed=True).get_dataframe()
+        df = df.rename(columns={'City': 'city', 'State': 'state', 'Date / Time': 'datetime'})
+        aggregates.apply(df)
+
+        # By chunks of one file, by month files of any format
+        paths = [[self.write('all.jsonl', records)],
+                 [self.write('10.jsonl', self.months[10]), self.write('11.json.gz', self.months[11])]]
+        for files in paths:
+            counts = partitioned_counts(files, processes=2, chunk_bytes=500, chunk_size=7)
+            assert_frame_equal(counts.places(['AK']), aggregates.places(['AK']))
+            assert_frame_equal(counts.day_state(['AK']), aggregates.day_state(['AK']))
+        aggregates.close()
+
+    def test_merge(self):
+        df = pd.DataFrame({'id': ['a', 'b', 'c'], 'city': ['Boston', 'boston', 'Austin'],
+                           'state': ['MA', 'MA', 'TX'],
+                           'datetime': pd.to_datetime(['2017-11-09 04:30', '2017-11-09 21:00', None])})
+        parts = [PartialCounts.from_frame(df.iloc[[i]]) for i in range(3)]
+        left = (parts[0] + parts[1]) + parts[2]
+        right = parts[2].merge(PartialCounts().merge(parts[1] + parts[0]))
+        whole = PartialCounts.from_frame(df)
+        for counts in (left, right):
+            assert_frame_equal(counts.places(), whole.places())
+            assert_frame_equal(counts.day_state(), whole.day_state())
+        self.assertEqual(whole.places()['reports'].tolist(), [1, 2])
+        self.assertEqual(whole.day_state().values.tolist(), [[pd.Timestamp(2017, 11, 9), 'MA', 2]])
+
+    def test_outputs(self):
+        data = self.write('all.jsonl', self.months[10] + self.months[11])
+        outputs = []
+        for mode, extra in (('single', []), ('partitioned', ['--processes', '2'])):
+            output_dir = os.path.join(self.tmp_dir.name, mode)
+            run_main(['--data', data, '--counties', self.counties, '--output-dir', output_dir,
+                      '--cache-dir', os.path.join(self.tmp_dir.name, mode + '_cache'),
+                      '--mongo-host', '', '--begin', '2017-10-01', '--end', '2017-11-30'] + extra)
+            files = []
+            for name in ('geo_reports.json', 'ts_reports.json'):
+                with open(os.path.join(output_dir, name), 'rb') as infile:
+                    files.append(infile.read())
+            outputs.append(files)
+        self.assertEqual(outputs[0], outputs[1])
+
+
+class TestSearchIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'index')
+        self.df = pd.DataFrame({
+            'id': ['a', 'b', 'c', 'd', 'e'],
+            'summary': ['Three orange lights hovering over the lake', 'Bright light, then three lights in a row',
+                        'Orange fireball.  Orange trail, no sound', "three orange lights didn't move", None],
+            'state': ['MO', 'MA', 'MO', 'TX', 'MO'],
+            'shape': ['Light', 'Triangle', 'Fireball', 'Light', None],
+            'datetime': pd.to_datetime(['2017-11-01 20:00', '2017-11-02 21:00', '2017-11-03 22:00', None,
+                                        '2017-11-04 23:00'])})
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize("Didn't see 3 UFOs, over St. Louis!"),
+                         ['didnt', 'see', '3', 'ufos', 'over', 'st', 'louis'])
+        self.assertEqual(tokenize(None), [])
+        self.assertEqual(parse_query('orange "Three  lights" lake ""'), (['orange', 'lake'], [['three', 'lights']]))
+
+    def test_search(self):
+        index = SearchIndex(self.path)
+        self.assertEqual(index.add(self.df), 5)
+
+        # Every keyword must be present, the more frequent in a shorter summary the better
+        found = index.search('orange')
+        self.assertEqual(list(found['id']), ['c', 'd', 'a'])
+        self.assertEqual(list(index.search('orange lights')['id']), ['d', 'a'])
+        self.assertTrue(index.search('purple').empty)
+
+        # BM25 score of the report d
+        lengths = [7, 8, 6, 5, 0]
+        average = sum(lengths) / 5
+        idf = np.log(1 + (5 - 3 + 0.5) / (3 + 0.5))
+        score = idf * 2.2 / (1 + 1.2 * (0.25 + 0.75 * 5 / average))
+        self.assertAlmostEqual(found.loc[found['id'] == 'd', 'score'].iloc[0], score)
+
+        # Phrases and filters
+        self.assertEqual(list(index.search('"three orange lights"')['id']), ['d', 'a'])
+        self.assertEqual(list(index.search('"orange three"')['id']), [])
+        self.assertEqual(list(index.search('"three lights"')['id']), ['b'])
+        self.assertEqual(list(index.search('orange', state='mo')['id']), ['c', 'a'])
+        self.assertEqual(list(index.search('orange', shape='LIGHT')['id']), ['d', 'a'])
+        self.assertEqual(list(index.search('orange', begin='2017-11-02', end='2017-11-03')['id']), ['c'])
+        self.assertEqual(list(index.search('orange', n=1)['id']), ['c'])
+
+    def test_incremental(self):
+        index = SearchIndex(self.path)
+        index.add(self.df.iloc[:3])
+        index.save()
+
+        # Reloaded, only the new and changed reports are indexed
+        index = SearchIndex(self.path)
+        self.assertEqual(len(index), 3)
+        df = self.df.copy()
+        df.loc[2, 'summary'] = 'Green disk'
+        self.assertEqual(index.add(df), 3)
+        self.assertEqual(index.add(df), 0)
+        self.assertEqual(len(index), 5)
+        expected = index.search('orange lights')
+        self.assertEqual(list(index.search('orange')['id']), ['d', 'a'])
+        index.save()
+
+        index = SearchIndex(self.path)
+        assert_frame_equal(index.search('orange lights'), expected)
+        index.merge()
+        index.save()
+        self.assertEqual(len([name for name in os.listdir(self.path) if name.endswith('.npz')]), 1)
+        index = SearchIndex(self.path)
+        assert_frame_equal(index.search('orange lights'), expected)
+        self.assertEqual(list(index.search('"green disk"')['id']), ['c'])
+
+
+class TestNearDuplicates(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        text = 'Three bright orange lights hovering silently over the lake, then they vanished.'
+        self.df = pd.DataFrame({
+            'id': ['x3', 'x1', 'x2', 'x4', 'x5', 'x6', 'x7', 'x8'],
+            'summary': [text, text.lower().replace(',', '') + '!!', text.replace('lights', 'light'),
+                        'A white disk moving fast to the north with no sound at all.', text, '', None, text],
+            'state': ['MO', 'MO', 'mo', 'MO', 'TX', 'MO', 'MO', None],
+            'datetime': pd.to_datetime(['2017-11-01 20:00', '2017-11-01 20:30', '2017-11-01 23:00',
+                                        '2017-11-01 00:00', '2017-11-01 00:00', '2017-11-01 00:00',
+                                        '2017-11-01 00:00', '2017-11-01 00:00'])})
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_find(self):
+        dedup = NearDuplicates()
+        self.assertRaises(ValueError, NearDuplicates, 64, 10)
+
+        # Same block and similar summaries only, empty summaries are never duplicates
+        clusters = dedup.find(self.df)
+        self.assertEqual(clusters.tolist(), ['x1', 'x1', 'x1', 'x4', 'x5', 'x6', 'x7', 'x8'])
+        assert_series_equal(dedup.find(self.df.iloc[::-1]), clusters.iloc[::-1])
+
+        signatures = dedup.signatures(self.df['summary'])
+        self.assertEqual(signatures.shape, (8, 64))
+        self.assertTrue((signatures[0] == signatures[4]).all())
+        self.assertLess((signatures[0] == signatures[3]).mean(), 0.5)
+        assert_frame_equal(pd.DataFrame(NearDuplicates().signatures(self.df['summary'])),
+                           pd.DataFrame(signatures))
+
+    def test_bucket_pairs(self):
+        # a, b and c only share the bucket of the first band, where a is the smallest ID but not
+        # similar to the others; b and c differ by one row in each other band and are near duplicates
+        rnd = np.random.RandomState(0)
+        signatures = rnd.randint(0, 1 << 31, (3, 64)).astype(np.uint32)
+        signatures[2] = signatures[1]
+        signatures[2, 4::4] += 1
+        signatures[0, :4] = signatures[1, :4]
+        clusters = NearDuplicates().clusters(['a', 'b', 'c'], [0, 0, 0], signatures)
+        self.assertEqual(clusters.tolist(), ['a', 'b', 'b'])
+        self.assertEqual(NearDuplicates().clusters(['c', 'b', 'a'], [0, 0, 0], signatures[::-1]).tolist(),
+                         ['b', 'b', 'a'])
+
+    def test_counts(self):
+        counties = os.path.join(self.tmp_dir.name, 'US_Counties.csv')
+        write_counties_csv(counties)
+        data = os.path.join(self.tmp_dir.name, 'data.jsonl')
+        with data_scrapper.RecordWriter(data) as writer:
+            for row in self.df.itertuples():
+                writer.write({row.id: {'Date / Time': row.datetime.strftime('%m/%d/%y %H:%M'),
+                                       'City': 'St. Louis', 'State': row.state, 'Shape': 'Light',
+                                       'Summary': row.summary, 'Posted': '11/2/17'}})
+
+        # Both aggregation paths give the same raw or deduplicated counts
+        outputs = {}
+        for mode in (['--dedup'], ['--dedup', '--processes', '2'], []):
+            output_dir = os.path.join(self.tmp_dir.name, '_'.join(mode))
+            run_main(['--data', data, '--counties', counties, '--output-dir', output_dir,
+                      '--cache-dir', os.path.join(output_dir, 'cache'), '--mongo-host', '',
+                      '--begin', '2017-11-01', '--end', '2017-11-30'] + mode)
+            with open(os.path.join(output_dir, 'ts_reports.json'), 'r') as infile:
+                outputs[' '.join(mode)] = infile.read()
+            if (mode == ['--dedup']):
+                # x5 in TX is not a county
+                cube = CountCube(os.path.join(output_dir, 'count_cube'))
+                self.assertEqual(cube.total(), 4)
+
+        self.assertEqual(outputs['--dedup'], outputs['--dedup --processes 2'])
+        # x8 has no state, x2 and x3 are near duplicates of x1
+        self.assertEqual(pd.read_json(StringIO(outputs['']))['reports'].sum(), 7)
+        self.assertEqual(pd.read_json(StringIO(outputs['--dedup']))['reports'].sum(), 5)
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_generators(self):
+        counties = benchmarks.make_counties(60)
+        places = list(zip(counties['County Name'], counties['State Abbr']))
+        reports = list(benchmarks.make_reports(100, places, seed=3))
+        self.assertEqual(reports, list(benchmarks.make_reports(100, places, seed=3)))
+        self.assertNotEqual(reports, list(benchmarks.make_reports(100, places, seed=4)))
+        assert_frame_equal(counties, benchmarks.make_counties(60))
+        self.assertEqual(len(set(report_id for record in reports for report_id in record)), 100)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            data_file, counties_file = benchmarks.write_dataset(tmp_dir, 200)
+            self.assertEqual(len(list(iter_records(data_file))), 200)
+            coord = Coordinates(counties_file)
+            self.assertEqual(len(coord.get_counties()), 50)
+            # the first county has two rings, separated by NaN
+            geometry = Coordinates.parse_geometry(counties['geometry'].iloc[:1])
+            self.assertEqual(len(geometry['ring_offsets']), 3)
+            self.assertEqual(len(coord.county_coordinates(0)[0]), len(geometry['coords']) + 1)
+
+    def test_suite(self):
+        stages = ['geo', 'timeserie'] + (['mongo'] if mongomock else [])
+        results = benchmarks.run_suite([300], stages=stages, repeat=1)
+        self.assertEqual(sorted(results['300']), sorted(['load', 'aggregates', 'counties'] + stages))
+        for result in results['300'].values():
+            self.assertGreater(result['seconds'], 0)
+            self.assertGreater(result['peak_mb'], 0)
+        self.assertRaises(ValueError, benchmarks.run_suite, [300], stages=['missing'])
+
+        baseline = {'300': {'geo': {'seconds': 1.0, 'peak_mb': 10.0}, 'load': {'seconds': 1.0}}}
+        results = {'300': {'geo': {'seconds': 1.1, 'peak_mb': 20.0}, 'load': {'seconds': 2.0},
+                           'cube': {'seconds': 9.0}}}
+        self.assertEqual(len(benchmarks.compare(results, baseline, 0.25)), 2)
+        self.assertEqual(benchmarks.compare(results, baseline, 1.5), [])
+
+        # The command line fails on a regression
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'baseline.json')
+            with open(path, 'w') as outfile:
+                json.dump({'300': {'counties': {'seconds': 1e-9}}}, outfile)
+            argv = ['--sizes', '300', '--stages', 'counties', '--repeat', '1', '--no-memory']
+            self.assertEqual(benchmarks.main(argv + ['--baseline', path]), 1)
+            self.assertEqual(benchmarks.main(argv + ['--save', path]), 0)
+            self.assertEqual(benchmarks.main(argv + ['--baseline', path, '--threshold', '100']), 0)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_disabled(self):
+        collector = Metrics()
+
+        @collector.timed()
+        def square(x):
+            return x * x
+
+        self.assertEqual(square(3), 9)
+        with collector.stage('stage'):
+            collector.inc('counter')
+            collector.observe('histogram', 0.1)
+        self.assertIs(collector.stage('a'), collector.stage('b'))
+        summary = collector.summary()
+        self.assertEqual((summary['stages'], summary['counters'], summary['histograms']), ({}, {}, {}))
+
+    def test_collect(self):
+        collector = Metrics(buckets=[0.1, 1]).enable()
+
+        @collector.timed()
+        def square(x):
+            return x * x
+
+        square(2)
+        square(3)
+        with collector.stage('load'):
+            data = np.ones(8 << 20)
+        with collector.stage('outer'):
+            with collector.stage('spike'):
+                np.ones(8 << 20).sum()
+        after = current_rss()
+        del data
+
+        # The CPU time is the one of the thread of the stage, not of a concurrent one
+        stop = threading.Event()
+
+        def spin():
+            while (not stop.is_set()):
+                pass
+        spinner = threading.Thread(target=spin)
+        spinner.start()
+        try:
+            with collector.stage('sleep'):
+                time.sleep(0.2)
+        finally:
+            stop.set()
+            spinner.join()
+        collector.inc('requests_total', status=200)
+        collector.inc('requests_total', 2, status=200)
+        collector.inc('requests_total', status=404)
+        for value in (0.05, 0.1, 0.5, 3):
+            collector.observe('latency_seconds', value)
+
+        summary = collector.summary()
+        self.assertEqual(summary['stages']['TestMetrics.test_collect.<locals>.square']['calls'], 2)
+        load, outer, spike, sleep = (summary['stages'][name] for name in ('load', 'outer', 'spike', 'sleep'))
+        self.assertGreater(load['wall_seconds'], 0)
+        self.assertGreaterEqual(load['thread_cpu_seconds'], 0)
+        self.assertGreaterEqual(sleep['wall_seconds'], 0.2)
+        self.assertLess(sleep['thread_cpu_seconds'], 0.1)
+        # Each stage gets the peak RSS during its call, an enclosing stage the one of its inner stages
+        if (load['peak_rss_bytes'] is not None):
+            self.assertGreater(load['peak_rss_bytes'], 64 << 20)
+            self.assertGreater(spike['peak_rss_bytes'], after + (32 << 20))
+            self.assertGreaterEqual(outer['peak_rss_bytes'], spike['peak_rss_bytes'])
+            self.assertGreaterEqual(summary['process']['peak_rss_bytes'], 64 << 20)
+        self.assertGreater(summary['process']['cpu_seconds'], sleep['thread_cpu_seconds'])
+        self.assertEqual(summary['counters'], {'requests_total{status=200}': 3, 'requests_total{status=404}': 1})
+        self.assertEqual(summary['histograms']['latency_seconds']['buckets'], {'0.1': 2, '1': 1, '+Inf': 1})
+
+        text = collector.to_prometheus()
+        self.assertIn('# TYPE ufo_requests_total counter\n', text)
+        self.assertIn('ufo_requests_total{status="200"} 3\n', text)
+        self.assertIn('ufo_latency_seconds_bucket{le="0.1"} 2\nufo_latency_seconds_bucket{le="1"} 3\n'
+                      'ufo_latency_seconds_bucket{le="+Inf"} 4\n', text)
+        self.assertIn('ufo_latency_seconds_count 4\n', text)
+        self.assertIn('ufo_stage_calls_total{stage="load"} 1\n', text)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            prefix = os.path.join(tmp_dir, 'metrics')
+            collector.write(prefix)
+            with open(prefix + '.json') as infile:
+                self.assertEqual(json.load(infile)['counters'], summary['counters'])
+            with open(prefix + '.prom') as infile:
+                written = infile.read()
+            self.assertIn('# TYPE ufo_process_peak_rss_bytes gauge\n', written)
+            self.assertEqual([line for line in written.split('\n') if 'process' not in line],
+                             [line for line in text.split('\n') if 'process' not in line])
+
+    def test_sampled_peak(self):
+        # Without the reset of the high water mark a thread samples the RSS
+        collector = Metrics(sample_interval=0.005).enable()
+        with mock.patch('metrics.reset_high_water_rss', return_value=False):
+            with collector.stage('spike'):
+                data = np.ones(8 << 20)
+                time.sleep(0.05)
+                del data
+            after = current_rss()
+        peak = collector.summary()['stages']['spike']['peak_rss_bytes']
+        if (after is not None):
+            self.assertGreater(peak, after + (32 << 20))
+
+
+class TestQueryService(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.csv = os.path.join(self.tmp_dir.name, 'US_Counties.csv')
+        write_counties_csv(self.csv)
+        self.path = os.path.join(self.tmp_dir.name, 'aggregates.sqlite')
+        self.df = pd.DataFrame({'id': ['a', 'b', 'c', 'd', 'e', 'f'],
+                                'city': ['St. Louis', 'St. Louis', 'Austin', 'Boston', 'Boston', 'Nowhere'],
+                                'state': ['MO', 'MO', 'TX', 'MA', 'MA', 'MO'],
+                                'datetime': pd.to_datetime(['2017-11-09 04:30', '2017-11-12 21:00',
+                                                            '2017-11-10 22:00', '2017-11-09 01:00',
+                                                            None, '2017-11-09 01:00'])})
+        aggregates = Aggregates(self.path)
+        aggregates.apply(self.df)
+        aggregates.close()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_queries(self):
+        service = QueryService(self.path, self.csv)
+        self.assertEqual(service.counties().values.tolist(),
+                         [['Austin', 'TX', 1], ['Boston', 'MA', 2], ['St. Louis', 'MO', 2]])
+        self.assertEqual(service.counties(begin='2017-11-10')['reports'].tolist(), [1, 0, 1])
+        self.assertEqual(service.counties('2017-11-09', '2017-11-09', states=['MO']).values.tolist(),
+                         [['St. Louis', 'MO', 1]])
+        boston = service.counties(states=['MA'], geometry=True).iloc[0]
+        self.assertEqual(len(boston['longitude']), 8)
+        self.assertTrue(np.isnan(boston['longitude'][4]))
+
+        # The places which are not counties are still in the time series
+        self.assertEqual(service.timeseries(states=['MO']).values.tolist(),
+                         [['2017-11-09', 'MO', 2], ['2017-11-12', 'MO', 1]])
+        self.assertEqual(service.timeseries('2017-11-01', '2017-11-30', freq='month').values.tolist(),
+                         [['2017-11', 'MA', 1], ['2017-11', 'MO', 3], ['2017-11', 'TX', 1]])
+        self.assertEqual(len(service.timeseries(states=['WA'])), 0)
+
+        self.assertEqual(service.top(n=2).values.tolist(), [['Boston', 'MA', 2], ['St. Louis', 'MO', 2]])
+        self.assertEqual(service.top(by='state').values.tolist(), [['MO', 3], ['MA', 2], ['TX', 1]])
+        with self.assertRaises(ValueError):
+            service.top(by='city')
+
+    def test_cache(self):
+        cache = LRUCache(10)
+        cache.put('a', b'12345')
+        cache.put('b', b'1234')
+        self.assertEqual(cache.get('a'), b'12345')
+        cache.put('c', b'12')
+        cache.put('d', b'12345678901')
+        # b was the least recently used, d is larger than the cache
+        self.assertEqual([cache.get(key) for key in 'abcd'], [b'12345', None, b'12', None])
+        self.assertEqual(cache.stats()['bytes'], 7)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+        service = QueryService(self.path, self.csv)
+        body = service.query('top', {'n': ['1'], 'by': ['state']})
+        self.assertEqual(json.loads(body), [{'state': 'MO', 'reports': 3}])
+        self.assertIs(service.query('top', {'by': ['state'], 'n': ['1']}), body)
+        self.assertEqual(service.cache.stats()['hits'], 1)
+        self.assertEqual(json.loads(service.query('counties', {'state': ['tx,ma']})),
+                         [{'city': 'Austin', 'state': 'TX', 'reports': 1},
+                          {'city': 'Boston', 'state': 'MA', 'reports': 2}])
+
+        # Loading new reports empties the cache
+        generation = service.generation
+        service.load(pd.DataFrame({'id': ['g'], 'city': ['Austin'], 'state': ['TX'],
+                                   'datetime': pd.to_datetime(['2017-11-11'])}))
+        self.assertEqual(service.generation, generation + 1)
+        self.assertEqual(service.cache.stats()['entries'], 0)
+        self.assertEqual(json.loads(service.query('top', {'n': ['1'], 'by': ['state']})),
+                         [{'state': 'MO', 'reports': 3}])
+        self.assertEqual(service.top(n=3, by='state')['reports'].tolist(), [3, 2, 2])
+
+        # So does a change of the SQLite file by another process
+        aggregates = Aggregates(self.path)
+        aggregates.apply(pd.DataFrame({'id': ['h', 'i'], 'city': ['Austin', 'Austin'], 'state': ['TX', 'TX'],
+                                       'datetime': pd.to_datetime(['2017-11-11', '2017-11-12'])}))
+        aggregates.close()
+        self.assertEqual(json.loads(service.query('top', {'n': ['1'], 'by': ['state']})),
+                         [{'state': 'TX', 'reports': 4}])
+        self.assertEqual(service.generation, generation + 2)
+
+    def test_http(self):
+        service = QueryService(self.path, self.csv)
+        server = make_server(service, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:%s/' % server.server_address[1]
+        try:
+            with urllib.request.urlopen(url + 'timeseries?state=MA&begin=2017-11-01') as response:
+                self.assertEqual(response.headers['Content-Type'], 'application/json')
+                self.assertEqual(json.load(response), [{'datetime': '2017-11-09', 'state': 'MA', 'reports': 1}])
+            for path, status in (('top?n=x', 400), ('counties?begin=2017-12-01&end=2017-11-01', 400),
+                                 ('unknown', 404)):
+                with self.assertRaises(urllib.error.HTTPError) as error:
+                    urllib.request.urlopen(url + path)
+                self.assertEqual(error.exception.code, status)
+
+            with urllib.request.urlopen(urllib.request.Request(url + 'reload', data=b'', method='POST')) as response:
+                self.assertEqual(json.load(response), {'generation': 2})
+            with urllib.request.urlopen(url + 'stats') as response:
+                self.assertEqual(json.load(response)['entries'], 0)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestScrapper(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FixtureHandler.pages = build_fixture_pages()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.stem = 'http://127.0.0.1:%d/' % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.output = os.path.join(self.tmp_dir.name, 'data.json')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_retrieve_data(self):
+        pages = data_scrapper.extract_links(
+            data_scrapper.get_soup_object(self.stem + 'ndxevent.html'))
+        self.assertEqual(pages, ['ndxe201711', 'ndxe201710'])
+
+        self.assertEqual(data_scrapper.retrieve_data(pages, self.stem, self.output, fast=False), 5)
+        serial = list(iter_records(self.output))
+        data_scrapper.retrieve_data(pages, self.stem, self.output, workers=4, rate=200)
+        concurrent = list(iter_records(self.output))
+
+        # Results keep the order of the index whatever the number of workers
+        self.assertEqual(serial, concurrent)
+        self.assertEqual([list(r)[0] for r in concurrent],
+                         ['1711/S171101', '1711/S171102', '1711/S171103',
+                          '1710/S171001', '1710/S171002'])
+        self.assertEqual(concurrent[0]['1711/S171101']['Summary'],
+                         'Long summary of 1711/S171101')
+        self.assertEqual(concurrent[0]['1711/S171101']['City'], 'St. Louis')
+
+    def test_unexpected_page(self):
+        # a month page whose rows don't match its links is skipped, not the whole crawl
+        FixtureHandler.pages['ndxe201712.html'] = FixtureHandler.pages['ndxe201711.html'].replace(
+            '<a href="1711/S171102.html">', '<a href="about.html">', 1)
+        try:
+            for fast in (True, False):
+                self.assertEqual(data_scrapper.retrieve_data(['ndxe201712', 'ndxe201710'], self.stem, self.output,
+                                                             fast=fast), 2)
+        finally:
+            del FixtureHandler.pages['ndxe201712.html']
+        self.assertEqual([list(r)[0] for r in iter_records(self.output)], ['1710/S171001', '1710/S171002'])
+
+    def test_metrics(self):
+        FixtureHandler.failures = {'1711/S171102.html': 1}
+        metrics.reset()
+        metrics.enable()
+        try:
+            self.assertEqual(data_scrapper.retrieve_data(['ndxe201711'], self.stem, self.output, backoff=0), 3)
+        finally:
+            metrics.disable()
+            FixtureHandler.failures = {}
+
+        # One month page and three summaries, one of them retried after a 503
+        summary = metrics.summary()
+        self.assertEqual(summary['counters']['http_requests_total{status=200}'], 4)
+        self.assertEqual(summary['counters']['http_retries_total'], 1)
+        self.assertGreater(summary['counters']['http_response_bytes_total'], 0)
+        self.assertEqual(summary['histograms']['http_request_seconds']['count'], 4)
+        self.assertEqual(summary['stages']['scraper.retrieve_data']['calls'], 1)
+        self.assertEqual(summary['stages']['scraper.parse_event_page']['calls'], 1)
+        metrics.reset()
+
+    def test_incremental_crawl(self):
+        cache_dir = os.path.join(self.tmp_dir.name, 'cache')
+        state_file = os.path.join(self.tmp_dir.name, 'state.json')
+        crawl = partial(data_scrapper.retrieve_data, base_url=self.stem, output_file=self.output,
+                        cache_dir=cache_dir, state_file=state_file)
+
+        # An interrupted crawl keeps a checkpoint of the month pages completed
+        FixtureHandler.hits = []
+        crawl(['ndxe201711', 'ndxe000000', 'ndxe201710'])
+        self.assertEqual(len(FixtureHandler.hits), 5)
+
+        # Resuming revalidates the completed month and only fetches the others
+        FixtureHandler.hits = []
+        crawl(['ndxe201711', 'ndxe201710'])
+        self.assertEqual(FixtureHandler.hits, ['ndxe201711.html', 'ndxe201710.html',
+                                               '1710/S171001.html', '1710/S171002.html'])
+        full = list(iter_records(self.output))
+        data_scrapper.retrieve_data(['ndxe201711', 'ndxe201710'], self.stem, self.output)
+        self.assertEqual(full, list(iter_records(self.output)))
+
+        # A re-run with unchanged pages downloads no report page
+        FixtureHandler.hits = []
+        crawl(['ndxe201711', 'ndxe201710'])
+        self.assertEqual(full, list(iter_records(self.output)))
+        self.assertEqual(FixtureHandler.hits, ['ndxe201711.html', 'ndxe201710.html'])
+
+        # An edited row of a changed month page is written with the summary kept in the state
+        page = FixtureHandler.pages['ndxe201711.html']
+        FixtureHandler.pages['ndxe201711.html'] = page.replace('St. Louis', 'Kirkwood', 1)
+        try:
+            FixtureHandler.hits = []
+            crawl(['ndxe201711', 'ndxe201710'])
+        finally:
+            FixtureHandler.pages['ndxe201711.html'] = page
+        self.assertEqual(FixtureHandler.hits, ['ndxe201711.html', 'ndxe201710.html'])
+        report = list(iter_records(self.output))[0]['1711/S171101']
+        self.assertEqual((report['City'], report['Summary']), ('Kirkwood', 'Long summary of 1711/S171101'))
+
+    def test_RecordWriter(self):
+        records = [{'1711/S171101': {'City': 'St. Louis', 'Summary': 'a'}},
+                   {'1711/S171102': {'City': 'Boston', 'Summary': None}}]
+
+        for name in ('data.jsonl', 'data.jsonl.gz', 'data.json', 'data.json.gz'):
+            path = os.path.join(self.tmp_dir.name, name)
+            with data_scrapper.RecordWriter(path, fsync_every=1) as writer:
+                for record in records:
+                    writer.write(record)
+            self.assertEqual(writer.count, 2)
+            self.assertEqual(list(iter_records(path)), records)
+
+    def test_fast_parser(self):
+        pages = build_fixture_pages()
+        pages['generated.html'] = benchmarks.make_month_page(50)
+        # a row with a missing cell still gives a record
+        pages['malformed.html'] = pages['ndxe201710.html'].replace('<td>Light</td>', '', 1)
+
+        for name, text in pages.items():
+            soup = BeautifulSoup(text, 'html.parser')
+            self.assertEqual(data_scrapper.parse_event_page(text),
+                             (data_scrapper.extract_links(soup),
+                              data_scrapper.get_event_content(soup)))
+
+        ids, records = data_scrapper.parse_event_page(pages['malformed.html'])
+        self.assertEqual(len(ids), len(records))
+        self.assertEqual(records[0]['Posted'], '')
+        self.assertEqual(records[1]['Shape'], 'Light')
+
+        url = self.stem + '1711/S171101.html'
+        self.assertEqual(data_scrapper.get_extended_summary(url, fast=True),
+                         data_scrapper.get_extended_summary(url))
+        self.assertIsNone(data_scrapper.parse_summary_page('<html></html>'))
+
+    def test_RateLimiter(self):
+        with self.assertRaises(ValueError):
+            data_scrapper.RateLimiter(0)
+
+        limiter = data_scrapper.RateLimiter(50)
+        start = time.monotonic()
+        for i in range(5):
+            limiter.wait(self.stem)
+        self.assertGreaterEqual(time.monotonic() - start, 0.08)
+
+
 # Run the tests
 if __name__ == '__main__':
     unittest.main(argv=[""], exit=False, verbosity=2)